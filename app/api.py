@@ -0,0 +1,529 @@
+"""
+This module serves the account flows as an HTTP/JSON API so they can run behind a load
+balancer.
+
+The server is a small HTTP/1.1 implementation on asyncio streams. It needs no packages
+beyond the standard library and keeps connections alive between requests. Each request
+is handed to service.LoginService, which runs the account flows in flows.py that the
+CLI runs too, so no request ever blocks the event loop on bcrypt, the database or
+SMTP. With --workers N the listening socket is opened once and shared by N worker
+processes, each running its own event loop, so the API scales across cores. Those
+processes are run by supervisor.Supervisor, which restarts crashed workers, recycles
+them after API_MAX_REQUESTS requests and reloads the settings on SIGHUP.
+
+Endpoints (JSON bodies, JSON responses with a "status" field):
+
+    POST   /register                 {"email", "password"}
+    POST   /login                    {"email", "password"}          -> "token" unless 2FA is required
+                                     + "code" for app 2FA, or "email_code": true to get one by email
+    POST   /login/2fa                {"email", "code"}              -> "token" (emailed codes)
+    POST   /password/reset-request   {"email"}
+    POST   /password/reset           {"email", "code", "new_password"}
+    POST   /logout                   (session)
+    POST   /account/email            {"new_email"}                  (session)
+    POST   /account/2fa              (session)                      emailed codes
+    POST   /account/2fa/app          (session)                      -> "secret", "uri"
+    POST   /account/2fa/app/confirm  {"secret", "code"}             (session) -> "backup_codes"
+    DELETE /account                  {"password"}                   (session)
+    GET    /health
+
+Endpoints marked (session) need an "Authorization: Bearer <token>" header. With more
+than one worker, sessions and verification codes are kept in the sqlite stores
+(SESSION_STORE_PATH, CODE_STORE_PATH), so every worker sees the same ones.
+
+Usage:
+    python api.py --port 8080 --workers 4
+"""
+
+import argparse, asyncio, json, os, socket, sys, traceback
+import config, db, hashing, metrics, service
+
+# HTTP status returned for each service status
+HTTP_STATUS = {
+    service.OK: 200,
+    service.TWO_FA_REQUIRED: 200,
+    service.CODE_SENT: 200,
+    service.UNKNOWN_EMAIL: 401,
+    service.BAD_PASSWORD: 401,
+    service.BAD_CODE: 401,
+    service.ACCOUNT_EXISTS: 409,
+    service.ALREADY_ENABLED: 409,
+    service.INVALID_EMAIL: 400,
+    service.INVALID_PASSWORD: 400,
+    service.RATE_LIMITED: 429,
+    service.LOCKED: 423,
+}
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+           408: "Request Timeout", 409: "Conflict", 413: "Payload Too Large", 423: "Locked", 429: "Too Many Requests",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class BadRequest(Exception):
+    """
+    Raised by a handler when the request body is missing a field or has the wrong type.
+    """
+
+
+class Request:
+    """
+    A parsed API request as seen by the handlers.
+
+    Attributes:
+        body (dict): The decoded JSON body.
+        email (str | None): The session's user, for endpoints that require a session.
+        token (str | None): The session token sent with the request.
+        source (str | None): The client's address, used for per-source rate limits.
+    """
+
+    __slots__ = ("body", "email", "token", "source")
+
+    def __init__(self, body, email, token, source) -> None:
+        self.body = body
+        self.email = email
+        self.token = token
+        self.source = source
+
+    def field(self, name) -> str:
+        value = self.body.get(name)
+        if not isinstance(value, str):
+            raise BadRequest(f"Field '{name}' must be a string")
+        return value
+
+    def optional_field(self, name) -> str | None:
+        return None if self.body.get(name) is None else self.field(name)
+
+
+class ApiServer:
+    """
+    Routes HTTP requests to a LoginService.
+
+    Args:
+        login_service (service.LoginService): A started service.
+        keepalive_timeout (float): Seconds an idle keep-alive connection is kept open.
+        max_body (int): Largest request body accepted, in bytes.
+        max_requests (int): Requests after which on_limit is called once; 0 for no limit.
+        on_limit (callable | None): Called when max_requests is reached, typically to stop serving.
+        request_timeout (float): Seconds a client has to send the rest of a request once it
+            has started one; slower clients get a 408 and are disconnected.
+    """
+
+    def __init__(self, login_service, keepalive_timeout=15.0, max_body=65536, max_requests=0, on_limit=None,
+                 request_timeout=10.0) -> None:
+        self.service = login_service
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.max_body = max_body
+        self.max_requests = max_requests
+        self.on_limit = on_limit
+
+        # Load counters, reported by stats()
+        self.requests = 0
+        self.in_flight = 0
+        self.connections = 0
+        self.errors = 0
+
+        # Once set, responses ask clients to close and idle connections are closed
+        self.draining = False
+
+        self._idle = set()  # Writers of keep-alive connections waiting for their next request
+        self._awaiting = 0  # New connections that have not sent their first request yet
+        self._done = asyncio.Event()  # Set while neither of those nor a request in flight exists
+        self._done.set()
+
+        # (method, path) -> (handler, needs a session)
+        self.routes = {
+            ("POST", "/register"): (self.register, False),
+            ("POST", "/login"): (self.login, False),
+            ("POST", "/login/2fa"): (self.verify_2fa, False),
+            ("POST", "/password/reset-request"): (self.request_reset, False),
+            ("POST", "/password/reset"): (self.reset_password, False),
+            ("POST", "/logout"): (self.logout, True),
+            ("POST", "/account/email"): (self.change_email, True),
+            ("POST", "/account/2fa"): (self.enable_2fa, True),
+            ("POST", "/account/2fa/app"): (self.new_totp_secret, True),
+            ("POST", "/account/2fa/app/confirm"): (self.enable_totp, True),
+            ("DELETE", "/account"): (self.delete_account, True),
+            ("GET", "/health"): (self.health, False),
+        }
+
+    async def handle_connection(self, reader, writer) -> None:
+        """
+        Serves requests on one connection until the client closes it, asks for it to be
+        closed, or leaves it idle for longer than keepalive_timeout.
+        """
+
+        peer = writer.get_extra_info("peername")
+        source = peer[0] if peer else None
+        self.connections += 1
+        self._awaiting += 1  # Until its first request arrives, a new connection counts as busy
+        self._done.clear()
+        first = True
+
+        try:
+            while True:
+                if not first:
+                    if self.draining:
+                        return
+                    self._idle.add(writer)
+
+                # An idle connection may wait keepalive_timeout for the first byte of its next request
+                try:
+                    start = await asyncio.wait_for(reader.readexactly(1), self.keepalive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                finally:
+                    self._idle.discard(writer)
+
+                self.in_flight += 1
+                self._done.clear()
+                if first:
+                    first = False
+                    self._awaiting -= 1
+
+                try:
+                    # The rest of the request must follow within request_timeout, so a stalled
+                    # client cannot hold the connection, or keep drain() from finishing
+                    try:
+                        head = start + await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.request_timeout)
+                    except asyncio.TimeoutError:
+                        await self._respond(writer, 408, {"status": "bad_request"}, keep_alive=False)
+                        return
+                    except asyncio.LimitOverrunError:
+                        return
+
+                    keep_alive = await self._handle_request(reader, writer, head, source)
+                finally:
+                    self._finished()
+
+                if not keep_alive:
+                    return
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # The client went away mid-request
+
+        finally:
+            if first:
+                self._awaiting -= 1
+                self._settle()
+            self.connections -= 1
+            writer.close()
+
+    async def _handle_request(self, reader, writer, head, source) -> bool:
+        # Reads the body of one request and answers it; returns whether to keep the connection open
+        request_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+        parts = request_line.split(" ")
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            length = -1
+
+        if len(parts) != 3 or length < 0:
+            await self._respond(writer, 400, {"status": "bad_request"}, keep_alive=False)
+            return False
+
+        if length > self.max_body:
+            await self._respond(writer, 413, {"status": "bad_request"}, keep_alive=False)
+            return False
+
+        method, target, version = parts
+
+        try:
+            body = await asyncio.wait_for(reader.readexactly(length), self.request_timeout) if length else b""
+        except asyncio.TimeoutError:
+            await self._respond(writer, 408, {"status": "bad_request"}, keep_alive=False)
+            return False
+
+        connection_header = headers.get("connection", "").lower()
+        keep_alive = connection_header != "close" if version == "HTTP/1.1" else connection_header == "keep-alive"
+
+        status, payload = await self.dispatch(method, target.split("?", 1)[0], headers, body, source)
+        if status >= 500:
+            self.errors += 1
+
+        # A draining server answers the request but asks the client to reconnect elsewhere
+        keep_alive = keep_alive and not self.draining
+        await self._respond(writer, status, payload, keep_alive)
+        return keep_alive
+
+    def _finished(self) -> None:
+        self.in_flight -= 1
+        self.requests += 1
+        self._settle()
+
+        if self.max_requests and self.requests == self.max_requests and self.on_limit:
+            self.on_limit()
+
+    def _settle(self) -> None:
+        # Lets drain() return once nothing is in flight and no new connection awaits its first request
+        if not self.in_flight and not self._awaiting:
+            self._done.set()
+
+    async def drain(self, timeout) -> bool:
+        """
+        Stops taking new requests on open connections and waits for the requests in
+        flight to be answered. Idle keep-alive connections are closed at once; busy ones
+        are closed after their current response. A new connection is still served one
+        request, since its client may already have sent it.
+
+        Args:
+            timeout (float): Longest wait, in seconds.
+
+        Returns:
+            bool: True if every request in flight was answered within the timeout.
+        """
+
+        self.draining = True
+        for writer in list(self._idle):
+            writer.close()
+
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> dict:
+        """
+        Returns the load counters: requests answered, requests in flight, open connections
+        and requests answered with a 5xx status.
+        """
+
+        return {"requests": self.requests, "in_flight": self.in_flight,
+                "connections": self.connections, "errors": self.errors}
+
+    async def dispatch(self, method, path, headers, body, source) -> tuple:
+        """
+        Runs the handler for one request.
+
+        Returns:
+            tuple: The HTTP status code and the JSON payload.
+        """
+
+        route = self.routes.get((method, path))
+
+        if route is None:
+            known_path = any(route_path == path for _, route_path in self.routes)
+            return (405, {"status": "method_not_allowed"}) if known_path else (404, {"status": "not_found"})
+
+        handler, needs_session = route
+
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            return 400, {"status": "bad_request", "error": "Body is not valid JSON"}
+
+        if not isinstance(data, dict):
+            return 400, {"status": "bad_request", "error": "Body must be a JSON object"}
+
+        token = email = None
+        if needs_session:
+            token = headers.get("authorization", "").removeprefix("Bearer ").strip()
+            email = await self.service.session_user(token)
+            if email is None:
+                return 401, {"status": "unauthorized"}
+
+        try:
+            return await handler(Request(data, email, token, source))
+
+        except BadRequest as error:
+            return 400, {"status": "bad_request", "error": str(error)}
+
+        except db.DatabaseUnavailable:
+            return 503, {"status": "unavailable"}
+
+        except Exception:
+            traceback.print_exc()
+            metrics.count("api_errors_total", path=path)
+            return 500, {"status": "error"}
+
+    @staticmethod
+    def _result(status, **extra) -> tuple:
+        return HTTP_STATUS[status], {"status": status, **extra}
+
+    async def register(self, request) -> tuple:
+        return self._result(await self.service.register(request.field("email"), request.field("password")))
+
+    async def login(self, request) -> tuple:
+        email = request.field("email")
+        status = await self.service.login(email, request.field("password"), request.source,
+                                          request.optional_field("code"), request.body.get("email_code") is True)
+
+        if status == service.OK:
+            return self._result(status, token=await self.service.start_session(email))
+        return self._result(status)
+
+    async def verify_2fa(self, request) -> tuple:
+        email = request.field("email")
+        status = await self.service.verify_2fa(email, request.field("code"), request.source)
+
+        if status == service.OK:
+            return self._result(status, token=await self.service.start_session(email))
+        return self._result(status)
+
+    async def request_reset(self, request) -> tuple:
+        return self._result(await self.service.request_reset(request.field("email"), request.source))
+
+    async def reset_password(self, request) -> tuple:
+        return self._result(await self.service.reset_password(
+            request.field("email"), request.field("code"), request.field("new_password")))
+
+    async def logout(self, request) -> tuple:
+        await self.service.end_session(request.token, request.email)
+        return self._result(service.OK)
+
+    async def change_email(self, request) -> tuple:
+        new_email = request.field("new_email")
+        status = await self.service.change_email(request.email, new_email)
+
+        # The old sessions are gone, so hand the caller a session under the new email
+        if status == service.OK:
+            return self._result(status, token=await self.service.start_session(new_email))
+        return self._result(status)
+
+    async def enable_2fa(self, request) -> tuple:
+        return self._result(await self.service.enable_2fa(request.email))
+
+    async def new_totp_secret(self, request) -> tuple:
+        secret, uri = await self.service.new_totp_secret(request.email)
+        return self._result(service.OK, secret=secret, uri=uri)
+
+    async def enable_totp(self, request) -> tuple:
+        status, backup_codes = await self.service.enable_totp(request.email, request.field("secret"), request.field("code"))
+
+        if status == service.OK:
+            return self._result(status, backup_codes=backup_codes)
+        return self._result(status)
+
+    async def delete_account(self, request) -> tuple:
+        return self._result(await self.service.delete_account(request.email, request.field("password")))
+
+    async def health(self, request) -> tuple:
+        return self._result(service.OK)
+
+    @staticmethod
+    async def _respond(writer, status, payload, keep_alive) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+
+async def serve(sock, hash_workers=None, stop=None, max_requests=0, on_limit=None, monitor=None) -> None:
+    """
+    Serves the API on an already bound, listening socket until stop is set or the task is
+    cancelled. It then stops accepting connections and waits up to API_GRACEFUL_TIMEOUT
+    seconds for the requests in flight to be answered.
+
+    Args:
+        sock (socket.socket): The listening socket, possibly shared with other workers.
+        hash_workers (int | None): bcrypt processes for this worker; defaults to SERVICE_HASH_WORKERS.
+        stop (asyncio.Event | None): Set to stop serving.
+        max_requests (int): Requests after which on_limit is called; 0 for no limit.
+        on_limit (callable | None): Called when max_requests is reached; defaults to setting stop.
+        monitor (callable | None): Coroutine function run with the ApiServer while serving, e.g.
+            to report its stats(); cancelled once the server has drained.
+    """
+
+    stop = stop or asyncio.Event()
+    engine = hashing.HashEngine(hashing.get_engine().rounds, hash_workers or config.SERVICE_HASH_WORKERS or None)
+
+    async with service.LoginService(hash_engine=engine) as login_service:
+        api = ApiServer(login_service, config.API_KEEPALIVE_TIMEOUT, config.API_MAX_BODY, max_requests, on_limit or stop.set,
+                        config.API_REQUEST_TIMEOUT)
+        server = await asyncio.start_server(api.handle_connection, sock=sock)
+        watcher = asyncio.create_task(monitor(api)) if monitor else None
+
+        try:
+            await stop.wait()
+        finally:
+            # Other workers keep accepting on the shared socket while this one finishes its requests
+            server.close()
+            if not await api.drain(config.API_GRACEFUL_TIMEOUT):
+                print(f"Warning: {api.in_flight} request(s) still in flight after {config.API_GRACEFUL_TIMEOUT}s",
+                      file=sys.stderr)
+            if watcher:
+                watcher.cancel()
+            engine.close()
+
+
+def bind(host, port, backlog=1024) -> socket.socket:
+    """
+    Opens the listening socket that every worker accepts connections from.
+    """
+
+    sock = socket.create_server((host, port), backlog=backlog, reuse_port=False)
+    sock.setblocking(False)
+    return sock
+
+
+def adjust_settings(workers) -> None:
+    """
+    Changes the settings that would be wrong with several worker processes. Called again
+    by the supervisor after every reload.
+    """
+
+    if workers > 1 and config.SESSION_STORE == "memory":
+        # The kernel hands each connection to any worker, so a token must be valid in all of them
+        print(f"Note: sessions are kept in {config.SESSION_STORE_PATH} with several workers", file=sys.stderr)
+        config.SESSION_STORE = "sqlite"
+
+    if workers > 1 and config.CODE_STORE == "memory":
+        # The code sent by one worker is usually checked by another
+        print(f"Note: verification codes are kept in {config.CODE_STORE_PATH} with several workers", file=sys.stderr)
+        config.CODE_STORE = "sqlite"
+
+    if workers > 1 and config.EMAIL_FILTER:
+        # A worker's filter would not see accounts registered through the other workers
+        print("Note: the unknown-email filter is turned off with several workers", file=sys.stderr)
+        config.EMAIL_FILTER = False
+
+    if workers > 1 and config.USER_CACHE:
+        # A worker's cache would keep serving records another worker has just changed
+        print("Note: the user record cache is turned off with several workers", file=sys.stderr)
+        config.USER_CACHE = False
+
+
+def run(host, port, workers) -> None:
+    """
+    Runs the API with the given number of worker processes. One runs in-process; more
+    are forked and looked after by supervisor.Supervisor.
+    """
+
+    workers = workers or os.cpu_count()
+
+    if workers > 1:
+        import supervisor
+        supervisor.Supervisor(host, port, workers).run()
+        return
+
+    sock = bind(host, port)
+    print(f"Serving the login API on http://{host}:{sock.getsockname()[1]} with 1 worker")
+
+    try:
+        asyncio.run(serve(sock))
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Serve the login simulator over HTTP/JSON.")
+    parser.add_argument("--host", default=config.API_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=config.API_PORT, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=config.API_WORKERS, help="Worker processes (0: one per CPU)")
+    args = parser.parse_args(argv)
+
+    metrics.start_exporters()
+    run(args.host, args.port, args.workers)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,383 @@
+"""
+This module keeps an audit log of account events: logins and failed logins, logouts,
+password resets and changes, email changes, 2FA enrolment and account deletion.
+
+Recording an event never touches the database on the caller's thread. Events go into a
+bounded in-memory ring buffer, and a background flusher writes them to the
+login_events table in multi-row INSERTs of up to batch_size rows, once a batch has
+filled up or flush_interval has passed. If the database write fails, or AUDIT_SINK is
+"file", the batch is appended to a local JSONL file instead. What happens when the
+buffer is full is set by AUDIT_ON_FULL:
+
+    drop_oldest   Overwrite the oldest buffered event (the default; never blocks)
+    drop_newest   Discard the new event
+    block         Wait for the flusher to make room
+
+Events are read back with the query tool, which streams the table (or the fallback
+file) filtered by user, event and time range:
+
+Usage:
+    python audit.py --email user@example.com --since 2024-05-01 --until 2024-05-02
+    python audit.py --event login_failed --since 2024-05-01T12:00 --file audit.jsonl
+"""
+
+import argparse, atexit, collections, json, sys, threading, time
+from datetime import datetime, timezone
+import config, db, metrics
+
+# Event names stored in login_events.event
+ACCOUNT_CREATED = "account_created"
+LOGIN_SUCCEEDED = "login_succeeded"  # detail holds "totp" or "backup_code" for authenticator-app logins
+LOGIN_FAILED = "login_failed"  # detail holds the reason, e.g. "bad_password"
+LOGGED_OUT = "logged_out"
+RESET_REQUESTED = "password_reset_requested"
+PASSWORD_RESET = "password_reset"
+PASSWORD_CHANGED = "password_changed"
+EMAIL_CHANGED = "email_changed"  # Recorded under the old email; detail holds the new one
+TWO_FA_ENABLED = "2fa_enabled"  # detail holds the method, "email" or "app"
+ACCOUNT_DELETED = "account_deleted"
+
+# Buffer policies for AUDIT_ON_FULL
+ON_FULL = ("drop_oldest", "drop_newest", "block")
+
+COLUMNS = ("occurred_at", "email", "event", "source", "detail")
+
+# VARCHAR widths of the login_events columns (migration 0004); longer values are clipped,
+# since one oversized value would make SQL Server reject the whole multi-row insert
+EMAIL_WIDTH = 100
+SOURCE_WIDTH = 64
+DETAIL_WIDTH = 200
+
+# SQL Server accepts at most 2100 parameters per statement
+MAX_BATCH_SIZE = 2100 // len(COLUMNS)
+
+
+def _insert_sql(rows) -> str:
+    values = ", ".join(["(?, ?, ?, ?, ?)"] * rows)
+    return f"INSERT INTO login_events ({', '.join(COLUMNS)}) VALUES {values}"
+
+
+class AuditLog:
+    """
+    Ring buffer of audit events drained by a background flusher thread.
+
+    Args:
+        sink (str): "db" to write to login_events, "file" to write only to fallback_path.
+        fallback_path (str): JSONL file batches are appended to when the database write fails.
+        capacity (int): Events the buffer holds before on_full applies.
+        batch_size (int): Most rows written per INSERT.
+        flush_interval (float): Longest time in seconds an event waits in the buffer.
+        on_full (str): One of ON_FULL.
+    """
+
+    def __init__(self, sink="db", fallback_path="audit.jsonl", capacity=10000, batch_size=100,
+                 flush_interval=1.0, on_full="drop_oldest") -> None:
+
+        if on_full not in ON_FULL:
+            raise ValueError(f"on_full must be one of {', '.join(ON_FULL)}")
+
+        self.sink = sink
+        self.fallback_path = fallback_path
+        self.capacity = max(1, capacity)
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.flush_interval = flush_interval
+        self.on_full = on_full
+
+        self._buffer = collections.deque()
+        self._in_flight = 0  # Events taken from the buffer that are still being written
+        self._flushing = 0  # flush() callers waiting; the flusher writes partial batches meanwhile
+        self._closed = False
+        self._thread = None
+        self._condition = threading.Condition()
+        self._metrics = {"emitted": 0, "written": 0, "fallback": 0, "dropped": 0, "batches": 0}
+
+    def emit(self, event, email, source=None, detail=None) -> bool:
+        """
+        Buffers an event for the flusher.
+
+        Args:
+            event (str): The event name, e.g. LOGIN_FAILED.
+            email (str): The account the event belongs to.
+            source (str | None): Client address or other origin.
+            detail (str | None): Extra information such as a failure reason.
+
+        Returns:
+            bool: False if the event was dropped because the buffer was full.
+        """
+
+        row = (int(time.time() * 1000), email[:EMAIL_WIDTH], event,
+               source[:SOURCE_WIDTH] if source is not None else None,
+               detail[:DETAIL_WIDTH] if detail is not None else None)
+        self._start()
+
+        with self._condition:
+            if len(self._buffer) >= self.capacity:
+                if self.on_full == "drop_newest":
+                    self._metrics["dropped"] += 1
+                    metrics.count("audit_events_dropped_total")
+                    return False
+
+                if self.on_full == "drop_oldest":
+                    self._buffer.popleft()
+                    self._metrics["dropped"] += 1
+                    metrics.count("audit_events_dropped_total")
+
+                else:
+                    self._condition.notify_all()
+                    while len(self._buffer) >= self.capacity and not self._closed:
+                        self._condition.wait()
+
+            self._buffer.append(row)
+            self._metrics["emitted"] += 1
+
+            # Wake the flusher early once a full batch is waiting
+            if len(self._buffer) >= self.batch_size:
+                self._condition.notify_all()
+
+        return True
+
+    def flush(self) -> None:
+        """
+        Blocks until every buffered event has been written.
+        """
+
+        self._start()
+
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                while (self._buffer or self._in_flight) and self._thread is not None:
+                    self._condition.wait()
+            finally:
+                self._flushing -= 1
+
+    def close(self) -> None:
+        """
+        Writes the remaining events and stops the flusher.
+        """
+
+        with self._condition:
+            self._closed = True
+            thread, self._thread = self._thread, None
+            self._condition.notify_all()
+
+        if thread is not None:
+            thread.join()
+
+        # Events buffered after the flusher stopped, or with no flusher ever started
+        while self._buffer:
+            self._write([self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))])
+
+    def metrics(self) -> dict:
+        """
+        Returns event counters and the current buffer depth.
+        """
+
+        with self._condition:
+            return {**self._metrics, "buffered": len(self._buffer)}
+
+    def _start(self) -> None:
+        # The flusher thread is only started once the first event is emitted
+        if self._thread is not None or self._closed:
+            return
+
+        with self._condition:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._flush_loop, name="audit-flusher", daemon=True)
+                self._thread.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._condition:
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._buffer) < self.batch_size and not self._closed and not (self._flushing and self._buffer):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                if not self._buffer:
+                    if self._closed:
+                        return
+                    self._condition.notify_all()  # Wake flush() callers
+                    continue
+
+                batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                self._in_flight = len(batch)
+                self._condition.notify_all()  # Room for blocked emitters
+
+            try:
+                self._write(batch)
+            finally:
+                with self._condition:
+                    self._in_flight = 0
+                    self._condition.notify_all()
+
+    def _write(self, batch) -> None:
+        if self.sink == "db":
+            try:
+                with db.connection() as connection:
+                    db.execute(connection, _insert_sql(len(batch)), [value for row in batch for value in row])
+                    connection.commit()
+                self._count("written", "batches", len(batch))
+                return
+
+            except Exception as error:
+                print(f"Could not write audit events to the database, appending them to {self.fallback_path}: {error!r}",
+                      file=sys.stderr)
+
+        try:
+            self._append_to_file(batch)
+            self._count("fallback", "batches", len(batch))
+        except OSError as error:
+            print(f"Could not write {len(batch)} audit events: {error!r}", file=sys.stderr)
+            self._count("dropped", "batches", len(batch))
+
+    def _append_to_file(self, batch) -> None:
+        # One write per batch, so batches from several processes do not interleave
+        lines = "".join(json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in batch)
+        with open(self.fallback_path, "a", encoding="utf-8") as file:
+            file.write(lines)
+
+    def _count(self, name, batches_name, events) -> None:
+        with self._condition:
+            self._metrics[name] += events
+            self._metrics[batches_name] += 1
+        metrics.count("audit_batches_total", outcome=name)
+
+
+_audit_log = None
+_audit_log_lock = threading.Lock()
+
+
+def get_audit_log() -> AuditLog | None:
+    """
+    Returns the process-wide audit log, or None if AUDIT_LOG is turned off. Buffered
+    events are written before the interpreter exits.
+    """
+
+    global _audit_log
+
+    if _audit_log is None and config.AUDIT_LOG:
+        with _audit_log_lock:
+            if _audit_log is None:
+                _audit_log = AuditLog(config.AUDIT_SINK, config.AUDIT_FILE, config.AUDIT_BUFFER_SIZE,
+                                      config.AUDIT_BATCH_SIZE, config.AUDIT_FLUSH_INTERVAL, config.AUDIT_ON_FULL)
+                atexit.register(_audit_log.close)
+    return _audit_log
+
+
+def configure_audit_log(audit_log) -> AuditLog:
+    """
+    Replaces the process-wide audit log. The previous one writes its buffered events
+    and is closed.
+    """
+
+    global _audit_log
+
+    with _audit_log_lock:
+        old_audit_log, _audit_log = _audit_log, audit_log
+
+    if old_audit_log is not None:
+        old_audit_log.close()
+
+    atexit.register(audit_log.close)
+    return audit_log
+
+
+def emit(event, email, source=None, detail=None) -> None:
+    """
+    Records an audit event without waiting for it to be written. Does nothing when the
+    audit log is turned off.
+    """
+
+    audit_log = get_audit_log()
+    if audit_log is not None:
+        audit_log.emit(event, email, source, detail)
+
+
+def query(email=None, since=None, until=None, event=None, batch_size=1000):
+    """
+    Streams events from login_events in time order.
+
+    The filters map onto the table's indexes: by email through (email, occurred_at)
+    and by time range through the clustered (occurred_at, event_id) index. Rows are
+    fetched batch_size at a time, so memory use does not grow with the result.
+
+    Args:
+        email (str | None): Only this account's events.
+        since (int | None): Earliest event time, Unix milliseconds, inclusive.
+        until (int | None): Latest event time, Unix milliseconds, exclusive.
+        event (str | None): Only events with this name.
+
+    Yields:
+        dict: One event, keyed by COLUMNS.
+    """
+
+    conditions, params = [], []
+    for column, operator, value in (("email", "=", email), ("occurred_at", ">=", since),
+                                    ("occurred_at", "<", until), ("event", "=", event)):
+        if value is not None:
+            conditions.append(f"{column} {operator} ?")
+            params.append(value)
+
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    with db.connection() as connection:
+        # A plain cursor, since the statement text varies with the filters
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT {', '.join(COLUMNS)} FROM login_events{where} ORDER BY occurred_at, event_id", params)
+        while rows := cursor.fetchmany(batch_size):
+            for row in rows:
+                yield dict(zip(COLUMNS, row))
+
+
+def query_file(path, email=None, since=None, until=None, event=None):
+    """
+    Streams events from a fallback JSONL file, with the same filters as query(). Events
+    are yielded in file order.
+    """
+
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by a crash mid-write
+
+            if ((email is None or row["email"] == email) and (event is None or row["event"] == event)
+                    and (since is None or row["occurred_at"] >= since) and (until is None or row["occurred_at"] < until)):
+                yield row
+
+
+def _timestamp(text) -> int:
+    # Unix seconds or an ISO 8601 date/time (local time unless it has an offset) -> Unix milliseconds
+    try:
+        return int(float(text) * 1000)
+    except ValueError:
+        return int(datetime.fromisoformat(text).timestamp() * 1000)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Read the login audit log.")
+    parser.add_argument("--email", help="Only this account's events")
+    parser.add_argument("--since", type=_timestamp, help="Earliest time (ISO 8601 or Unix seconds)")
+    parser.add_argument("--until", type=_timestamp, help="Latest time, exclusive (ISO 8601 or Unix seconds)")
+    parser.add_argument("--event", help="Only events with this name, e.g. login_failed")
+    parser.add_argument("--file", help="Read this fallback JSONL file instead of the database")
+    args = parser.parse_args(argv)
+
+    filters = {"email": args.email, "since": args.since, "until": args.until, "event": args.event}
+    events = query_file(args.file, **filters) if args.file else query(**filters)
+
+    try:
+        for row in events:
+            row["time"] = datetime.fromtimestamp(row["occurred_at"] / 1000, timezone.utc).isoformat(timespec="milliseconds")
+            sys.stdout.write(json.dumps(row) + "\n")
+    except BrokenPipeError:
+        pass  # Output piped into head or similar
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,10 +1,17 @@
 from validators import email_valid_check, password_valid_check
-from email_utils import send_email
-import db, state, bcrypt, pyodbc
+import flows, state
+from flows import INLINE, run
 from getpass import getpass
-from random import randint
 from ui import BLUE, RED, YELLOW, BOLD, RESET
 
+# What the log in page prints for each way check_login() turns a login down
+LOGIN_FAILURES = {
+    flows.RATE_LIMITED: "Too many login attempts. Try again later.",
+    flows.UNKNOWN_EMAIL: "E-Mail not found.",
+    flows.LOCKED: "Account is locked after too many failed logins. Try again later.",
+    flows.BAD_PASSWORD: "Incorrect password",
+}
+
 def create_account() -> None:
     '''
     Handles the process of creating a new user account.
@@ -27,26 +34,13 @@ def create_account() -> None:
     # Validate password (non-empty)
     password = password_valid_check(password, "Password for registration: ")
 
-    # Hash the password using bcrypt
-    hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
-
-    # Connect to the database
-    connection = db.get_connection_to_db()
-    cursor = connection.cursor()
-
-    try:
-        # Attempt to insert the new account into the LoginInformation table
-        cursor.execute('INSERT INTO LoginInformation (email, password_hash) VALUES (?,?)', (email, hashed_password))
-        connection.commit()  # Commit the transaction to save changes
+    # Hash the password and insert the new account into the LoginInformation table
+    if run(flows.register(INLINE, email, password)) == flows.OK:
         print("Account sucessfully created!")
 
-    except pyodbc.IntegrityError as acc_exists:
+    else:
         # Handle case where the email already exists in the database
-        print("Account with " + email + " already exists. Account creation failed.")  
-
-    finally:
-        # Always close the database connection
-        db.close_connection(connection)
+        print("Account with " + email + " already exists. Account creation failed.")
 
 
 def log_in() -> str | None:
@@ -68,54 +62,42 @@ def log_in() -> str | None:
     email = input("E-Mail: ")
     password = getpass("Password: ")
 
-    # Connect to the database
-    connection = db.get_connection_to_db()
-    cursor = connection.cursor()
-
-    try:
-        # Fetch hashed password associated with the email
-        cursor.execute("SELECT password_hash FROM LoginInformation WHERE email = ?", (email,))
-        stored_hash = cursor.fetchone()[0]
-
-        # Verify the inputted password matches the hashed password
-        if bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8')):
-
-            cursor.execute('SELECT two_fa FROM LoginInformation WHERE email = ?', (email,))
-            two_fa = cursor.fetchone()[0]
-            
-            # If account has 2fa enabled, verify with user
-            if two_fa == 1:
-
-                # Generate a random number for authentication
-                authentication_number = randint(1, 1000)
-
-                # Send code to email
-                send_email(email, "Your Two Factor Authentication Code", "Two Factor Authentication Code: " + str(authentication_number))
-                print("Two Factor Authentication code sent. Check your E-Mail.")
-
-                # Compare user inputted code to generated authentication number
-                if input("2-FA Code: ") == str(authentication_number):
-                    print("Authentication successful")
-
-                else:
-                    print("Authentication Failed. Returning to start page.")
-                    return
-                
-            state.user = email
-            print("Login successful")
-
-        else:
-            print("Incorrect password")
-            return
-        
-    except TypeError as acc_exists:
-        # Handle case where the email was not found in the database
-        print("E-Mail not found.")
+    # Check the password, against the local credential snapshot while the database is unavailable
+    status, record, from_snapshot = run(flows.check_login(INLINE, email, password))
+
+    if from_snapshot:
+        print("The account database is unavailable, so your login is checked against a local copy. "
+              "Account changes are unavailable until it is back.")
+
+    if status != flows.OK:
+        print(LOGIN_FAILURES[status])
         return
-    
-    finally:
-        # Always close the database connection
-        db.close_connection(connection)
+
+    # Accounts enrolled in an authenticator app are asked for its code; typing "email"
+    # falls back to an emailed code. The snapshot holds no TOTP secrets, so logins
+    # checked against it always use an emailed code.
+    code = None
+    if record.two_fa and record.totp_secret:
+        code = input("Authenticator or backup code (or 'email' to get a code by E-Mail): ").strip()
+
+    email_code = code is not None and code.lower() == "email"
+    status = run(flows.finish_login(INLINE, email, record, from_snapshot,
+                                    code=None if email_code else code, email_code=email_code))
+
+    # Otherwise a code was emailed; compare the one the user types to it
+    if status == flows.TWO_FA_REQUIRED:
+        print("Two Factor Authentication code sent. Check your E-Mail.")
+        status = run(flows.verify_2fa(INLINE, email, input("2-FA Code: ")))
+
+    if status != flows.OK:
+        print("Authentication Failed. Returning to start page.")
+        return
+
+    if record.two_fa:
+        print("Authentication successful")
+
+    state.start_session(email)
+    print("Login successful")
 
     return email
 
@@ -124,9 +106,10 @@ def two_factor_authentication():
     """
     Enable Two-Factor Authentication (2FA) for the current user.
 
-    Prompts the user for confirmation to enable 2FA. If confirmed,
-    checks whether 2FA is already enabled. If not, updates the user's
-    record in the database to enable 2FA.
+    Prompts the user for confirmation to enable 2FA and for the method to use. Email
+    2FA updates the user's record if it is not already enabled. App 2FA shows a new
+    secret to add to an authenticator app, checks a code from the app and shows the
+    account's backup codes once; it also switches an account from emailed codes to the app.
     """
 
     # Display the two-factor authentication page heading
@@ -145,24 +128,41 @@ def two_factor_authentication():
         print("You changed your mind. Returning to logged in page.")
         return  # User cancelled 2FA enable
 
-    # Connect to the database
-    connection = db.get_connection_to_db()
-    cursor = connection.cursor()
+    # Ask whether codes should come from an authenticator app or by email
+    method = input("Use an authenticator app or E-Mail codes? app/email: ").lower()
 
-    # Check if 2FA is already enabled for this user
-    cursor.execute("SELECT two_fa FROM LoginInformation WHERE email = ?", (state.user,))
-    validation = cursor.fetchone()[0]
-    
-    # If already enabled, inform the user and exit
-    if validation == 1:
-        print("Two Factor Authentication is already enabled. Returning to logged in page.")
+    while method != "app" and method != "email":
+        print("Incorrect input. Try again.")
+        method = input("Use an authenticator app or E-Mail codes? app/email: ").lower()
+
+    email = state.current_user()
+
+    if method == "app":
+        _enable_authenticator_app(email)
         return
 
-    # Enable 2FA for the user
+    # Enable 2FA for the user; the update only applies if it is not already enabled
     print("Enabling 2-FA...")
-    cursor.execute('UPDATE LoginInformation SET two_fa = ? WHERE email = ?', (1, state.user))
-    cursor.commit()
+    if run(flows.enable_2fa(INLINE, email)) == flows.ALREADY_ENABLED:
+        print("Two Factor Authentication is already enabled. Returning to logged in page.")
+        return
+
     print("2-FA is officially active.")
 
-    # Close the database connection
-    db.close_connection(connection)
\ No newline at end of file
+
+def _enable_authenticator_app(email) -> None:
+    # Show a new secret, and only store it once the app has produced a valid code from it
+    secret, uri = run(flows.new_totp_secret(INLINE, email))
+    print("Add this account to your authenticator app with the key or link below.")
+    print(f"Key: {secret}")
+    print(f"Link: {uri}")
+
+    status, backup_codes = run(flows.enable_totp(INLINE, email, secret, input("Code shown by the app: ")))
+    if status != flows.OK:
+        print("The code did not match. 2-FA was not changed. Returning to logged in page.")
+        return
+
+    print("2-FA with your authenticator app is officially active.")
+    print("Backup codes (each works once; keep them somewhere safe, they are not shown again):")
+    for code in backup_codes:
+        print(f"    {code}")
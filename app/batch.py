@@ -0,0 +1,319 @@
+"""
+This module runs CLI commands non-interactively from a script or a JSONL stream.
+
+Each command names the same actions as the start page and the logged-in page ("new
+account", "login", "change email", ...) and carries its arguments instead of prompting
+for them. Commands go through a match-based dispatch like the interactive loops, backed
+by service.LoginService. Results are printed as one JSON object per line.
+
+Logged-in commands ("update password", "change email", "2fa", "delete account",
+"logout") apply to an account that was logged in by an earlier "login" command in the
+same batch, just as in the interactive CLI.
+
+The whole batch shares one database connection and one SMTP session by default.
+With --concurrency N, commands for different accounts run N at a time over N
+connections, while the commands for any one account always run in file order.
+
+JSONL input has one object per line with a "command" key and the command's fields:
+
+    {"command": "new account", "email": "a@example.com", "password": "secret"}
+    {"command": "login", "email": "a@example.com", "password": "secret"}
+    {"command": "change email", "email": "a@example.com", "new_email": "b@example.com"}
+
+A "login" for an account using an authenticator app may carry the app's "code" too.
+
+Script input has one command per line followed by its fields in the order listed in
+COMMANDS, quoted like a shell command line; blank lines and "#" comments are skipped:
+
+    new account a@example.com secret
+    login a@example.com secret
+    update password a@example.com "new secret"
+
+Usage:
+    python batch.py commands.jsonl --concurrency 8 > results.jsonl
+    python main.py --batch commands.txt
+"""
+
+import argparse, asyncio, json, shlex, sys, time
+import config, db, mailer, service
+
+# Command -> the fields it takes, in script order
+COMMANDS = {
+    "new account": ("email", "password"),
+    "login": ("email", "password"),
+    "2fa code": ("email", "code"),
+    "forgot password": ("email",),
+    "reset password": ("email", "code", "new_password"),
+    "update password": ("email", "new_password"),
+    "change email": ("email", "new_email"),
+    "2fa": ("email",),
+    "delete account": ("email", "password"),
+    "logout": ("email",),
+}
+
+# Statuses of commands that could not be run at all
+BAD_COMMAND = "bad_command"
+NOT_LOGGED_IN = "not_logged_in"
+UNAVAILABLE = "unavailable"  # The database could not be reached
+ERROR = "error"
+
+
+def parse_jsonl(lines):
+    """
+    Yields (line_number, command, fields) for each JSONL line. Lines that cannot be
+    parsed are yielded with command None and an error message in place of the fields.
+    """
+
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            fields = json.loads(line)
+        except ValueError:
+            yield line_number, None, "Line is not valid JSON"
+            continue
+
+        if not isinstance(fields, dict):
+            yield line_number, None, "Line must be a JSON object"
+            continue
+
+        yield line_number, fields.pop("command", None), fields
+
+
+def parse_script(lines):
+    """
+    Yields (line_number, command, fields) for each script line, matching the longest
+    command name at the start of the line and mapping the remaining words to its fields.
+    """
+
+    # Longest names first so "2fa code" wins over "2fa"
+    names = sorted(COMMANDS, key=len, reverse=True)
+
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        try:
+            words = shlex.split(line)
+        except ValueError as error:
+            yield line_number, None, str(error)
+            continue
+
+        for name in names:
+            size = len(name.split())
+            if [word.lower() for word in words[:size]] == name.split():
+                yield line_number, name, dict(zip(COMMANDS[name], words[size:]))
+                break
+        else:
+            yield line_number, None, f"Unknown command: {line}"
+
+
+class BatchRunner:
+    """
+    Runs parsed commands against a LoginService.
+
+    Args:
+        login_service (service.LoginService): A started service.
+        concurrency (int): Commands in flight at the same time.
+    """
+
+    def __init__(self, login_service, concurrency=1) -> None:
+        self.service = login_service
+        self.concurrency = max(1, concurrency)
+
+        self._sessions = {}  # email -> session token of accounts logged in by this batch
+        self._tails = {}  # email -> the last task queued for that account
+
+    async def run(self, commands, emit) -> dict:
+        """
+        Runs every command and passes each result to emit as it completes.
+
+        Returns:
+            dict: The number of results per status.
+        """
+
+        slots = asyncio.Semaphore(self.concurrency)
+        summary = {}
+        pending = set()
+
+        async def run_one(line_number, command, fields, waits_for) -> None:
+            # Commands for the same account run in file order
+            for task in waits_for:
+                await task
+
+            async with slots:
+                started = time.perf_counter()
+                status = await self.execute(command, fields)
+
+            result = {"line": line_number, "command": command, "status": status,
+                      "ms": round((time.perf_counter() - started) * 1000, 3)}
+            if isinstance(fields, dict):
+                result["email"] = fields.get("email")
+            else:
+                result["error"] = fields
+
+            summary[status] = summary.get(status, 0) + 1
+            emit(result)
+
+        for line_number, command, fields in commands:
+            keys = self._keys(fields)
+            waits_for = [self._tails[key] for key in keys if key in self._tails]
+
+            # Don't read ahead further than the commands that can run
+            while len(pending) >= self.concurrency * 4:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            task = asyncio.create_task(run_one(line_number, command, fields, waits_for))
+            pending.add(task)
+            for key in keys:
+                self._tails[key] = task
+            task.add_done_callback(lambda done, keys=keys: self._forget(done, keys))
+
+        if pending:
+            await asyncio.wait(pending)
+
+        return summary
+
+    async def execute(self, command, fields) -> str:
+        """
+        Runs one command and returns its status.
+        """
+
+        if command is None:
+            return BAD_COMMAND
+
+        names = COMMANDS.get(command)
+        if names is None or any(not isinstance(fields.get(name), str) for name in names):
+            return BAD_COMMAND
+
+        email = fields["email"]
+
+        try:
+            match command:
+
+                case "new account":
+                    return await self.service.register(email, fields["password"])
+
+                case "login":
+                    code = fields.get("code")  # Authenticator code, for accounts enrolled in an app
+                    status = await self.service.login(email, fields["password"], code=code if isinstance(code, str) else None)
+                    if status == service.OK:
+                        self._sessions[email] = await self.service.start_session(email)
+                    return status
+
+                case "2fa code":
+                    status = await self.service.verify_2fa(email, fields["code"])
+                    if status == service.OK:
+                        self._sessions[email] = await self.service.start_session(email)
+                    return status
+
+                case "forgot password":
+                    return await self.service.request_reset(email)
+
+                case "reset password":
+                    return await self.service.reset_password(email, fields["code"], fields["new_password"])
+
+            # The remaining commands belong to the logged-in page
+            if not await self._logged_in(email):
+                return NOT_LOGGED_IN
+
+            match command:
+
+                case "update password":
+                    return await self.service.update_password(email, fields["new_password"])
+
+                case "change email":
+                    status = await self.service.change_email(email, fields["new_email"])
+                    if status == service.OK:
+                        del self._sessions[email]
+                        self._sessions[fields["new_email"]] = await self.service.start_session(fields["new_email"])
+                    return status
+
+                case "2fa":
+                    return await self.service.enable_2fa(email)
+
+                case "delete account":
+                    status = await self.service.delete_account(email, fields["password"])
+                    if status == service.OK:
+                        del self._sessions[email]
+                    return status
+
+                case "logout":
+                    await self.service.end_session(self._sessions.pop(email), email)
+                    return service.OK
+
+        except db.DatabaseUnavailable as error:
+            print(f"line failed: {command}: {error}", file=sys.stderr)
+            return UNAVAILABLE
+
+        except Exception as error:
+            print(f"line failed: {command}: {error!r}", file=sys.stderr)
+            return ERROR
+
+    async def _logged_in(self, email) -> bool:
+        token = self._sessions.get(email)
+        return token is not None and await self.service.session_user(token) == email
+
+    @staticmethod
+    def _keys(fields) -> list:
+        # Accounts a command touches; change email touches both addresses
+        if not isinstance(fields, dict):
+            return []
+        return [value for value in (fields.get("email"), fields.get("new_email")) if isinstance(value, str)]
+
+    def _forget(self, task, keys) -> None:
+        # Drop finished tails so the map only holds accounts with commands in flight
+        for key in keys:
+            if self._tails.get(key) is task:
+                del self._tails[key]
+
+
+async def run_batch(commands, output=sys.stdout, concurrency=1) -> dict:
+    """
+    Runs parsed commands with a LoginService and writes one JSON result per line.
+
+    Returns:
+        dict: The number of results per status.
+    """
+
+    def emit(result) -> None:
+        output.write(json.dumps(result) + "\n")
+
+    async with service.LoginService(db_workers=concurrency) as login_service:
+        return await BatchRunner(login_service, concurrency).run(commands, emit)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Run login simulator commands from a script or JSONL file.")
+    parser.add_argument("path", nargs="?", default="-", help="Command file, or - for standard input")
+    parser.add_argument("--format", choices=("jsonl", "script"), help="Input format (default: from the extension)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Commands for different accounts run at once")
+    args = parser.parse_args(argv)
+
+    file_format = args.format or ("jsonl" if args.path.endswith((".jsonl", ".ndjson")) else "script")
+    source = sys.stdin if args.path == "-" else open(args.path, encoding="utf-8")
+
+    # One pooled connection per concurrent command and a single SMTP session for the whole batch
+    db.configure_pool(db.BACKENDS[config.DB_BACKEND](), min_size=1, max_size=max(1, args.concurrency),
+                      acquire_timeout=config.DB_POOL_ACQUIRE_TIMEOUT)
+    mailer.configure_mailer(mailer.Mailer(mailer.default_session, config.SENDER_EMAIL, workers=1,
+                                          queue_size=config.MAIL_QUEUE_SIZE, batch_size=config.MAIL_BATCH_SIZE,
+                                          max_retries=config.MAIL_MAX_RETRIES))
+
+    try:
+        parse = parse_jsonl if file_format == "jsonl" else parse_script
+        summary = asyncio.run(run_batch(parse(source), sys.stdout, args.concurrency))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+    print(json.dumps({"summary": summary}), file=sys.stderr)
+
+    if summary.get(BAD_COMMAND) or summary.get(ERROR):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
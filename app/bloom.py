@@ -0,0 +1,221 @@
+"""
+This module keeps an in-process membership filter of the emails in LoginInformation.
+
+Most lookups during a credential-stuffing wave are for addresses that were never
+registered. A counting Bloom filter answers "definitely not registered" without a
+database round trip. It can also answer "maybe registered", in which case the database
+is asked as before. Counters rather than bits let deletions and email changes be
+removed from the filter again.
+
+The filter is built on first use with a streaming scan of the table (of every shard
+when sharding is on) and is kept up to date by the users module whenever an account is
+created, renamed or deleted. Writes made by other processes are picked up by a periodic
+rebuild (EMAIL_FILTER_REFRESH).
+Emails are compared case-insensitively, matching SQL Server's default collation.
+"""
+
+import hashlib, math, threading, time
+import config, db, metrics, shards
+
+
+class CountingBloomFilter:
+    """
+    Bloom filter with 8-bit counters so items can be removed again.
+
+    Counters saturate at 255 and are never decremented after that, which can only
+    cause false positives, never false negatives.
+
+    Args:
+        capacity (int): Number of items the filter is sized for.
+        error_rate (float): Target false-positive rate at capacity.
+    """
+
+    def __init__(self, capacity, error_rate=0.01) -> None:
+        capacity = max(1, capacity)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._counters = bytearray(self.size)
+
+    def _positions(self, item) -> list:
+        # Double hashing: k positions from the two halves of one 128-bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item) -> None:
+        counters = self._counters
+        for position in self._positions(item):
+            if counters[position] < 255:
+                counters[position] += 1
+        self.count += 1
+
+    def remove(self, item) -> None:
+        """
+        Removes an item. Only call this for items that were added; removing anything
+        else can introduce false negatives.
+        """
+
+        counters = self._counters
+        for position in self._positions(item):
+            if 0 < counters[position] < 255:
+                counters[position] -= 1
+        self.count -= 1
+
+    def __contains__(self, item) -> bool:
+        counters = self._counters
+        return all(counters[position] for position in self._positions(item))
+
+
+class KnownEmails:
+    """
+    Counting Bloom filter over the registered emails, with background rebuilds.
+
+    While a rebuild scans the table, new emails are also queued and added to the
+    rebuilt filter before it replaces the old one. Removals during a rebuild are not
+    replayed, because the scan may never have seen those emails; they just stay as
+    false positives until the next rebuild.
+
+    Args:
+        capacity (int): Minimum number of emails the filter is sized for.
+        error_rate (float): Target false-positive rate.
+        refresh (float): Seconds between rebuilds; 0 never rebuilds.
+        batch_size (int): Rows fetched per round trip while scanning.
+    """
+
+    def __init__(self, capacity=100_000, error_rate=0.01, refresh=300.0, batch_size=5000) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh = refresh
+        self.batch_size = batch_size
+
+        self._filter = None
+        self._built_at = 0.0
+        self._pool = None  # shards.topology() the filter was built from; a new one means different databases
+        self._pending = None  # Emails added while a rebuild is scanning, else None
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    def might_exist(self, email) -> bool:
+        """
+        Returns False only if email is definitely not registered.
+        """
+
+        if self._filter is None or self._pool is not shards.topology():
+            self.rebuild()
+        elif not self._is_fresh() and not self._rebuild_lock.locked():
+            threading.Thread(target=self.rebuild, name="email-filter-rebuild", daemon=True).start()
+
+        found = email.lower() in self._filter
+        metrics.count("email_filter_lookups_total", result="maybe" if found else "miss")
+        return found
+
+    def add(self, email) -> None:
+        key = email.lower()
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(key)
+            if self._pending is not None:
+                self._pending.append(key)
+
+    def remove(self, email) -> None:
+        with self._lock:
+            if self._filter is not None:
+                self._filter.remove(email.lower())
+
+    def rebuild(self) -> None:
+        """
+        Rebuilds the filter from a streaming scan of LoginInformation and swaps it in.
+        Only one rebuild runs at a time; concurrent callers wait for it to finish.
+        """
+
+        with self._rebuild_lock:
+            if self._filter is not None and self._pool is shards.topology() and self._is_fresh():
+                return  # Another caller rebuilt it while we waited
+
+            with self._lock:
+                self._pending = []
+
+            try:
+                topology = shards.topology()
+                pools = shards.pools()
+
+                count = 0
+                for pool in pools:
+                    with pool.connection() as connection:
+                        count += db.execute(connection, 'SELECT COUNT(*) FROM LoginInformation').fetchall()[0][0]
+                new_filter = CountingBloomFilter(max(self.capacity, 2 * count), self.error_rate)
+
+                for pool in pools:
+                    with pool.connection() as connection:
+                        # A plain cursor, since the scan is not a statement worth keeping prepared
+                        cursor = connection.cursor()
+                        cursor.execute('SELECT email FROM LoginInformation')
+                        while rows := cursor.fetchmany(self.batch_size):
+                            for (email,) in rows:
+                                new_filter.add(email.lower())
+
+                with self._lock:
+                    for key in self._pending:
+                        new_filter.add(key)
+                    self._filter = new_filter
+                    self._built_at = time.monotonic()
+                    self._pool = topology
+
+            finally:
+                with self._lock:
+                    self._pending = None
+
+    def _is_fresh(self) -> bool:
+        return not self.refresh or time.monotonic() - self._built_at <= self.refresh
+
+
+_known_emails = None
+_known_emails_lock = threading.Lock()
+
+
+def get_known_emails() -> KnownEmails | None:
+    """
+    Returns the process-wide email filter, or None if EMAIL_FILTER is turned off.
+    """
+
+    global _known_emails
+
+    if _known_emails is None and config.EMAIL_FILTER:
+        with _known_emails_lock:
+            if _known_emails is None:
+                _known_emails = KnownEmails(config.EMAIL_FILTER_CAPACITY, config.EMAIL_FILTER_ERROR_RATE,
+                                            config.EMAIL_FILTER_REFRESH)
+    return _known_emails
+
+
+def might_exist(email) -> bool:
+    """
+    Returns False only if email is definitely not registered. Always True when the
+    filter is turned off.
+    """
+
+    known_emails = get_known_emails()
+    return known_emails is None or known_emails.might_exist(email)
+
+
+def added(email) -> None:
+    """
+    Records a newly registered email.
+    """
+
+    known_emails = get_known_emails()
+    if known_emails is not None:
+        known_emails.add(email)
+
+
+def removed(email) -> None:
+    """
+    Records that an email is no longer registered.
+    """
+
+    known_emails = get_known_emails()
+    if known_emails is not None:
+        known_emails.remove(email)
+
@@ -0,0 +1,163 @@
+"""
+This module checks passwords against a local list of known breached passwords.
+
+The list is a file of sorted, fixed-width SHA-1 digests. It is memory-mapped and
+binary-searched, so a lookup touches about log2(n) pages, needs no parsing at startup,
+and shares the operating system's page cache between processes instead of holding the
+list in Python objects.
+
+Build the file from a plaintext password list, or from a "SHA1:count" hash list such as
+the Have I Been Pwned download:
+
+    python breached.py passwords.txt breached.bin
+
+The build is an external sort: digests are sorted in runs of bounded size, spilled to
+temporary files and merged, so lists of many gigabytes are built in bounded memory.
+"""
+
+import hashlib, heapq, mmap, sys, tempfile
+
+DIGEST_SIZE = 20  # Bytes in a SHA-1 digest
+SORT_CHUNK = 1_000_000  # Digests sorted in memory at once, about 60 MB of bytes objects
+
+
+def _digest(password) -> bytes:
+    return hashlib.sha1(password.encode("utf-8")).digest()
+
+
+class BreachedPasswords:
+    """
+    Read-only, memory-mapped set of breached password digests.
+
+    Args:
+        path (str): A file written by build_breach_file().
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+
+        with open(path, "rb") as source:
+            # mmap cannot map an empty file
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if source.seek(0, 2) else b""
+
+        self._count = len(self._map) // DIGEST_SIZE
+
+    def __contains__(self, password) -> bool:
+        """
+        Returns True if the password appears in the breach list.
+        """
+
+        target = _digest(password)
+        data = self._map
+        low, high = 0, self._count
+
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * DIGEST_SIZE
+            candidate = data[offset:offset + DIGEST_SIZE]
+
+            if candidate < target:
+                low = middle + 1
+            elif candidate > target:
+                high = middle
+            else:
+                return True
+
+        return False
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+
+def _digests(lines):
+    # The digest of each non-empty line, read as a hex digest if it is one
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+
+        candidate = line.split(":", 1)[0]
+        if len(candidate) == 2 * DIGEST_SIZE and all(char in "0123456789abcdefABCDEF" for char in candidate):
+            yield bytes.fromhex(candidate)
+        else:
+            yield _digest(line)
+
+
+def _read_run(run):
+    # Yields the digests of a spilled run in order
+    run.seek(0)
+    while digest := run.read(DIGEST_SIZE):
+        yield digest
+
+
+def _sorted(digests, chunk_size):
+    """
+    Yields digests in order, duplicates included. Runs of chunk_size digests are sorted
+    in memory and spilled to temporary files, which are then merged, so at most one run
+    is held.
+    """
+
+    runs = []
+    chunk = []
+
+    try:
+        for digest in digests:
+            chunk.append(digest)
+            if len(chunk) >= chunk_size:
+                chunk.sort()
+                run = tempfile.TemporaryFile()
+                run.write(b"".join(chunk))
+                runs.append(run)
+                chunk = []
+
+        chunk.sort()
+        yield from heapq.merge(*(_read_run(run) for run in runs), chunk)
+
+    finally:
+        for run in runs:
+            run.close()
+
+
+def build_breach_file(lines, path, chunk_size=SORT_CHUNK) -> int:
+    """
+    Writes a sorted digest file from an iterable of text lines.
+
+    Each line is either a plaintext password or a 40-character hex SHA-1 digest,
+    optionally followed by ":count" as in the Have I Been Pwned lists.
+
+    Args:
+        lines: Iterable of lines, e.g. an open text file.
+        path (str): The digest file to write.
+        chunk_size (int): Digests sorted in memory at once before spilling to a temporary file.
+
+    Returns:
+        int: The number of distinct digests written.
+    """
+
+    count = 0
+    previous = None
+
+    with open(path, "wb") as target:
+        for digest in _sorted(_digests(lines), chunk_size):
+            # Duplicates come out of the merge next to each other
+            if digest != previous:
+                target.write(digest)
+                count += 1
+                previous = digest
+
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python breached.py <password or hash list> <output file>")
+        sys.exit(1)
+
+    with open(sys.argv[1], encoding="utf-8", errors="replace") as source:
+        count = build_breach_file(source, sys.argv[2])
+
+    print(f"Wrote {count} breached password digests to {sys.argv[2]}.")
@@ -0,0 +1,321 @@
+"""
+This module bulk-imports and exports LoginInformation accounts as CSV or JSONL.
+
+Rows are streamed through generators, so files of any size are processed with memory
+bounded by the batch size. Each batch is inserted with one executemany call (using
+pyodbc's fast_executemany when available) and one commit, or one per shard when
+sharding is on. Plaintext passwords are hashed in parallel on the hashing engine's
+process pool; rows that already carry a password_hash are passed through once it is
+checked to be a bcrypt hash. A row that violates the email primary key, or is otherwise
+rejected, is written to the error report without aborting its batch.
+
+Usage:
+    python bulk.py import accounts.csv --batch-size 5000 --report errors.csv
+    python bulk.py export accounts.jsonl
+"""
+
+import argparse, csv, json, sys
+from itertools import islice
+import bloom, db, hashing, shards
+from validators import validate_many
+
+INSERT_ACCOUNT = 'INSERT INTO LoginInformation (email, password_hash, two_fa) VALUES (?,?,?)'
+SELECT_ACCOUNTS = 'SELECT email, password_hash, two_fa FROM LoginInformation'
+EXPORT_FIELDS = ("email", "password_hash", "two_fa")
+TEXT_FIELDS = ("email", "password", "password_hash")
+
+
+def _format(path, file_format) -> str:
+    # Use the explicit format, or guess it from the file extension
+    if file_format:
+        return file_format
+    return "jsonl" if str(path).endswith((".jsonl", ".json")) else "csv"
+
+
+def read_rows(path, file_format=None, errors=None):
+    """
+    Yields each account in a CSV (with a header row) or JSONL file as a dict.
+
+    Args:
+        path (str): The file to read.
+        file_format (str | None): "csv" or "jsonl"; guessed from the extension if None.
+        errors (list | None): Collects (line_number, "", error) for JSONL lines that are not
+            a JSON object, which are then skipped; without it they raise ValueError.
+
+    Yields:
+        tuple: (line_number, row) for each account.
+    """
+
+    with open(path, newline="", encoding="utf-8") as source:
+        if _format(path, file_format) == "jsonl":
+            for line_number, line in enumerate(source, start=1):
+                if not line.strip():
+                    continue
+
+                try:
+                    row = json.loads(line)
+                    if not isinstance(row, dict):
+                        raise ValueError("not a JSON object")
+                except ValueError as line_error:
+                    # json.JSONDecodeError is a ValueError too
+                    if errors is None:
+                        raise
+                    errors.append((line_number, "", f"malformed line: {line_error}"))
+                    continue
+
+                yield line_number, row
+        else:
+            # Line 1 is the header, so data starts on line 2
+            for line_number, row in enumerate(csv.DictReader(source), start=2):
+                yield line_number, row
+
+
+def write_rows(path, rows, fields, file_format=None) -> int:
+    """
+    Writes dicts to a CSV or JSONL file as they are produced.
+
+    Args:
+        path (str): The file to write.
+        rows: Iterable of dicts keyed by fields.
+        fields (tuple): Column names, in order.
+        file_format (str | None): "csv" or "jsonl"; guessed from the extension if None.
+
+    Returns:
+        int: The number of rows written.
+    """
+
+    count = 0
+
+    with open(path, "w", newline="", encoding="utf-8") as target:
+        if _format(path, file_format) == "jsonl":
+            for row in rows:
+                target.write(json.dumps(row) + "\n")
+                count += 1
+        else:
+            writer = csv.DictWriter(target, fieldnames=fields)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+
+    return count
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _parse_two_fa(value) -> int:
+    return 1 if str(value).strip().lower() in ("1", "true", "yes", "y") else 0
+
+
+def _text_fields(row) -> dict:
+    # A JSONL row can hold any JSON value; a missing or null field reads as ""
+    fields = {}
+    for name in TEXT_FIELDS:
+        value = row.get(name)
+        if value is not None and not isinstance(value, str):
+            raise TypeError(f"{name} is not a string")
+        fields[name] = value or ""
+    return fields
+
+
+def _prepare(batch, engine, errors) -> list:
+    # Validate a batch and hash its plaintext passwords in parallel
+    prepared, to_hash, checked = [], [], []
+
+    for line_number, row in batch:
+        try:
+            checked.append((line_number, row, _text_fields(row)))
+        except TypeError as row_error:
+            email = row.get("email")
+            errors.append((line_number, email.strip() if isinstance(email, str) else "", str(row_error)))
+
+    emails = [fields["email"].strip() for _, _, fields in checked]
+
+    for (line_number, row, fields), email, email_errors in zip(checked, emails, validate_many(emails)):
+        two_fa = _parse_two_fa(row.get("two_fa", 0))
+
+        if email_errors:
+            errors.append((line_number, email, "invalid email"))
+        elif fields["password_hash"]:
+            if not hashing.HASH_PATTERN.fullmatch(fields["password_hash"]):
+                errors.append((line_number, email, "password_hash is not a bcrypt hash"))
+                continue
+            prepared.append((line_number, [email, fields["password_hash"], two_fa]))
+        elif fields["password"]:
+            if len(fields["password"].encode("utf-8")) > hashing.MAX_PASSWORD_BYTES:
+                errors.append((line_number, email, f"password longer than {hashing.MAX_PASSWORD_BYTES} bytes"))
+                continue
+            prepared.append((line_number, [email, None, two_fa]))
+            to_hash.append((len(prepared) - 1, fields["password"]))
+        else:
+            errors.append((line_number, email, "missing password or password_hash"))
+
+    if to_hash:
+        hashes = engine.hash_many([password for _, password in to_hash])
+        for (index, _), password_hash in zip(to_hash, hashes):
+            prepared[index][1][1] = password_hash
+
+        # A password bcrypt refused comes back as its error; report that row and keep the rest
+        failed = {index for index, (_, values) in enumerate(prepared) if isinstance(values[1], Exception)}
+        for index in sorted(failed):
+            line_number, values = prepared[index]
+            errors.append((line_number, values[0], f"could not hash password: {values[1]}"))
+        prepared = [item for index, item in enumerate(prepared) if index not in failed]
+
+    return prepared
+
+
+def _insert_batch(connection, prepared, errors) -> int:
+    # Insert a whole batch in one call; if anything in it is rejected, retry row by row
+    cursor = connection.cursor()
+    if hasattr(cursor, "fast_executemany"):
+        cursor.fast_executemany = True
+
+    try:
+        cursor.executemany(INSERT_ACCOUNT, [tuple(values) for _, values in prepared])
+        connection.commit()
+
+        for _, values in prepared:
+            bloom.added(values[0])
+        return len(prepared)
+
+    except db.integrity_error():
+        connection.rollback()
+
+    imported = 0
+
+    for line_number, values in prepared:
+        try:
+            cursor.execute(INSERT_ACCOUNT, tuple(values))
+            bloom.added(values[0])
+            imported += 1
+
+        except db.integrity_error() as row_error:
+            errors.append((line_number, values[0], f"rejected by database: {row_error}"))
+
+    connection.commit()
+    return imported
+
+
+def import_accounts(path, file_format=None, batch_size=1000, engine=None, report_path=None) -> dict:
+    """
+    Streams accounts from a CSV or JSONL file into LoginInformation.
+
+    Each row needs an email and either a plaintext password or a password_hash, plus an
+    optional two_fa flag.
+
+    Args:
+        path (str): The file to import.
+        file_format (str | None): "csv" or "jsonl"; guessed from the extension if None.
+        batch_size (int): Rows inserted and committed together.
+        engine (hashing.HashEngine | None): Engine hashing plaintext passwords.
+        report_path (str | None): CSV file listing every rejected row.
+
+    Returns:
+        dict: Counts of rows read, imported and failed.
+    """
+
+    engine = engine or hashing.get_engine()
+    errors = []
+    summary = {"read": 0, "imported": 0, "failed": 0}
+
+    report = open(report_path, "w", newline="", encoding="utf-8") if report_path else None
+    report_writer = csv.writer(report) if report else None
+    if report_writer:
+        report_writer.writerow(("line", "email", "error"))
+
+    def flush_errors() -> None:
+        # Flush this batch's errors so the report stays streaming too
+        summary["failed"] += len(errors)
+        if report_writer:
+            report_writer.writerows(sorted(errors))
+        errors.clear()
+
+    try:
+        for batch in _batches(read_rows(path, file_format, errors), batch_size):
+            # At this point errors only holds the malformed lines skipped while reading the batch
+            summary["read"] += len(batch) + len(errors)
+            prepared = _prepare(batch, engine, errors)
+
+            # Each shard gets its share of the batch in one insert
+            by_shard = {}
+            for line_number, values in prepared:
+                pool = shards.home(values[0])
+                by_shard.setdefault(id(pool), (pool, []))[1].append((line_number, values))
+
+            for pool, rows in by_shard.values():
+                with pool.connection() as connection:
+                    summary["imported"] += _insert_batch(connection, rows, errors)
+
+            flush_errors()
+
+        # Malformed lines after the last account
+        summary["read"] += len(errors)
+        flush_errors()
+
+    finally:
+        if report:
+            report.close()
+
+    return summary
+
+
+def iter_accounts(batch_size=1000):
+    """
+    Yields every LoginInformation row as a dict, fetching batch_size rows at a time,
+    one shard after another when sharding is on.
+    """
+
+    for pool in shards.pools():
+        with pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(SELECT_ACCOUNTS)
+
+            while rows := cursor.fetchmany(batch_size):
+                for email, password_hash, two_fa in rows:
+                    if isinstance(password_hash, bytes):
+                        password_hash = password_hash.decode("utf-8")
+                    yield {"email": email, "password_hash": password_hash, "two_fa": int(bool(two_fa))}
+
+
+def export_accounts(path, file_format=None, batch_size=1000) -> int:
+    """
+    Streams every account to a CSV or JSONL file with email, password_hash and two_fa.
+
+    Returns:
+        int: The number of accounts exported.
+    """
+
+    return write_rows(path, iter_accounts(batch_size), EXPORT_FIELDS, file_format)
+
+
+def main(argv=None) -> None:
+    """
+    Command-line entry point for bulk import and export.
+    """
+
+    parser = argparse.ArgumentParser(description="Bulk import or export LoginInformation accounts.")
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("path", help="CSV or JSONL file")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="File format (default: from extension)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Rows per insert batch and commit")
+    parser.add_argument("--workers", type=int, help="Processes hashing plaintext passwords")
+    parser.add_argument("--report", help="CSV file listing rejected rows (import only)")
+    args = parser.parse_args(argv)
+
+    if args.action == "import":
+        engine = hashing.HashEngine(hashing.get_engine().rounds, args.workers) if args.workers else None
+        summary = import_accounts(args.path, args.format, args.batch_size, engine, args.report)
+        print(f"Read {summary['read']} rows: {summary['imported']} imported, {summary['failed']} failed.")
+
+    else:
+        count = export_accounts(args.path, args.format, args.batch_size)
+        print(f"Exported {count} accounts to {args.path}.")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
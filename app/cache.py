@@ -0,0 +1,170 @@
+"""
+This module keeps a read-through cache of UserRecords in front of the users module.
+
+Logged-in actions and repeated logins read the same LoginInformation row again and
+again. The cache keeps recently read records for a short TTL, evicts the least recently
+used record once it holds max_size of them, and counts hits and misses. The write
+helpers in users invalidate the affected emails as soon as their UPDATE or DELETE has
+been committed, so a process never serves a record older than its own last write.
+
+Each fill takes a lease on its key before reading the database, and every invalidation
+revokes the lease. A reader that raced a writer therefore cannot put the row it read
+before the write back into the cache.
+
+Keys are compared case-insensitively for invalidation, so a write under any spelling
+of an email drops every cached spelling of it, while a cached record is only served for
+the exact email it was read for. Writes made by other processes are only seen once the
+TTL has expired, which is why USER_CACHE_TTL is short and the API turns the cache off
+when it runs several workers.
+"""
+
+import threading, time
+from collections import OrderedDict
+import config, metrics, shards
+
+
+class RecordCache:
+    """
+    Bounded LRU cache with a TTL and lease-guarded fills.
+
+    Args:
+        max_size (int): Most records kept; the least recently used one is evicted beyond this.
+        ttl (float): Seconds a record is served before it is read from the database again.
+    """
+
+    def __init__(self, max_size=10000, ttl=30.0) -> None:
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # key -> (email, record, expires_at), oldest first
+        self._leases = {}  # key -> token of the fill currently allowed to store
+        self._pool = None  # shards.topology() the records were read from; a new one means different databases
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "stale_fills": 0}
+
+    def get(self, email, load):
+        """
+        Returns the cached record for email, or calls load(email) and caches its result.
+        None results (unregistered emails) are not cached.
+        """
+
+        key = email.lower()
+        now = time.monotonic()
+        pool = shards.topology()
+
+        with self._lock:
+            if self._pool is not pool:
+                self._entries.clear()
+                self._leases.clear()
+                self._pool = pool
+
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] == email and entry[2] > now:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                metrics.count("user_cache_lookups_total", result="hit")
+                return entry[1]
+
+            self._stats["misses"] += 1
+            token = self._leases[key] = object()
+
+        metrics.count("user_cache_lookups_total", result="miss")
+
+        try:
+            record = load(email)
+
+        except BaseException:
+            with self._lock:
+                if self._leases.get(key) is token:
+                    del self._leases[key]
+            raise
+
+        with self._lock:
+            if self._leases.get(key) is not token:
+                # Invalidated while loading, or a newer fill took over; the row may be stale
+                self._stats["stale_fills"] += 1
+                return record
+
+            del self._leases[key]
+
+            if record is not None:
+                self._entries[key] = (email, record, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self._stats["evictions"] += 1
+
+        return record
+
+    def invalidate(self, *emails) -> None:
+        """
+        Drops the cached records of the given emails and revokes fills in progress.
+        """
+
+        with self._lock:
+            for email in emails:
+                key = email.lower()
+                self._leases.pop(key, None)
+                if self._entries.pop(key, None) is not None:
+                    self._stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._leases.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the cache's counters, size and hit rate.
+        """
+
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> RecordCache | None:
+    """
+    Returns the process-wide record cache, or None if USER_CACHE is turned off.
+    """
+
+    global _cache
+
+    if _cache is None and config.USER_CACHE:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RecordCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+    return _cache
+
+
+def configure_cache(cache) -> RecordCache | None:
+    """
+    Replaces the process-wide record cache, e.g. with one of a different size or TTL.
+    None drops it, so the next get_cache() creates a new one if USER_CACHE is set.
+    """
+
+    global _cache
+
+    with _cache_lock:
+        _cache = cache
+
+    return cache
+
+
+def invalidate(*emails) -> None:
+    """
+    Drops the given emails from the process-wide cache, if there is one.
+    """
+
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(*emails)
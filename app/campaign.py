@@ -0,0 +1,387 @@
+"""
+This module sends one templated message to every account, or to those with or without
+2FA, e.g. to announce an incident or a forced password reset.
+
+Recipients are streamed from LoginInformation in email order, one shard after another,
+over a forward-only cursor that fetches batch_size rows at a time, so memory stays
+bounded however many accounts there are. Each message is rendered from a
+string.Template and handed to a Mailer of the campaign's own: a pool of persistent SMTP
+sessions limited to a number of messages per second, so a campaign never holds up the
+2FA and reset codes on the process-wide mailer, and never floods the SMTP server.
+
+A campaign named NAME keeps its progress in CAMPAIGN_DIR/NAME/:
+
+    deliveries.jsonl    One line per recipient with its outcome, appended as each
+                        message is sent or fails for good
+    checkpoint.json     The shard and last email of the last finished batch, rewritten
+                        after every batch
+    report.json         The delivery report, rewritten when a run ends
+
+Sending the same campaign again resumes after the checkpoint. Recipients of a batch cut
+short by a crash are found in the deliveries after the checkpoint and not sent twice.
+The checkpoint follows each shard's email order, so do not rebalance shards while a
+campaign is unfinished.
+
+A template file holds a "Subject:" line, a blank line and the body. $email, $domain and
+any --var NAME=VALUE are substituted in both, and $$ is a literal dollar sign.
+
+Usage:
+    python campaign.py send reset-2024-05 --template reset.txt --var url=https://example.com/reset
+    python campaign.py send reset-2024-05 --template reset.txt --rate 50 --sessions 8
+    python campaign.py report reset-2024-05
+"""
+
+import argparse, hashlib, json, os, re, signal, smtplib, sys, tempfile, threading, time
+from pathlib import Path
+from string import Template
+import config, db, mailer, shards
+
+SELECT_RECIPIENTS = 'SELECT email FROM LoginInformation WHERE email > ?'
+AUDIENCES = {
+    "all": "",
+    "two_fa": " AND two_fa = 1",
+    "no_two_fa": " AND two_fa = 0",
+}
+NAME_PATTERN = re.compile(r"[A-Za-z0-9._-]+")
+REPORTED_FAILURES = 100  # Failed recipients listed in the report; the rest are in deliveries.jsonl
+
+
+def parse_template(text) -> tuple:
+    """
+    Splits a template file into its subject and body.
+
+    Returns:
+        tuple: (subject, body)
+
+    Raises:
+        ValueError: If the first line is not a "Subject:" line.
+    """
+
+    first_line, _, body = text.partition("\n")
+    if not first_line.lower().startswith("subject:"):
+        raise ValueError('A template starts with a "Subject:" line')
+
+    return first_line.split(":", 1)[1].strip(), body.lstrip("\n")
+
+
+def _sources() -> list:
+    # (label, pool) of every database holding accounts, in a fixed order
+    shard_set = shards.get_shards()
+    return [("main", db.get_pool())] if shard_set is None else sorted(shard_set.pools.items())
+
+
+def _write_json(path, data) -> None:
+    # Written next to the old file and renamed over it, so a crash never leaves half a file
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def _read_json(path):
+    try:
+        return json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+
+
+class Campaign:
+    """
+    One message sent to every matching account, resumable after an interruption.
+
+    Args:
+        name (str): Names the campaign's directory; letters, digits, ".", "_" and "-".
+        subject (str): Subject line template.
+        body (str): Message body template.
+        variables (dict | None): Values for the templates' placeholders besides $email and $domain.
+        audience (str): "all", "two_fa" or "no_two_fa".
+        directory (str | None): Where campaign directories are kept (default: CAMPAIGN_DIR).
+        rate (float | None): Most messages per second (default: CAMPAIGN_RATE); 0 for no limit.
+        sessions (int | None): SMTP sessions sending in parallel (default: CAMPAIGN_SESSIONS).
+        batch_size (int | None): Recipients fetched and sent between checkpoints (default: CAMPAIGN_BATCH_SIZE).
+        session_factory: Callable returning a new SMTPSession (default: the server configured in .env).
+        sender_email (str | None): Address the messages are sent from (default: SENDER_EMAIL).
+    """
+
+    def __init__(self, name, subject, body, variables=None, audience="all", directory=None, rate=None,
+                 sessions=None, batch_size=None, session_factory=None, sender_email=None) -> None:
+        if not NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid campaign name: {name!r}")
+        if audience not in AUDIENCES:
+            raise ValueError(f"Unknown audience {audience!r}; use one of {', '.join(AUDIENCES)}")
+
+        self.name = name
+        self.subject = Template(subject)
+        self.body = Template(body)
+        self.variables = dict(variables or {})
+        self.audience = audience
+        self.path = Path(directory or config.CAMPAIGN_DIR) / name
+        self.rate = config.CAMPAIGN_RATE if rate is None else rate
+        self.sessions = sessions or config.CAMPAIGN_SESSIONS
+        self.batch_size = batch_size or config.CAMPAIGN_BATCH_SIZE
+        self.session_factory = session_factory or mailer.default_session
+        self.sender_email = sender_email or config.SENDER_EMAIL
+
+        # Rendering for a made-up recipient finds unknown placeholders before anything is sent
+        self.render("user@example.com")
+
+        # Identifies what is being sent, so a resume cannot continue with a different message
+        self.fingerprint = hashlib.sha256(json.dumps(
+            [subject, body, self.variables, audience], sort_keys=True).encode("utf-8")).hexdigest()
+
+        self._stop = threading.Event()
+        self._journal = None
+        self._journal_lock = threading.Lock()
+
+    def render(self, email) -> tuple:
+        """
+        Returns the (subject, body) of the message to one recipient.
+
+        Raises:
+            ValueError: If a template has a placeholder with no value, or a stray "$".
+        """
+
+        values = {**self.variables, "email": email, "domain": email.rpartition("@")[2]}
+
+        try:
+            return self.subject.substitute(values), self.body.substitute(values)
+        except KeyError as missing:
+            raise ValueError(f"No value for template placeholder ${missing.args[0]}") from None
+
+    def stop(self) -> None:
+        """
+        Asks a running campaign to stop once the current batch is sent and checkpointed.
+        """
+
+        self._stop.set()
+
+    def reset(self) -> None:
+        """
+        Deletes the campaign's progress, so the next run starts from the first recipient.
+        """
+
+        for file_name in ("checkpoint.json", "deliveries.jsonl", "report.json"):
+            (self.path / file_name).unlink(missing_ok=True)
+
+    def run(self) -> dict:
+        """
+        Sends the campaign, or what is left of it, and returns the delivery report.
+
+        Raises:
+            ValueError: If the campaign's progress was recorded for a different message or audience.
+            db.DatabaseUnavailable: If the recipients could not be read; progress up to the last
+                checkpoint is kept.
+        """
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        checkpoint = self._load_checkpoint()
+        if checkpoint["status"] == "completed":
+            return report(self.name, self.path.parent)
+
+        finished = self._finished_since(checkpoint)
+        checkpoint["status"] = "running"
+        started = time.monotonic()
+
+        campaign_mailer = mailer.Mailer(self.session_factory, self.sender_email, workers=self.sessions,
+                                        queue_size=self.batch_size, max_retries=config.MAIL_MAX_RETRIES,
+                                        rate=self.rate)
+        self._journal = open(self.path / "deliveries.jsonl", "a", encoding="utf-8")
+        self._stop.clear()
+
+        try:
+            for label, pool in _sources():
+                if label in checkpoint["done"]:
+                    continue
+
+                after = checkpoint["after"] if checkpoint["shard"] == label else ""
+                with pool.connection() as connection:
+                    cursor = connection.cursor()
+                    cursor.execute(SELECT_RECIPIENTS + AUDIENCES[self.audience] + ' ORDER BY email', (after,))
+
+                    while not self._stop.is_set() and (rows := cursor.fetchmany(self.batch_size)):
+                        for row in rows:
+                            if row[0] not in finished:
+                                subject, body = self.render(row[0])
+                                campaign_mailer.submit(row[0], subject, body, on_done=self._record)
+
+                        # Every message of the batch is sent or failed before the checkpoint moves past it
+                        campaign_mailer.flush()
+                        self._save_checkpoint(checkpoint, shard=label, after=rows[-1][0])
+
+                if self._stop.is_set():
+                    break
+                self._save_checkpoint(checkpoint, shard=None, after="", done=checkpoint["done"] + [label])
+
+            else:
+                checkpoint["status"] = "completed"
+
+        finally:
+            campaign_mailer.close()
+            with self._journal_lock:
+                self._journal.close()
+                self._journal = None
+
+            if checkpoint["status"] != "completed":
+                checkpoint["status"] = "interrupted"
+            checkpoint["seconds"] = round(checkpoint["seconds"] + time.monotonic() - started, 3)
+            self._save_checkpoint(checkpoint)
+
+        summary = report(self.name, self.path.parent)
+        _write_json(self.path / "report.json", summary)
+        return summary
+
+    def _record(self, email, error) -> None:
+        # Called by the mailer's workers as each message is sent or fails for good
+        if error is None:
+            status = "sent"
+        elif isinstance(error, smtplib.SMTPRecipientsRefused):
+            status = "refused"
+        else:
+            status = "failed"
+
+        entry = {"email": email, "status": status, "at": int(time.time())}
+        if error is not None:
+            entry["error"] = str(error)
+
+        with self._journal_lock:
+            self._journal.write(json.dumps(entry) + "\n")
+
+    def _load_checkpoint(self) -> dict:
+        checkpoint = _read_json(self.path / "checkpoint.json")
+
+        if checkpoint is None:
+            return {"name": self.name, "fingerprint": self.fingerprint, "audience": self.audience,
+                    "status": "new", "started_at": int(time.time()), "seconds": 0.0,
+                    "shard": None, "after": "", "done": [], "journal_offset": 0}
+
+        if checkpoint["fingerprint"] != self.fingerprint:
+            raise ValueError(f"Campaign {self.name} was started with a different message or audience; "
+                             f"finish it with the same template, or reset it to start over")
+        return checkpoint
+
+    def _finished_since(self, checkpoint) -> set:
+        # Recipients whose outcome was written after the last checkpoint, by a run that then stopped
+        finished = set()
+
+        try:
+            with open(self.path / "deliveries.jsonl", "r+b") as journal:
+                journal.seek(checkpoint["journal_offset"])
+                for line in journal:
+                    if line.endswith(b"\n"):
+                        finished.add(json.loads(line)["email"])
+                    else:
+                        # A line cut off by a crash; drop it, so the file stays one entry per line
+                        journal.truncate(journal.tell() - len(line))
+        except FileNotFoundError:
+            pass
+
+        return finished
+
+    def _save_checkpoint(self, checkpoint, **changes) -> None:
+        # The deliveries are on disk before a checkpoint that counts on them
+        if self._journal is not None:
+            with self._journal_lock:
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                changes["journal_offset"] = self._journal.tell()
+
+        checkpoint.update(changes, updated_at=int(time.time()))
+        _write_json(self.path / "checkpoint.json", checkpoint)
+
+
+def report(name, directory=None) -> dict:
+    """
+    Builds a campaign's delivery report from its checkpoint and deliveries.
+
+    Args:
+        name (str): The campaign name.
+        directory (str | None): Where campaign directories are kept (default: CAMPAIGN_DIR).
+
+    Returns:
+        dict: The campaign's status, counts of recipients by outcome, sending rate and the
+            first REPORTED_FAILURES failed recipients with their errors.
+
+    Raises:
+        ValueError: If there is no such campaign.
+    """
+
+    path = Path(directory or config.CAMPAIGN_DIR) / name
+    checkpoint = _read_json(path / "checkpoint.json")
+    if checkpoint is None:
+        raise ValueError(f"No campaign named {name} in {path.parent}")
+
+    counts = {"sent": 0, "refused": 0, "failed": 0}
+    failures = []
+
+    # Streamed, so the report costs no memory however many recipients there were
+    try:
+        with open(path / "deliveries.jsonl", encoding="utf-8") as journal:
+            for line in journal:
+                entry = json.loads(line)
+                counts[entry["status"]] += 1
+                if entry["status"] != "sent" and len(failures) < REPORTED_FAILURES:
+                    failures.append({"email": entry["email"], "status": entry["status"], "error": entry.get("error")})
+    except FileNotFoundError:
+        pass
+
+    recipients = sum(counts.values())
+    seconds = checkpoint["seconds"]
+
+    return {"name": name, "status": checkpoint["status"], "audience": checkpoint["audience"],
+            "started_at": checkpoint["started_at"], "updated_at": checkpoint.get("updated_at"),
+            "recipients": recipients, **counts, "seconds": seconds,
+            "messages_per_second": round(recipients / seconds, 1) if seconds else 0.0,
+            "failures": failures, "deliveries": str(path / "deliveries.jsonl")}
+
+
+def main(argv=None) -> None:
+    """
+    Command-line entry point: send (or resume) a campaign, or print its report.
+    """
+
+    parser = argparse.ArgumentParser(description="Send a templated message to every account.")
+    parser.add_argument("action", choices=("send", "report"))
+    parser.add_argument("name", help="Campaign name; sending the same name again resumes it")
+    parser.add_argument("--template", help='File with a "Subject:" line, a blank line and the body (send only)')
+    parser.add_argument("--var", action="append", default=[], metavar="NAME=VALUE",
+                        help="Value for a $NAME placeholder; may be repeated")
+    parser.add_argument("--audience", choices=tuple(AUDIENCES), default="all", help="Accounts to send to")
+    parser.add_argument("--rate", type=float, help="Most messages per second (default: CAMPAIGN_RATE)")
+    parser.add_argument("--sessions", type=int, help="Parallel SMTP sessions (default: CAMPAIGN_SESSIONS)")
+    parser.add_argument("--batch-size", type=int, help="Recipients between checkpoints (default: CAMPAIGN_BATCH_SIZE)")
+    parser.add_argument("--directory", help="Where campaign progress is kept (default: CAMPAIGN_DIR)")
+    parser.add_argument("--restart", action="store_true", help="Discard the campaign's progress and start over")
+    args = parser.parse_args(argv)
+
+    if args.action == "report":
+        print(json.dumps(report(args.name, args.directory), indent=2))
+        return
+
+    if not args.template:
+        parser.error("send needs --template")
+
+    try:
+        subject, body = parse_template(Path(args.template).read_text(encoding="utf-8"))
+        variables = dict(variable.split("=", 1) for variable in args.var)
+        campaign = Campaign(args.name, subject, body, variables, args.audience, args.directory,
+                            args.rate, args.sessions, args.batch_size)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.restart:
+        campaign.reset()
+
+    def interrupt(signum, frame) -> None:
+        print("Stopping after the current batch; send again to resume.", file=sys.stderr, flush=True)
+        campaign.stop()
+
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+
+    print(json.dumps(campaign.run(), indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,284 @@
+"""
+This module stores the one-time verification codes sent for 2FA logins and password resets.
+
+Codes are keyed by (email, purpose), stored only as keyed hashes, expire after a TTL and
+allow a limited number of wrong guesses. Because the code lives in the store rather than
+on the call stack, the step that sends a code and the step that checks it can run in
+different requests, or, with SqliteCodeStore, in different worker processes.
+"""
+
+import heapq, hmac, hashlib, secrets, sqlite3, threading, time
+import config
+
+
+def generate_code(digits) -> str:
+    """
+    Returns a random numeric code with the given number of digits.
+    """
+
+    return str(secrets.randbelow(10 ** digits)).zfill(digits)
+
+
+def _digest(key, email, purpose, code) -> bytes:
+    # Keyed hash so a leaked store does not reveal codes by brute-forcing a plain hash
+    return hmac.new(key, f"{email}\0{purpose}\0{code}".encode("utf-8"), hashlib.sha256).digest()
+
+
+class MemoryCodeStore:
+    """
+    In-process code store with O(1) lookup and heap-based expiry.
+
+    Each entry is a dict lookup away. Expiry times sit in a min-heap, so expired codes
+    are evicted by popping the heap front on each call instead of scanning every entry.
+    When max_entries is reached the code closest to expiry is evicted to make room.
+
+    Args:
+        ttl (float): Seconds a code stays valid.
+        max_attempts (int): Wrong guesses allowed before a code is discarded.
+        max_entries (int): Most codes held at once.
+        digits (int): Length of generated codes.
+        key (bytes | None): HMAC key for stored codes; random per process by default.
+    """
+
+    def __init__(self, ttl=600.0, max_attempts=5, max_entries=100_000, digits=6, key=None) -> None:
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.max_entries = max_entries
+        self.digits = digits
+        self.key = key or secrets.token_bytes(32)
+
+        self._entries = {}  # (email, purpose) -> [digest, expires_at, attempts]
+        self._expiry = []   # Heap of (expires_at, email, purpose)
+        self._lock = threading.Lock()
+
+    def issue(self, email, purpose) -> str:
+        """
+        Creates a new code for (email, purpose), replacing any outstanding one.
+
+        Returns:
+            str: The plaintext code to send to the user.
+        """
+
+        code = generate_code(self.digits)
+        expires_at = time.monotonic() + self.ttl
+
+        with self._lock:
+            self._evict_expired()
+
+            key = (email, purpose)
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                self._evict_soonest()
+
+            self._entries[key] = [_digest(self.key, email, purpose, code), expires_at, 0]
+            heapq.heappush(self._expiry, (expires_at, email, purpose))
+
+            # Replaced codes leave stale heap items behind; rebuild before they pile up
+            if len(self._expiry) > 2 * len(self._entries) + 64:
+                self._expiry = [(entry[1], email, purpose) for (email, purpose), entry in self._entries.items()]
+                heapq.heapify(self._expiry)
+
+        return code
+
+    def verify(self, email, purpose, code) -> bool:
+        """
+        Checks a code. A correct code is consumed; a wrong one uses up an attempt.
+
+        Returns:
+            bool: True if the code matches an unexpired code for (email, purpose).
+        """
+
+        digest = _digest(self.key, email, purpose, str(code))
+
+        with self._lock:
+            self._evict_expired()
+
+            entry = self._entries.get((email, purpose))
+            if entry is None:
+                return False
+
+            if hmac.compare_digest(entry[0], digest):
+                del self._entries[(email, purpose)]
+                return True
+
+            entry[2] += 1
+            if entry[2] >= self.max_attempts:
+                del self._entries[(email, purpose)]
+
+            return False
+
+    def discard(self, email, purpose=None) -> None:
+        """
+        Removes the outstanding code for (email, purpose), or every code for email if
+        purpose is None.
+        """
+
+        with self._lock:
+            if purpose is not None:
+                self._entries.pop((email, purpose), None)
+            else:
+                for key in [key for key in self._entries if key[0] == email]:
+                    del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict_expired(self) -> None:
+        # Must be called with the lock held
+        now = time.monotonic()
+
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, email, purpose = heapq.heappop(self._expiry)
+            entry = self._entries.get((email, purpose))
+
+            # Skip heap items left behind by codes that were replaced or already used
+            if entry is not None and entry[1] == expires_at:
+                del self._entries[(email, purpose)]
+
+    def _evict_soonest(self) -> None:
+        # Must be called with the lock held
+        while self._expiry:
+            expires_at, email, purpose = heapq.heappop(self._expiry)
+            entry = self._entries.get((email, purpose))
+
+            if entry is not None and entry[1] == expires_at:
+                del self._entries[(email, purpose)]
+                return
+
+
+class SqliteCodeStore:
+    """
+    Code store in a shared sqlite file, so every worker process on a host can verify
+    codes issued by the others.
+
+    Lookups use the (email, purpose) primary key and expired rows are removed with an
+    indexed range delete, so neither needs a full scan. The HMAC key is kept in the file
+    so every process hashes codes the same way.
+
+    Args:
+        path (str): Path of the sqlite file shared by the workers.
+        ttl (float): Seconds a code stays valid.
+        max_attempts (int): Wrong guesses allowed before a code is discarded.
+        digits (int): Length of generated codes.
+    """
+
+    def __init__(self, path, ttl=600.0, max_attempts=5, digits=6) -> None:
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.digits = digits
+
+        self._local = threading.local()
+        self._path = path
+
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS verification_codes ('
+                               'email TEXT NOT NULL, purpose TEXT NOT NULL, code_hash BLOB NOT NULL, '
+                               'expires_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                               'PRIMARY KEY (email, purpose))')
+            connection.execute('CREATE INDEX IF NOT EXISTS verification_codes_expiry ON verification_codes (expires_at)')
+            connection.execute('CREATE TABLE IF NOT EXISTS code_store_key (id INTEGER PRIMARY KEY CHECK (id = 1), key BLOB NOT NULL)')
+            connection.execute('INSERT OR IGNORE INTO code_store_key (id, key) VALUES (1, ?)', (secrets.token_bytes(32),))
+
+        self.key = connection.execute('SELECT key FROM code_store_key WHERE id = 1').fetchone()[0]
+
+    def issue(self, email, purpose) -> str:
+        """
+        Creates a new code for (email, purpose), replacing any outstanding one.
+
+        Returns:
+            str: The plaintext code to send to the user.
+        """
+
+        code = generate_code(self.digits)
+        connection = self._connection()
+
+        with connection:
+            self._evict_expired(connection)
+            connection.execute('INSERT OR REPLACE INTO verification_codes (email, purpose, code_hash, expires_at, attempts) '
+                               'VALUES (?, ?, ?, ?, 0)',
+                               (email, purpose, _digest(self.key, email, purpose, code), time.time() + self.ttl))
+
+        return code
+
+    def verify(self, email, purpose, code) -> bool:
+        """
+        Checks a code. A correct code is consumed; a wrong one uses up an attempt.
+
+        Returns:
+            bool: True if the code matches an unexpired code for (email, purpose).
+        """
+
+        connection = self._connection()
+
+        with connection:
+            # BEGIN IMMEDIATE so two workers cannot both redeem the same code
+            connection.execute('BEGIN IMMEDIATE')
+            self._evict_expired(connection)
+
+            row = connection.execute('SELECT code_hash, attempts FROM verification_codes WHERE email = ? AND purpose = ?',
+                                     (email, purpose)).fetchone()
+            if row is None:
+                return False
+
+            if hmac.compare_digest(row[0], _digest(self.key, email, purpose, str(code))):
+                connection.execute('DELETE FROM verification_codes WHERE email = ? AND purpose = ?', (email, purpose))
+                return True
+
+            if row[1] + 1 >= self.max_attempts:
+                connection.execute('DELETE FROM verification_codes WHERE email = ? AND purpose = ?', (email, purpose))
+            else:
+                connection.execute('UPDATE verification_codes SET attempts = attempts + 1 WHERE email = ? AND purpose = ?',
+                                   (email, purpose))
+
+            return False
+
+    def discard(self, email, purpose=None) -> None:
+        """
+        Removes the outstanding code for (email, purpose), or every code for email if
+        purpose is None.
+        """
+
+        connection = self._connection()
+
+        with connection:
+            if purpose is not None:
+                connection.execute('DELETE FROM verification_codes WHERE email = ? AND purpose = ?', (email, purpose))
+            else:
+                connection.execute('DELETE FROM verification_codes WHERE email = ?', (email,))
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite handles locking between processes
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+
+        return connection
+
+    @staticmethod
+    def _evict_expired(connection) -> None:
+        connection.execute('DELETE FROM verification_codes WHERE expires_at <= ?', (time.time(),))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the process-wide code store selected by CODE_STORE ("memory" or "sqlite").
+    """
+
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if config.CODE_STORE == "sqlite":
+                    _store = SqliteCodeStore(config.CODE_STORE_PATH, config.CODE_TTL, config.CODE_MAX_ATTEMPTS,
+                                             config.CODE_DIGITS)
+                else:
+                    _store = MemoryCodeStore(config.CODE_TTL, config.CODE_MAX_ATTEMPTS, config.CODE_MAX_ENTRIES,
+                                             config.CODE_DIGITS)
+    return _store
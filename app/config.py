@@ -1,15 +1,96 @@
-from dotenv import load_dotenv
-import os
-from pathlib import Path
+"""
+This module gives access to the application's settings, which are defined in settings.py.
 
-# Load environment variables from .env file
-env_path = Path(__file__).parent.parent / '.env'
-load_dotenv(dotenv_path=env_path)
+Importing config is free: python-dotenv is imported, the .env file is read and the
+settings are evaluated the first time any setting is accessed, and the values are then
+cached on this module, so later reads are ordinary attribute lookups. Commands that
+never read a setting, such as "help" and "quit", never pay for loading them.
 
-# E-Mail variables
-SENDER_EMAIL = os.getenv("SENDER_EMAIL")
-SENDER_PASSWORD = os.getenv("SENDER_PASSWORD")
+reload() reads the .env file and the settings again, for long-running processes such
+as the API supervisor that pick up changed settings on SIGHUP.
+"""
 
-# Database variables
-DB_SERVER = os.getenv("DB_SERVER")
-DB_DATABASE = os.getenv("DB_DATABASE")
\ No newline at end of file
+import os, threading
+
+# Path of the .env file read on first access; ENV_FILE points at another one
+env_path = os.getenv("ENV_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '.env')
+
+_loaded = False
+_load_lock = threading.Lock()
+
+# Variables set in the real environment before the .env file was read; the .env file never overrides them
+_environment = set()
+
+# Variables the .env file set on the last (re)load
+_from_env_file = set()
+
+
+def load() -> None:
+    """
+    Loads environment variables from the .env file and caches every setting on this
+    module. Only the first call does any work.
+    """
+
+    global _loaded
+
+    with _load_lock:
+        if _loaded:
+            return
+
+        _read_env_file()
+
+        import settings
+        for name, value in vars(settings).items():
+            # Keep values already set on this module, e.g. overrides made by the HTTP API
+            if name.isupper() and name not in globals():
+                globals()[name] = value
+
+        _loaded = True
+
+
+def reload() -> None:
+    """
+    Reads the .env file and evaluates the settings again, replacing every cached value,
+    including overrides made on this module since the last load. Variables from the
+    real environment still take precedence over the .env file, and a variable removed
+    from the file falls back to its default.
+    """
+
+    global _loaded
+
+    with _load_lock:
+        for name in _from_env_file:
+            os.environ.pop(name, None)
+        _from_env_file.clear()
+        _read_env_file()
+
+        import importlib, settings
+        settings = importlib.reload(settings)
+        for name, value in vars(settings).items():
+            if name.isupper():
+                globals()[name] = value
+
+        _loaded = True
+
+
+def _read_env_file() -> None:
+    # Sets the .env file's variables that the real environment does not already set
+    from dotenv import dotenv_values
+
+    if not _loaded:
+        _environment.update(os.environ)
+
+    for name, value in dotenv_values(env_path).items():
+        if name not in _environment and value is not None:
+            os.environ[name] = value
+            _from_env_file.add(name)
+
+
+def __getattr__(name):
+    # Only called for names not cached on the module yet, i.e. before load() or for typos
+    if not name.startswith("__") and not _loaded:
+        load()
+        if name in globals():
+            return globals()[name]
+
+    raise AttributeError(f"module 'config' has no attribute '{name}'")
@@ -1,36 +1,725 @@
-import config
-import pyodbc
+import config, metrics
+import functools, random, sqlite3, threading, time
+from contextlib import contextmanager
 
-def get_connection_to_db() -> pyodbc.Connection:
+# Per-thread query counters installed by count_queries()
+_query_counters = threading.local()
+
+# id(connection) -> the pool it was borrowed from, for as long as it is borrowed; lets
+# execute() use the right pool's prepared statements and breaker when there are several
+_owners = {}
+
+
+class DatabaseUnavailable(Exception):
+    """
+    Raised when the database cannot be reached or did not answer in time. Flows catch
+    it to tell the user to try again later instead of hanging or crashing.
+    """
+
+
+class CircuitOpen(DatabaseUnavailable):
+    """
+    Raised without contacting the database while the circuit breaker is open.
+    """
+
+
+class PoolTimeout(DatabaseUnavailable):
+    """
+    Raised when no pooled connection becomes available within the acquire timeout.
+    """
+
+
+class CircuitBreaker:
+    """
+    Fails fast while the database is unhealthy.
+
+    After failure_threshold consecutive connection or query failures the breaker opens,
+    and every acquire raises CircuitOpen at once instead of waiting on timeouts. Once
+    reset_timeout seconds have passed, one caller at a time is let through as a probe:
+    its success closes the breaker again, and its failure keeps it open for another
+    reset_timeout.
+
+    Args:
+        failure_threshold (int): Consecutive failures that open the breaker.
+        reset_timeout (float): Seconds the breaker stays open before probing.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0) -> None:
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Returns True if a caller may use the database now.
+        """
+
+        if self.state == self.CLOSED:
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+
+            if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_started = now
+                return True
+
+            # Let another probe through if the last one never reported back
+            if self.state == self.HALF_OPEN and now - self._probe_started >= self.reset_timeout:
+                self._probe_started = now
+                return True
+
+            return self.state == self.CLOSED
+
+    def record_success(self) -> None:
+        # Lock-free fast path for the common healthy case
+        if self.state == self.CLOSED and not self._failures:
+            return
+
+        with self._lock:
+            if self.state != self.CLOSED:
+                metrics.count("db_circuit_transitions_total", state=self.CLOSED)
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                metrics.count("db_circuit_transitions_total", state=self.OPEN)
+
+
+class PyodbcBackend:
+    """
+    Backend that opens connections to SQL Server using ODBC and Windows Authentication.
+    """
+
+    name = "pyodbc"
+    dialect = "sqlserver"
+
+    def __init__(self, server, database, connect_timeout=5, query_timeout=10) -> None:
+        self.conn_str = (
+            'DRIVER={ODBC Driver 17 for SQL Server};'
+            f'SERVER={server};'
+            f'DATABASE={database};'
+            'Trusted_Connection=yes;'  # Enables Windows Authentication
+        )
+        self.connect_timeout = connect_timeout
+        self.query_timeout = query_timeout
+
+    @property
+    def IntegrityError(self) -> type[Exception]:
+        import pyodbc
+        return pyodbc.IntegrityError
+
+    @property
+    def TransientErrors(self) -> tuple:
+        # Connection failures, dropped links and timeouts (HYT00/HYT01) are OperationalErrors
+        import pyodbc
+        return (pyodbc.OperationalError, pyodbc.InterfaceError)
+
+    def connect(self):
+        """
+        Opens a new connection to the configured SQL Server database. Logging in gives up
+        after connect_timeout seconds, and every statement after query_timeout seconds.
+
+        Raises:
+            pyodbc.Error: If the connection fails.
+        """
+
+        import pyodbc
+        connection = pyodbc.connect(self.conn_str, timeout=self.connect_timeout)
+        connection.timeout = self.query_timeout
+        return connection
+
+
+class SqliteBackend:
+    """
+    Backend that stands in for SQL Server with a local sqlite3 database.
+
+    Used to test and benchmark the pool and the account flows without a SQL Server
+    instance. The path may be a file name or a sqlite URI such as "file:bench.db?mode=rwc".
+    query_timeout bounds how long a statement waits for another connection's lock.
+    """
+
+    name = "sqlite"
+    dialect = "sqlite"
+    IntegrityError = sqlite3.IntegrityError
+    TransientErrors = (sqlite3.OperationalError,)  # Locked or unreachable database files
+
+    def __init__(self, path, query_timeout=10) -> None:
+        self.path = path
+        self.query_timeout = query_timeout
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens a new sqlite3 connection. The tables are created by the migrations.
+        """
+
+        # Pooled connections are handed between threads, so disable sqlite's same-thread check
+        return sqlite3.connect(self.path, uri=True, check_same_thread=False, timeout=self.query_timeout)
+
+
+class FaultInjector:
+    """
+    Wraps another backend and injects the failures a real database server produces, so
+    the retry, timeout and circuit breaker paths can be exercised against sqlite.
+
+    Attributes can be changed while the pool is in use:
+        down (bool): Every connect and statement fails.
+        connect_failure_rate (float): Fraction of connects that fail.
+        query_failure_rate (float): Fraction of statements that fail.
+        query_delay (float): Seconds every statement takes. Statements that would take
+            longer than the backend's query_timeout fail after query_timeout, as a
+            driver's query timeout would.
+
+    Args:
+        backend: The backend real connections are opened with.
+    """
+
+    def __init__(self, backend, seed=None) -> None:
+        self.backend = backend
+        self.name = backend.name
+        self.dialect = backend.dialect
+        self.IntegrityError = backend.IntegrityError
+        self.TransientErrors = backend.TransientErrors
+
+        self.down = False
+        self.connect_failure_rate = 0.0
+        self.query_failure_rate = 0.0
+        self.query_delay = 0.0
+        self._random = random.Random(seed)
+
+    def _error(self, message) -> Exception:
+        return self.TransientErrors[0](f"Injected fault: {message}")
+
+    def connect(self):
+        if self.down or self._random.random() < self.connect_failure_rate:
+            raise self._error("connection refused")
+        return _FaultyConnection(self.backend.connect(), self)
+
+    def before_statement(self) -> None:
+        # Called by the wrapped cursors before each statement runs
+        if self.down or self._random.random() < self.query_failure_rate:
+            raise self._error("connection lost")
+
+        if self.query_delay:
+            timeout = getattr(self.backend, "query_timeout", None)
+            if timeout is not None and self.query_delay > timeout:
+                time.sleep(timeout)
+                raise self._error("query timeout expired")
+            time.sleep(self.query_delay)
+
+
+class _FaultyConnection:
+    # Passes everything through to the real connection, but hands out faulty cursors
+
+    def __init__(self, connection, injector) -> None:
+        self._connection = connection
+        self._injector = injector
+
+    def cursor(self):
+        return _FaultyCursor(self._connection.cursor(), self._injector)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _FaultyCursor:
+
+    def __init__(self, cursor, injector) -> None:
+        self._cursor = cursor
+        self._injector = injector
+
+    def execute(self, sql, params=()):
+        self._injector.before_statement()
+        self._cursor.execute(sql, params)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+BACKENDS = {
+    "pyodbc": lambda: PyodbcBackend(config.DB_SERVER, config.DB_DATABASE, config.DB_CONNECT_TIMEOUT, config.DB_QUERY_TIMEOUT),
+    "sqlite": lambda: SqliteBackend(config.DB_SQLITE_PATH, config.DB_QUERY_TIMEOUT),
+}
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of reusable database connections.
+
+    Connections are handed out most-recently-used first so that the idle ones at the
+    bottom of the stack age out. A connection that has been idle for longer than
+    health_check_after seconds is probed with "SELECT 1" before it is handed out, and
+    idle connections above min_size are closed once they exceed idle_timeout.
+
+    Connection failures count against the pool's circuit breaker. While it is open,
+    acquire() raises CircuitOpen at once instead of trying the database.
+
+    Args:
+        backend: Object with a connect() method and IntegrityError, TransientErrors and dialect attributes.
+        min_size (int): Number of connections kept open even when idle.
+        max_size (int): Maximum number of connections open at the same time.
+        idle_timeout (float): Seconds an idle connection above min_size is kept.
+        acquire_timeout (float): Seconds to wait for a free connection before raising PoolTimeout.
+        health_check_after (float): Idle seconds after which a connection is probed before reuse.
+        breaker (CircuitBreaker | None): The pool's breaker; a default one if None.
+    """
+
+    def __init__(self, backend, min_size=1, max_size=10, idle_timeout=300.0,
+                 acquire_timeout=30.0, health_check_after=5.0, breaker=None) -> None:
+
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1")
+
+        self.backend = backend
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+        self.breaker = breaker or CircuitBreaker()
+
+        self._idle = []  # Stack of (connection, last_used) tuples
+        self._statements = {}  # id(connection) -> {sql: cursor} for prepared-statement reuse
+        self._size = 0   # Open connections, idle or in use
+        self._closed = False
+        self._condition = threading.Condition()
+
+        # Counters reported by stats()
+        self._created = 0
+        self._reused = 0
+        self._discarded = 0
+
+    def acquire(self):
+        """
+        Hands out a healthy connection, opening a new one if the pool is below max_size.
+
+        Raises:
+            CircuitOpen: If the circuit breaker is open.
+            DatabaseUnavailable: If a new connection could not be opened.
+            PoolTimeout: If no connection becomes free within acquire_timeout.
+        """
+
+        if not self.breaker.allow():
+            metrics.count("db_unavailable_total", reason="circuit_open")
+            raise CircuitOpen("The database is unavailable; not trying again yet")
+
+        with metrics.span("db_connection_acquire"):
+            connection = self._acquire()
+
+        _owners[id(connection)] = self
+        return connection
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+
+                stale = self._evict_idle()
+
+                connection = None
+                create = False
+
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+
+                elif self._size < self.max_size:
+                    self._size += 1
+                    create = True
+
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._condition.wait(remaining):
+                        if not self._idle and self._size >= self.max_size:
+                            raise PoolTimeout(f"No database connection available after {self.acquire_timeout}s")
+
+            # Close evicted connections and open or probe connections outside the lock
+            for connection_to_close in stale:
+                self._close_quietly(connection_to_close)
+                self._forget()
+
+            if connection is None and not create:
+                continue  # Woken up by a release, look again
+
+            if create:
+                try:
+                    connection = self.backend.connect()
+                except self.backend.TransientErrors as error:
+                    self._forget()
+                    self.breaker.record_failure()
+                    metrics.count("db_unavailable_total", reason="connect")
+                    raise DatabaseUnavailable(f"Could not connect to the database: {error}") from error
+                except BaseException:
+                    self._forget()
+                    raise
+                self.breaker.record_success()
+                with self._condition:
+                    self._created += 1
+                return connection
+
+            if time.monotonic() - last_used < self.health_check_after or self._is_healthy(connection):
+                with self._condition:
+                    self._reused += 1
+                return connection
+
+            # The connection went stale while idle, drop it and try again
+            self._close_quietly(connection)
+            self._forget()
+
+    def release(self, connection, discard=False) -> None:
+        """
+        Returns a connection to the pool.
+
+        Any uncommitted work is rolled back first so the next user starts with a clean
+        transaction. If the rollback fails, or discard is True, the connection is closed.
+        """
+
+        _owners.pop(id(connection), None)
+
+        if not discard:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+
+        with self._condition:
+            if not discard and not self._closed:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+                return
+
+        self._close_quietly(connection)
+        self._forget()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that acquires a connection and always returns it to the pool,
+        including on early returns and exceptions.
+        """
+
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self) -> None:
+        """
+        Closes every idle connection and stops handing out new ones. Connections in use
+        are closed when they are released.
+        """
+
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+
+        for connection, _ in idle:
+            self._close_quietly(connection)
+            self._forget()
+
+    def cursor_for(self, connection, sql):
+        """
+        Returns the cursor that last ran sql on this connection, creating it if needed.
+
+        Drivers such as pyodbc keep a statement prepared on the cursor and skip the
+        prepare step when the same SQL text is executed on it again, so reusing one
+        cursor per statement saves a round trip on every repeated query. Callers must
+        consume a statement's results fully before running another on the connection.
+        """
+
+        statements = self._statements.setdefault(id(connection), {})
+        cursor = statements.get(sql)
+
+        if cursor is None:
+            cursor = statements[sql] = connection.cursor()
+
+        return cursor
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of the pool's size and usage counters.
+        """
+
+        with self._condition:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "created": self._created,
+                "reused": self._reused,
+                "discarded": self._discarded,
+            }
+
+    def _evict_idle(self) -> list:
+        # Must be called with the lock held. Idle connections are ordered oldest first.
+        stale = []
+        now = time.monotonic()
+        while self._idle and self._size - len(stale) > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            stale.append(self._idle.pop(0)[0])
+        return stale
+
+    def _forget(self) -> None:
+        # A connection was closed or failed to open, free its slot
+        with self._condition:
+            self._size -= 1
+            self._discarded += 1
+            self._condition.notify()
+
+    @staticmethod
+    def _is_healthy(connection) -> bool:
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    def _close_quietly(self, connection) -> None:
+        self._statements.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _migrated(pool) -> ConnectionPool:
+    # Bring the schema up to date before the pool is handed to anyone
+    if config.DB_AUTO_MIGRATE:
+        import migrate
+        migrate.migrate(pool)
+    return pool
+
+
+def new_pool(backend, **options) -> ConnectionPool:
+    """
+    Builds a pool on backend with the configured sizes, timeouts and circuit breaker,
+    and applies any pending migrations to its database when DB_AUTO_MIGRATE is set.
+
+    Args:
+        backend: The backend new connections are opened with.
+        **options: Keyword arguments passed on to ConnectionPool, overriding the configured ones.
+    """
+
+    settings = {
+        "min_size": config.DB_POOL_MIN_SIZE,
+        "max_size": config.DB_POOL_MAX_SIZE,
+        "idle_timeout": config.DB_POOL_IDLE_TIMEOUT,
+        "acquire_timeout": config.DB_POOL_ACQUIRE_TIMEOUT,
+    }
+    settings.update(options)
+    settings.setdefault("breaker", CircuitBreaker(config.DB_BREAKER_THRESHOLD, config.DB_BREAKER_RESET))
+    return _migrated(ConnectionPool(backend, **settings))
+
+
+def get_pool() -> ConnectionPool:
     """
-    Establishes a connection to the SQL Server database using ODBC and Windows Authentication.
+    Returns the process-wide connection pool, creating it from config on first use and
+    applying any pending migrations when DB_AUTO_MIGRATE is set.
+    """
+
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = new_pool(BACKENDS[config.DB_BACKEND]())
+    return _pool
+
+
+def configure_pool(backend, **options) -> ConnectionPool:
+    """
+    Replaces the process-wide pool with one built on the given backend, applying any
+    pending migrations to its database when DB_AUTO_MIGRATE is set.
+
+    Used to point the application at a local stand-in database for tests and benchmarks.
+
+    Args:
+        backend: The backend new connections are opened with, e.g. SqliteBackend("bench.db").
+        **options: Keyword arguments passed on to ConnectionPool. Without a breaker, the
+            pool gets one with the configured DB_BREAKER_* thresholds.
 
     Returns:
-        pyodbc.Connection: A connection object to the specified database.
+        ConnectionPool: The newly installed pool.
+    """
 
-    Raises:
-        pyodbc.Error: If the connection fails.
+    global _pool
+
+    options.setdefault("breaker", CircuitBreaker(config.DB_BREAKER_THRESHOLD, config.DB_BREAKER_RESET))
+    pool = _migrated(ConnectionPool(backend, **options))
+
+    with _pool_lock:
+        old_pool, _pool = _pool, pool
+
+    if old_pool is not None:
+        old_pool.close()
+
+    return _pool
+
+
+def connection():
+    """
+    Context manager yielding a pooled connection that is returned to the pool on exit.
+
+    Example:
+        with db.connection() as connection:
+            cursor = connection.cursor()
+    """
+
+    return get_pool().connection()
+
+
+def integrity_error() -> type[Exception]:
+    """
+    Returns the exception type the active backend raises on constraint violations.
+    """
+
+    return get_pool().backend.IntegrityError
+
+
+def get_connection_to_db():
     """
+    Takes a connection from the pool. Prefer the connection() context manager, which
+    cannot leak; connections taken here must be handed back with close_connection().
 
-    server = config.DB_SERVER
-    database = config.DB_DATABASE
+    Returns:
+        A connection object to the configured database.
 
-    conn_str = (
-        'DRIVER={ODBC Driver 17 for SQL Server};'
-        f'SERVER={server};'
-        f'DATABASE={database};'
-        'Trusted_Connection=yes;'  # Enables Windows Authentication
-    )
+    Raises:
+        PoolTimeout: If no connection becomes free in time.
+    """
 
-    return pyodbc.connect(conn_str)
+    return get_pool().acquire()
 
 
 def close_connection(connection) -> None:
     """
-    Closes the provided database connection.
+    Returns the provided database connection to the pool.
 
     Args:
-        connection (pyodbc.Connection): The active database connection to close.
+        connection: The active database connection to release.
+    """
+
+    get_pool().release(connection)
+
+
+def execute(connection, sql, params=()):
+    """
+    Runs a statement on a pooled connection, reusing the connection's prepared cursor
+    for that SQL text, and counts it for count_queries().
+
+    Args:
+        connection: A connection borrowed from the pool.
+        sql (str): The statement to run.
+        params (tuple): Values for the statement's ? placeholders.
+
+    Returns:
+        The cursor the statement ran on, ready for fetchone()/fetchall().
+
+    Raises:
+        DatabaseUnavailable: If the statement failed with a connection error or timed out.
+    """
+
+    counters = getattr(_query_counters, "stack", None)
+    if counters:
+        for counter in counters:
+            counter.append(sql)
+
+    pool = _owners.get(id(connection)) or get_pool()
+    cursor = pool.cursor_for(connection, sql)
+
+    try:
+        with metrics.span("db_query"):
+            cursor.execute(sql, params)
+
+    except pool.backend.TransientErrors as error:
+        pool.breaker.record_failure()
+        metrics.count("db_unavailable_total", reason="query")
+        raise DatabaseUnavailable(f"Database query failed: {error}") from error
+
+    pool.breaker.record_success()
+    return cursor
+
+
+def idempotent(function):
+    """
+    Decorator for read-only helpers that borrow their own connection. A call that
+    fails with DatabaseUnavailable is retried up to DB_READ_RETRIES times with jittered
+    exponential backoff. CircuitOpen and PoolTimeout are not retried, since the database
+    is known to be down or the pool has already waited.
+
+    Only use it on functions that are safe to run more than once.
     """
-    
-    connection.close()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        for attempt in range(config.DB_READ_RETRIES + 1):
+            try:
+                return function(*args, **kwargs)
+
+            except (CircuitOpen, PoolTimeout):
+                raise
+
+            except DatabaseUnavailable:
+                if attempt == config.DB_READ_RETRIES:
+                    raise
+
+                metrics.count("db_read_retries_total")
+                # Jitter keeps threads that failed together from retrying in lockstep
+                time.sleep(config.DB_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    return wrapper
+
+
+@contextmanager
+def count_queries():
+    """
+    Context manager that records every statement run through execute() on the current
+    thread while the block is active.
+
+    Example:
+        with db.count_queries() as queries:
+            users.get_credentials(email)
+        assert len(queries) == 1
+
+    Yields:
+        list: The SQL text of each statement, in execution order.
+    """
+
+    queries = []
+    stack = _query_counters.__dict__.setdefault("stack", [])
+    stack.append(queries)
+
+    try:
+        yield queries
+    finally:
+        stack.remove(queries)
@@ -1,9 +1,10 @@
-import smtplib, ssl
-import config
-
 def send_email(receiver_email, subject, message) -> None:
     '''
-    Sends an email to the specified email address.
+    Queues an email to the specified email address.
+
+    The message is handed to the background mailer, which delivers it over a
+    persistent SMTP session, so the caller does not wait for the connection,
+    login or delivery.
 
     Args:
         receiver_email (str): The email address of the receiver.
@@ -11,21 +12,7 @@ def send_email(receiver_email, subject, message) -> None:
         message (str): The body content of the email.
     '''
 
-    # Port number for secure SMTP (SSL) connection
-    port = 465
-
-    # Create a secure SSL context for encrypted connection
-    context = ssl.create_default_context()
-
-    # Email address of the sender
-    sender_email = config.SENDER_EMAIL
-    
-    # Connect securely to the SMTP server and send the email
-    with smtplib.SMTP_SSL("smtp.gmail.com", port, context=context) as server:
+    # Imported on first send, so flows that never email do not load smtplib and ssl
+    import mailer
 
-        # Log in to the SMTP server with sender credentials
-        server.login(sender_email, config.SENDER_PASSWORD)
-        
-        # Format the email with subject line and message body
-        email_message = f"Subject: {subject}\n\n{message}"
-        server.sendmail(sender_email, receiver_email, email_message)
\ No newline at end of file
+    mailer.get_mailer().submit(receiver_email, subject, message)
@@ -0,0 +1,148 @@
+"""
+This module provides a local stand-in SMTP server for testing and benchmarking email
+delivery offline.
+
+It speaks just enough plain SMTP for smtplib (EHLO/HELO, AUTH, MAIL, RCPT, DATA, RSET,
+NOOP, QUIT), accepts any credentials, and keeps received messages in memory instead of
+relaying them. Addresses added to its rejected set are refused as unknown mailboxes. Point the mailer at it with SMTP_HOST=127.0.0.1, SMTP_PORT set to the
+server's port, and SMTP_USE_SSL=false.
+"""
+
+import socketserver, threading, time
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        server = self.server
+        sender, receivers = None, []
+        self._reply("220 localhost fake SMTP ready")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.decode("utf-8", "replace").rstrip("\r\n")
+            verb = command.split(" ", 1)[0].upper()
+
+            if server.latency:
+                time.sleep(server.latency)
+
+            match verb:
+
+                case "EHLO":
+                    self._reply("250-localhost", "250-AUTH PLAIN LOGIN", "250 OK")
+
+                case "HELO" | "NOOP":
+                    self._reply("250 OK")
+
+                case "AUTH":
+                    # AUTH LOGIN sends the username and password on separate lines
+                    if command.upper().startswith("AUTH LOGIN"):
+                        parts = command.split(" ")
+                        if len(parts) < 3:
+                            self._reply("334 VXNlcm5hbWU6")
+                            self.rfile.readline()
+                        self._reply("334 UGFzc3dvcmQ6")
+                        self.rfile.readline()
+                    self._reply("235 Authentication successful")
+
+                case "MAIL":
+                    sender, receivers = command.split(":", 1)[1].strip(), []
+                    self._reply("250 OK")
+
+                case "RCPT":
+                    receiver = command.split(":", 1)[1].strip()
+                    if receiver.strip("<>") in server.rejected:
+                        self._reply("550 No such user here")
+                    else:
+                        receivers.append(receiver)
+                        self._reply("250 OK")
+
+                case "DATA":
+                    self._reply("354 End data with <CR><LF>.<CR><LF>")
+                    body = []
+                    for data_line in self.rfile:
+                        if data_line in (b".\r\n", b".\n"):
+                            break
+                        body.append(data_line.decode("utf-8", "replace"))
+                    server.record(sender, receivers, "".join(body))
+                    self._reply("250 OK")
+
+                case "RSET":
+                    sender, receivers = None, []
+                    self._reply("250 OK")
+
+                case "QUIT":
+                    self._reply("221 Bye")
+                    return
+
+                case _:
+                    self._reply("502 Command not implemented")
+
+    def _reply(self, *lines) -> None:
+        self.wfile.write("".join(line + "\r\n" for line in lines).encode("utf-8"))
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded SMTP server on localhost that stores messages instead of sending them.
+
+    Use it as a context manager; it listens on a free port by default:
+
+        with FakeSMTPServer() as smtp_server:
+            session = SMTPSession("127.0.0.1", smtp_server.port, use_ssl=False)
+
+    Args:
+        port (int): Port to listen on; 0 picks a free one.
+        latency (float): Seconds to wait before answering each command, to mimic a remote server.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0) -> None:
+        super().__init__(("127.0.0.1", port), _SMTPHandler)
+        self.latency = latency
+        self.messages = []  # (sender, receivers, message) tuples
+        self.rejected = set()  # Receiver addresses answered with 550
+        self.connections = 0
+        self._messages_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def record(self, sender, receivers, message) -> None:
+        with self._messages_lock:
+            self.messages.append((sender, receivers, message))
+
+    def process_request(self, request, client_address) -> None:
+        with self._messages_lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def start(self) -> "FakeSMTPServer":
+        """
+        Starts serving on a background thread.
+        """
+
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-smtp", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops serving and closes the listening socket.
+        """
+
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "FakeSMTPServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
@@ -0,0 +1,421 @@
+"""
+This module holds the account flows shared by every client: the CLI (auth.py and
+user_actions.py) and service.LoginService, which the HTTP API and batch runner use.
+
+Each flow is a coroutine that takes its input as arguments and returns a status; none of
+them prompts, so the CLI asks its questions before or between flow calls. Blocking work
+goes through the runner passed in as the first argument, which provides:
+
+    db(function, *args)                     Runs a database or store call
+    check_password(password, stored_hash)   Verifies a password with bcrypt
+    hash_password(password)                 Hashes a password with bcrypt
+    dummy_check(password)                   Runs a bcrypt check that always fails
+    send_email(receiver_email, subject, message)
+    hash_engine, code_store, session_store
+
+INLINE runs all of it on the calling thread, as the CLI wants. LoginService runs bcrypt
+on the hashing engine's process pool, database calls on its thread pool and emails
+through its mailer, so the same flows never block its event loop.
+"""
+
+import audit, codes, config, db, email_utils, hashing, metrics, ratelimit, sessions, snapshot, totp, users
+from validators import is_valid_email, is_valid_password
+
+# Result statuses returned by the flows
+OK = "ok"
+UNKNOWN_EMAIL = "unknown_email"
+BAD_PASSWORD = "bad_password"
+TWO_FA_REQUIRED = "2fa_required"
+BAD_CODE = "bad_code"
+CODE_SENT = "code_sent"
+ACCOUNT_EXISTS = "account_exists"
+ALREADY_ENABLED = "already_enabled"
+INVALID_EMAIL = "invalid_email"
+INVALID_PASSWORD = "invalid_password"
+RATE_LIMITED = "rate_limited"
+LOCKED = "locked"
+
+# Audit detail and metrics outcome of a wrong 2FA code
+TWO_FA_FAILURE = "2fa_failure"
+
+
+class Inline:
+    """
+    Runs a flow's blocking work on the calling thread, for the interactive CLI.
+    """
+
+    @property
+    def hash_engine(self) -> hashing.HashEngine:
+        return hashing.get_engine()
+
+    @property
+    def code_store(self):
+        return codes.get_store()
+
+    @property
+    def session_store(self):
+        return sessions.get_store()
+
+    async def db(self, function, *args):
+        return function(*args)
+
+    async def check_password(self, password, stored_hash) -> bool:
+        return hashing.check_password(password, stored_hash)
+
+    async def hash_password(self, password) -> str:
+        return hashing.hash_password(password)
+
+    async def dummy_check(self, password) -> bool:
+        return hashing.dummy_check(password)
+
+    async def send_email(self, receiver_email, subject, message) -> None:
+        email_utils.send_email(receiver_email, subject, message)
+
+
+INLINE = Inline()
+
+
+def run(flow):
+    """
+    Runs a flow coroutine given INLINE to the end from synchronous code and returns its
+    result. INLINE never suspends, so the flow finishes on its first step without the
+    cost of an event loop.
+
+    Raises:
+        RuntimeError: If the flow suspends, as it would with a runner that offloads work.
+    """
+
+    try:
+        flow.send(None)
+    except StopIteration as finished:
+        return finished.value
+
+    flow.close()
+    raise RuntimeError("Only flows run with INLINE can be run from synchronous code")
+
+
+def _login_failed(email, source, reason) -> str:
+    metrics.count("auth_outcomes_total", flow="login", outcome=reason)
+    audit.emit(audit.LOGIN_FAILED, email, source, reason)
+    return reason
+
+
+async def _send_code(runner, email, purpose, subject, prefix) -> None:
+    # Generate a one-time code for authentication and queue it for delivery
+    code = await runner.db(runner.code_store.issue, email, purpose)
+    await runner.send_email(email, subject, prefix + code)
+
+
+async def register(runner, email, password) -> str:
+    """
+    Creates a new account.
+
+    Returns:
+        str: OK, INVALID_EMAIL, INVALID_PASSWORD or ACCOUNT_EXISTS.
+    """
+
+    if not is_valid_email(email):
+        return INVALID_EMAIL
+
+    if not is_valid_password(password):
+        return INVALID_PASSWORD
+
+    hashed_password = await runner.hash_password(password)
+
+    if not await runner.db(users.create_user, email, hashed_password):
+        return ACCOUNT_EXISTS
+
+    audit.emit(audit.ACCOUNT_CREATED, email)
+    return OK
+
+
+async def check_login(runner, email, password, source=None) -> tuple:
+    """
+    The first half of a login: checks an email and password, counting a wrong password
+    towards the account's lockout.
+
+    While the database is unavailable, the account is checked against the credential
+    snapshot (snapshot.py) if one is configured, and nothing is written.
+
+    Args:
+        source (str | None): Client address or other origin, used for per-source rate limits.
+
+    Returns:
+        tuple: The status (OK, BAD_PASSWORD, UNKNOWN_EMAIL, RATE_LIMITED or LOCKED), the
+               users.UserRecord or None, and True if the record came from the snapshot.
+    """
+
+    # Reject throttled attempts before spending a query or a bcrypt check on them
+    if not ratelimit.allow("login", email, source):
+        return _login_failed(email, source, RATE_LIMITED), None, False
+
+    record, from_snapshot = await runner.db(snapshot.login_record, email)
+
+    if record is None:
+        # Spend as long as a real password check so timing does not reveal unknown emails
+        await runner.dummy_check(password)
+        return _login_failed(email, source, UNKNOWN_EMAIL), None, from_snapshot
+
+    # Locked accounts are turned away without checking the password
+    if ratelimit.locked_for(record):
+        return _login_failed(email, source, LOCKED), record, from_snapshot
+
+    if not await runner.check_password(password, record.password_hash):
+        if not from_snapshot:
+            await runner.db(users.record_failed_login, email, ratelimit.lock_until(record.failed_logins + 1))
+        return _login_failed(email, source, BAD_PASSWORD), record, from_snapshot
+
+    # Transparently upgrade hashes made with an outdated cost factor
+    if runner.hash_engine.needs_rehash(record.password_hash) and not from_snapshot:
+        new_hash = await runner.hash_password(password)
+        await runner.db(users.update_password_hash, email, new_hash)
+
+    # The password was right, so earlier failures no longer count towards a lockout
+    if record.failed_logins:
+        await runner.db(users.clear_failed_logins, email)
+
+    return OK, record, from_snapshot
+
+
+async def finish_login(runner, email, record, from_snapshot, source=None, code=None, email_code=False) -> str:
+    """
+    The second half of a login, for a record check_login() accepted.
+
+    Accounts enrolled in an authenticator app need the app's code (or a backup code)
+    as code; without one they get TWO_FA_REQUIRED. With email_code set, or with emailed
+    2FA, a code is emailed instead and the login is finished by verify_2fa(). The
+    snapshot holds no TOTP secrets, so logins checked against it always use emailed codes.
+
+    Returns:
+        str: OK, TWO_FA_REQUIRED or BAD_CODE.
+    """
+
+    second_factor = None
+
+    if record.two_fa and record.totp_secret and not email_code:
+        if code is None:
+            return TWO_FA_REQUIRED
+
+        second_factor = await runner.db(totp.verify, record, code)
+        if second_factor is None:
+            _login_failed(email, source, TWO_FA_FAILURE)
+            return BAD_CODE
+
+    elif record.two_fa:
+        await _send_code(runner, email, "2fa", "Your Two Factor Authentication Code", "Two Factor Authentication Code: ")
+        return TWO_FA_REQUIRED
+
+    if not from_snapshot:
+        await runner.db(users.record_login, email)
+    metrics.count("auth_outcomes_total", flow="login", outcome="success")
+    audit.emit(audit.LOGIN_SUCCEEDED, email, source, "snapshot" if from_snapshot else second_factor)
+    return OK
+
+
+async def login(runner, email, password, source=None, code=None, email_code=False) -> str:
+    """
+    A whole login for non-interactive clients: check_login() and, if the password was
+    right, finish_login().
+
+    Returns:
+        str: OK, TWO_FA_REQUIRED, BAD_PASSWORD, BAD_CODE, UNKNOWN_EMAIL, RATE_LIMITED or LOCKED.
+    """
+
+    status, record, from_snapshot = await check_login(runner, email, password, source)
+    if status != OK:
+        return status
+
+    return await finish_login(runner, email, record, from_snapshot, source, code, email_code)
+
+
+async def verify_2fa(runner, email, code, source=None) -> str:
+    """
+    Finishes a 2FA login with the code emailed by finish_login().
+
+    Returns:
+        str: OK or BAD_CODE.
+    """
+
+    if not await runner.db(runner.code_store.verify, email, "2fa", code):
+        _login_failed(email, source, TWO_FA_FAILURE)
+        return BAD_CODE
+
+    detail = None
+    try:
+        await runner.db(users.record_login, email)
+    except db.DatabaseUnavailable:
+        # A login checked against the credential snapshot finishes without being recorded
+        if not config.SNAPSHOT_PATH:
+            raise
+        detail = "snapshot"
+
+    metrics.count("auth_outcomes_total", flow="login", outcome="success")
+    audit.emit(audit.LOGIN_SUCCEEDED, email, source, detail)
+    return OK
+
+
+async def request_reset(runner, email, source=None) -> str:
+    """
+    Emails a password reset code to a registered account.
+
+    Args:
+        source (str | None): Client address or other origin, used for per-source rate limits.
+
+    Returns:
+        str: CODE_SENT, UNKNOWN_EMAIL or RATE_LIMITED.
+    """
+
+    # Throttle reset requests before they cost a query or an email
+    if not ratelimit.allow("reset", email, source):
+        metrics.count("auth_outcomes_total", flow="reset", outcome=RATE_LIMITED)
+        return RATE_LIMITED
+
+    if not await runner.db(users.email_exists, email):
+        metrics.count("auth_outcomes_total", flow="reset", outcome=UNKNOWN_EMAIL)
+        return UNKNOWN_EMAIL
+
+    await _send_code(runner, email, "reset", "Your Authentication Code", "Authentication Code: ")
+    audit.emit(audit.RESET_REQUESTED, email, source)
+    return CODE_SENT
+
+
+async def reset_password(runner, email, code, new_password) -> str:
+    """
+    Sets a new password using the code emailed by request_reset().
+
+    Returns:
+        str: OK, INVALID_PASSWORD or BAD_CODE.
+    """
+
+    if not is_valid_password(new_password):
+        return INVALID_PASSWORD
+
+    if not await runner.db(runner.code_store.verify, email, "reset", code):
+        metrics.count("auth_outcomes_total", flow="reset", outcome=BAD_CODE)
+        return BAD_CODE
+
+    hashed_password = await runner.hash_password(new_password)
+    await runner.db(users.update_password_hash, email, hashed_password)
+    metrics.count("auth_outcomes_total", flow="reset", outcome="success")
+    audit.emit(audit.PASSWORD_RESET, email)
+    return OK
+
+
+async def enable_2fa(runner, email) -> str:
+    """
+    Turns on emailed 2FA codes for an account.
+
+    Returns:
+        str: OK or ALREADY_ENABLED.
+    """
+
+    # The update only applies if 2FA is not already enabled
+    if not await runner.db(users.enable_two_fa, email):
+        return ALREADY_ENABLED
+
+    audit.emit(audit.TWO_FA_ENABLED, email, detail="email")
+    return OK
+
+
+async def new_totp_secret(runner, email) -> tuple:
+    """
+    Creates a secret for enrolling an account in an authenticator app. Nothing is
+    stored until enable_totp() confirms it with a code from the app.
+
+    Returns:
+        tuple: The base32 secret and its otpauth:// provisioning URI.
+    """
+
+    secret = totp.new_secret()
+    return secret, totp.provisioning_uri(secret, email)
+
+
+async def enable_totp(runner, email, secret, code) -> tuple:
+    """
+    Turns on authenticator-app 2FA with a secret from new_totp_secret(), once code
+    shows the app produces valid codes for it. An account using emailed codes is
+    switched over to the app.
+
+    Returns:
+        tuple: OK and the new backup codes, or BAD_CODE and None.
+    """
+
+    if not totp.is_secret(secret):
+        return BAD_CODE, None
+
+    step = totp.match(secret, code)
+    if step is None:
+        return BAD_CODE, None
+
+    backup_codes, backup_hashes = totp.new_backup_codes()
+    await runner.db(users.enable_totp, email, secret, step, backup_hashes)
+    audit.emit(audit.TWO_FA_ENABLED, email, detail="app")
+    return OK, backup_codes
+
+
+async def update_password(runner, email, new_password) -> str:
+    """
+    Replaces the password of a logged-in user.
+
+    Returns:
+        str: OK or INVALID_PASSWORD.
+    """
+
+    if not is_valid_password(new_password):
+        return INVALID_PASSWORD
+
+    hashed_password = await runner.hash_password(new_password)
+    await runner.db(users.update_password_hash, email, hashed_password)
+    audit.emit(audit.PASSWORD_CHANGED, email)
+    return OK
+
+
+async def change_email(runner, email, new_email) -> str:
+    """
+    Moves an account to a new email and ends every session opened under the old one.
+
+    Returns:
+        str: OK, INVALID_EMAIL or ACCOUNT_EXISTS.
+    """
+
+    if not is_valid_email(new_email):
+        return INVALID_EMAIL
+
+    if not await runner.db(users.change_email, email, new_email):
+        return ACCOUNT_EXISTS
+
+    await runner.db(runner.session_store.revoke_user, email)
+    audit.emit(audit.EMAIL_CHANGED, email, detail=new_email)
+    return OK
+
+
+async def delete_account(runner, email, password) -> str:
+    """
+    Deletes an account after checking its password once more, and ends its sessions.
+
+    Returns:
+        str: OK or BAD_PASSWORD.
+    """
+
+    record = await runner.db(users.get_credentials, email)
+
+    if record is None or not await runner.check_password(password, record.password_hash):
+        return BAD_PASSWORD
+
+    await runner.db(users.delete_user, email)
+
+    # End every session of the deleted account, not just the caller's
+    await runner.db(runner.session_store.revoke_user, email)
+    audit.emit(audit.ACCOUNT_DELETED, email)
+    return OK
+
+
+async def end_session(runner, token, email=None) -> None:
+    """
+    Ends one session. Pass the session's email to record the logout in the audit log.
+    """
+
+    await runner.db(runner.session_store.revoke, token)
+
+    if email is not None:
+        audit.emit(audit.LOGGED_OUT, email)
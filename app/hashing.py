@@ -0,0 +1,314 @@
+"""
+This module is the bcrypt hashing engine shared by the CLI and the login service.
+
+Single hashes requested by the CLI run inline, since the caller would be waiting on
+them anyway. Concurrent and bulk callers go through HashEngine, which spreads bcrypt
+across a process pool with one worker per core so hashing is not limited to one CPU.
+bcrypt and the process pool machinery are imported on first use.
+"""
+
+import os, re, secrets, threading, time
+import config, metrics
+
+# bcrypt refuses passwords longer than this many UTF-8 bytes
+MAX_PASSWORD_BYTES = 72
+# A bcrypt hash: version, two-digit cost, then 22 characters of salt and 31 of hash
+HASH_PATTERN = re.compile(r"\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}")
+
+
+def _hashpw(password, rounds) -> str:
+    # Module-level so it can run in a worker process
+    import bcrypt
+    encoded = password.encode("utf-8")
+    if len(encoded) > MAX_PASSWORD_BYTES:
+        raise ValueError(f"Password is longer than {MAX_PASSWORD_BYTES} bytes")
+    return bcrypt.hashpw(encoded, bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _hashpw_or_error(password, rounds) -> str | ValueError:
+    # For batches: one password bcrypt refuses comes back as its error instead of failing the batch
+    try:
+        return _hashpw(password, rounds)
+    except ValueError as error:
+        return error
+
+
+def _checkpw(password, stored_hash) -> bool:
+    # Module-level so it can run in a worker process
+    import bcrypt
+    encoded = password.encode("utf-8")
+    if len(encoded) > MAX_PASSWORD_BYTES:
+        # No stored hash can match a password bcrypt refuses to hash
+        return False
+    if isinstance(stored_hash, str):
+        stored_hash = stored_hash.encode("utf-8")
+    return bcrypt.checkpw(encoded, stored_hash)
+
+
+def _rehash(password, stored_hash, rounds) -> str | None:
+    # Verify a password and, if its hash uses an outdated cost, return a replacement hash
+    if not _checkpw(password, stored_hash) or hash_rounds(stored_hash) >= rounds:
+        return None
+    return _hashpw(password, rounds)
+
+
+def hash_rounds(stored_hash) -> int:
+    """
+    Reads the cost factor out of a bcrypt hash such as "$2b$12$...".
+
+    Args:
+        stored_hash (str | bytes): A bcrypt hash.
+
+    Returns:
+        int: The hash's cost factor (log2 of the number of rounds).
+    """
+
+    if isinstance(stored_hash, bytes):
+        stored_hash = stored_hash.decode("utf-8")
+    return int(stored_hash.split("$")[2])
+
+
+def calibrate(target_ms=250.0, min_rounds=4, max_rounds=16) -> int:
+    """
+    Picks the highest bcrypt cost factor whose measured hash time is at or below target_ms.
+
+    Costs are tried from min_rounds upwards, each step doubling the hash time, and the
+    search stops at the first hash that goes over the target. If even min_rounds goes
+    over it, min_rounds is returned.
+
+    Args:
+        target_ms (float): Target time for one hash in milliseconds.
+        min_rounds (int): Lowest cost factor to consider; bcrypt's minimum is 4.
+        max_rounds (int): Highest cost factor to consider.
+
+    Returns:
+        int: The chosen cost factor.
+    """
+
+    chosen = min_rounds
+
+    for rounds in range(min_rounds, max_rounds + 1):
+        start = time.perf_counter()
+        _hashpw("calibration", rounds)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        if elapsed_ms > target_ms:
+            break
+        chosen = rounds
+
+    return chosen
+
+
+class HashEngine:
+    """
+    Runs bcrypt on a process pool.
+
+    Args:
+        rounds (int): Cost factor for new hashes.
+        workers (int): Worker processes; defaults to one per CPU.
+    """
+
+    def __init__(self, rounds, workers=None) -> None:
+        self.rounds = rounds
+        self.workers = workers or os.cpu_count()
+        self._executor = None
+        self._dummy_hash = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # Worker processes are only started, and multiprocessing imported, once something is submitted
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    from concurrent.futures import ProcessPoolExecutor
+                    self._executor = ProcessPoolExecutor(self.workers)
+        return self._executor
+
+    def submit_hash(self, password):
+        """
+        Hashes a password on the pool and returns a concurrent.futures.Future for the hash.
+        """
+
+        return self._timed("bcrypt_hash", self.executor.submit(_hashpw, password, self.rounds))
+
+    def submit_check(self, password, stored_hash):
+        """
+        Verifies a password on the pool and returns a concurrent.futures.Future for the result.
+        """
+
+        return self._timed("bcrypt_verify", self.executor.submit(_checkpw, password, stored_hash))
+
+    def submit_rehash(self, password, stored_hash):
+        """
+        Verifies a password on the pool and returns a Future for its upgraded hash, which is
+        None if the password is wrong or the hash is already at the configured cost.
+        """
+
+        return self.executor.submit(_rehash, password, stored_hash, self.rounds)
+
+    def hash_many(self, passwords, chunksize=16) -> list:
+        """
+        Hashes many passwords in parallel, preserving their order.
+
+        Returns:
+            list: The hash of each password, or the ValueError in its place for a password
+                  bcrypt refuses, such as one over MAX_PASSWORD_BYTES.
+        """
+
+        passwords = list(passwords)
+        return list(self.executor.map(_hashpw_or_error, passwords, [self.rounds] * len(passwords),
+                                      chunksize=chunksize))
+
+    def check_many(self, pairs, chunksize=16) -> list:
+        """
+        Verifies many (password, stored_hash) pairs in parallel, preserving their order.
+        A password over MAX_PASSWORD_BYTES never matches.
+        """
+
+        passwords, hashes = zip(*pairs) if pairs else ((), ())
+        return list(self.executor.map(_checkpw, passwords, hashes, chunksize=chunksize))
+
+    def rehash_many(self, pairs, chunksize=16) -> list:
+        """
+        Upgrades many (password, stored_hash) pairs in parallel.
+
+        Returns:
+            list: The new hash for each pair, or None where the password did not match or
+                  the hash already uses the configured cost.
+        """
+
+        pairs = list(pairs)
+        passwords = [password for password, _ in pairs]
+        hashes = [stored_hash for _, stored_hash in pairs]
+        return list(self.executor.map(_rehash, passwords, hashes, [self.rounds] * len(pairs), chunksize=chunksize))
+
+    @staticmethod
+    def _timed(name, future):
+        # Record submit-to-result time, which includes any wait for a free worker
+        if metrics.enabled:
+            start = time.perf_counter()
+            future.add_done_callback(lambda _: metrics.observe(name, time.perf_counter() - start))
+        return future
+
+    def needs_rehash(self, stored_hash) -> bool:
+        """
+        Returns True if the hash was made with a lower cost than the engine's.
+        """
+
+        return hash_rounds(stored_hash) < self.rounds
+
+    def submit_dummy_hash(self):
+        """
+        Makes dummy_hash on the pool unless it exists already, and returns a Future for it,
+        so async callers never compute it inline on their event loop.
+        """
+
+        if self._dummy_hash is not None:
+            from concurrent.futures import Future
+            future = Future()
+            future.set_result(self._dummy_hash)
+            return future
+
+        def keep(done) -> None:
+            if self._dummy_hash is None and done.exception() is None:
+                self._dummy_hash = done.result()
+
+        future = self.executor.submit(_hashpw, secrets.token_urlsafe(16), self.rounds)
+        future.add_done_callback(keep)
+        return future
+
+    @property
+    def dummy_hash(self) -> str:
+        """
+        A hash of a random password at the engine's cost. Checking a password against it
+        takes as long as a real check, so unknown emails cannot be told apart by timing.
+        Made inline on first use unless submit_dummy_hash() made it already.
+        """
+
+        if self._dummy_hash is None:
+            self._dummy_hash = _hashpw(secrets.token_urlsafe(16), self.rounds)
+        return self._dummy_hash
+
+    def close(self) -> None:
+        """
+        Shuts down the worker processes.
+        """
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> HashEngine:
+    """
+    Returns the process-wide hashing engine. The cost factor comes from BCRYPT_ROUNDS, or
+    is calibrated against BCRYPT_TARGET_MS on first use when BCRYPT_ROUNDS is "auto".
+    """
+
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                if config.BCRYPT_ROUNDS == "auto":
+                    rounds = calibrate(config.BCRYPT_TARGET_MS)
+                else:
+                    rounds = int(config.BCRYPT_ROUNDS)
+                _engine = HashEngine(rounds, config.SERVICE_HASH_WORKERS or None)
+    return _engine
+
+
+def hash_password(password) -> str:
+    """
+    Hashes a password inline with the configured cost factor.
+
+    Args:
+        password (str): The plaintext password.
+
+    Returns:
+        str: The bcrypt hash.
+
+    Raises:
+        ValueError: If the password is longer than MAX_PASSWORD_BYTES.
+    """
+
+    with metrics.span("bcrypt_hash"):
+        return _hashpw(password, get_engine().rounds)
+
+
+def check_password(password, stored_hash) -> bool:
+    """
+    Verifies a password inline against a stored bcrypt hash.
+
+    Args:
+        password (str): The plaintext password.
+        stored_hash (str | bytes): The stored bcrypt hash.
+
+    Returns:
+        bool: True if the password matches; always False for one over MAX_PASSWORD_BYTES.
+    """
+
+    with metrics.span("bcrypt_verify"):
+        return _checkpw(password, stored_hash)
+
+
+def dummy_check(password) -> bool:
+    """
+    Runs a full bcrypt check that always fails, to spend the same time on an unknown
+    email as on a wrong password.
+    """
+
+    return check_password(password, get_engine().dummy_hash)
+
+
+def needs_rehash(stored_hash) -> bool:
+    """
+    Returns True if a stored hash uses a lower cost than the configured one.
+    """
+
+    return get_engine().needs_rehash(stored_hash)
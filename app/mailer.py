@@ -0,0 +1,384 @@
+"""
+This module delivers email through long-lived, authenticated SMTP sessions.
+
+Messages are put on a bounded in-memory queue and drained by worker threads. Each
+worker keeps its own SMTP session open between messages, sends everything waiting in
+the queue (up to batch_size) over that session, reconnects when the session has gone
+stale, and retries transient failures with exponential backoff. Callers therefore
+never wait for a TLS handshake, a login or delivery.
+
+A mailer can also be limited to a number of messages per second across all of its
+workers and report each message's outcome to a callback, as campaign.py uses it.
+"""
+
+import atexit, queue, random, smtplib, ssl, sys, threading, time
+from email.message import EmailMessage
+import config, metrics
+
+
+class SMTPSession:
+    """
+    One authenticated connection to an SMTP server that is reopened on demand.
+
+    Args:
+        host (str): SMTP server host name.
+        port (int): SMTP server port.
+        use_ssl (bool): Connect with implicit TLS (SMTP_SSL) instead of plain SMTP.
+        username (str | None): Login name; no login is attempted when it or password is empty.
+        password (str | None): Login password.
+        timeout (float): Socket timeout in seconds.
+        max_idle (float): Idle seconds after which the session is checked with NOOP before reuse.
+    """
+
+    def __init__(self, host, port, use_ssl=True, username=None, password=None, timeout=30.0, max_idle=60.0) -> None:
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        self._server = None
+        self._last_used = 0.0
+
+    def send(self, sender_email, receiver_email, email_message) -> None:
+        """
+        Sends one message, connecting and logging in first if needed.
+
+        Raises:
+            smtplib.SMTPException | OSError: If the message could not be sent.
+        """
+
+        with metrics.span("smtp_connect"):
+            server = self._ensure_open()
+
+        try:
+            with metrics.span("smtp_send"):
+                server.sendmail(sender_email, receiver_email, email_message)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # The connection is unusable; drop it so the next send reconnects
+            self.close()
+            raise
+
+        self._last_used = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Closes the connection if one is open.
+        """
+
+        server, self._server = self._server, None
+
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    def _ensure_open(self):
+        # Check a session that sat idle for a while before trusting it
+        if self._server is not None and time.monotonic() - self._last_used > self.max_idle:
+            try:
+                if self._server.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+
+        if self._server is None:
+            if self.use_ssl:
+                context = ssl.create_default_context()
+                server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=context)
+            else:
+                server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+            if self.username and self.password:
+                server.login(self.username, self.password)
+
+            self._server = server
+            self._last_used = time.monotonic()
+
+        return self._server
+
+
+class Mailer:
+    """
+    Background email delivery over a pool of persistent SMTP sessions.
+
+    Args:
+        session_factory: Callable returning a new SMTPSession; one is made per worker.
+        sender_email (str): Address messages are sent from.
+        workers (int): Worker threads, each with its own SMTP session.
+        queue_size (int): Messages that may wait for delivery; submit() blocks or drops beyond this.
+        batch_size (int): Messages a worker sends over its session before checking the queue again.
+        max_retries (int): Attempts after the first before a message is counted as failed.
+        backoff (float): Base delay in seconds between retries; doubled on each attempt.
+        rate (float): Most messages sent per second over all workers, retries included; 0 for no limit.
+    """
+
+    def __init__(self, session_factory, sender_email, workers=2, queue_size=1000, batch_size=20,
+                 max_retries=3, backoff=0.5, rate=0.0) -> None:
+        self.session_factory = session_factory
+        self.sender_email = sender_email
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate = rate
+
+        self._queue = queue.Queue(queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._next_send = 0.0
+        self._metrics = {"queued": 0, "sent": 0, "failed": 0, "retried": 0, "dropped": 0,
+                         "reconnects": 0, "batches": 0, "delivery_seconds": 0.0}
+
+    def submit(self, receiver_email, subject, message, block=True, timeout=None, on_done=None) -> bool:
+        """
+        Queues a message for delivery and returns without waiting for it to be sent.
+
+        Args:
+            receiver_email (str): The email address of the receiver.
+            subject (str): The subject line of the email.
+            message (str): The body content of the email.
+            block (bool): Wait for room if the queue is full instead of dropping the message.
+            timeout (float | None): Longest time to wait for room when block is True.
+            on_done: Called on a worker thread as on_done(receiver_email, error) once the message
+                is sent (error None) or has failed for good; it must not raise.
+
+        Returns:
+            bool: True if the message was queued, False if it was dropped because the queue was full.
+        """
+
+        self._start()
+
+        email_message = _format(subject, message)
+
+        try:
+            self._queue.put((receiver_email, email_message, time.monotonic(), on_done), block, timeout)
+        except queue.Full:
+            self._count("dropped")
+            return False
+
+        self._count("queued")
+        return True
+
+    def flush(self) -> None:
+        """
+        Blocks until every queued message has been delivered or has failed.
+        """
+
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        Delivers the remaining messages, then stops the workers and closes their sessions.
+        """
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def metrics(self) -> dict:
+        """
+        Returns delivery counters and the current queue depth.
+        """
+
+        with self._lock:
+            metrics = dict(self._metrics)
+
+        metrics["queue_depth"] = self._queue.qsize()
+        return metrics
+
+    def _start(self) -> None:
+        # Worker threads are only started once the first message is submitted
+        if self._threads:
+            return
+
+        with self._lock:
+            if not self._threads:
+                for number in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f"mailer-{number}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _work(self) -> None:
+        session = self.session_factory()
+
+        try:
+            stopping = False
+
+            while not stopping:
+                item = self._queue.get()
+                if item is None:
+                    self._queue.task_done()
+                    return
+
+                # Send whatever else is already waiting over the same session
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        # Stop signal; finish this batch first
+                        self._queue.task_done()
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                self._count("batches")
+                for receiver_email, email_message, queued_at, on_done in batch:
+                    # Every message is marked done, whatever happens, so flush() never hangs
+                    try:
+                        self._send_one(session, receiver_email, email_message, queued_at, on_done)
+                    finally:
+                        self._queue.task_done()
+        finally:
+            session.close()
+
+    def _send_one(self, session, receiver_email, email_message, queued_at, on_done) -> None:
+        # Anything raised here is reported and the worker goes on with the next message
+        try:
+            error = self._deliver(session, receiver_email, email_message, queued_at)
+        except Exception as unexpected:
+            print(f"Could not send email to {receiver_email}: {unexpected!r}", file=sys.stderr)
+            self._count("failed")
+            metrics.count("emails_total", outcome="failed")
+            error = unexpected
+
+        if on_done is None:
+            return
+
+        try:
+            on_done(receiver_email, error)
+        except Exception as callback_error:
+            print(f"Delivery callback for {receiver_email} failed: {callback_error!r}", file=sys.stderr)
+
+    def _deliver(self, session, receiver_email, email_message, queued_at):
+        # Returns None once sent, or the error the message finally failed with
+        for attempt in range(self.max_retries + 1):
+            self._throttle()
+
+            try:
+                session.send(self.sender_email, receiver_email, email_message)
+                delivery_seconds = time.monotonic() - queued_at
+                self._count("sent", "delivery_seconds", delivery_seconds)
+                metrics.observe("email_delivery", delivery_seconds)
+                metrics.count("emails_total", outcome="sent")
+                return None
+
+            except smtplib.SMTPRecipientsRefused as refused:
+                # Retrying will not help if the server rejects the address
+                print(f"Could not send email to {receiver_email}: {refused}")
+                send_error = refused
+                break
+
+            except (smtplib.SMTPException, OSError) as error:
+                send_error = error
+                if attempt == self.max_retries:
+                    print(f"Could not send email to {receiver_email}: {send_error}")
+                    break
+
+                self._count("retried")
+                if isinstance(send_error, (smtplib.SMTPServerDisconnected, OSError)):
+                    self._count("reconnects")
+                    session.close()
+
+                # Exponential backoff with jitter so workers do not retry in lockstep
+                time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+        self._count("failed")
+        metrics.count("emails_total", outcome="failed")
+        return send_error
+
+    def _throttle(self) -> None:
+        # Hands out evenly spaced send times, so the workers together keep to the rate
+        if self.rate <= 0:
+            return
+
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_send)
+            self._next_send = slot + 1.0 / self.rate
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _count(self, name, seconds_name=None, seconds=0.0) -> None:
+        with self._lock:
+            self._metrics[name] += 1
+            if seconds_name is not None:
+                self._metrics[seconds_name] += seconds
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+def _format(subject, message) -> str | bytes:
+    # Plain ASCII messages go out as they always have; anything else needs MIME headers,
+    # since smtplib only sends ASCII strings
+    if (subject + message).isascii():
+        return f"Subject: {subject}\n\n{message}"
+
+    email_message = EmailMessage()
+    email_message["Subject"] = subject
+    email_message.set_content(message)
+    return email_message.as_bytes()
+
+
+def default_session() -> SMTPSession:
+    """
+    Returns an SMTP session for the server and account configured in .env.
+    """
+
+    return SMTPSession(config.SMTP_HOST, config.SMTP_PORT, config.SMTP_USE_SSL,
+                       config.SENDER_EMAIL, config.SENDER_PASSWORD)
+
+
+def get_mailer() -> Mailer:
+    """
+    Returns the process-wide mailer, creating it from config on first use. Queued
+    messages are delivered before the interpreter exits.
+    """
+
+    global _mailer
+
+    if _mailer is None:
+        with _mailer_lock:
+            if _mailer is None:
+                _mailer = Mailer(
+                    default_session,
+                    config.SENDER_EMAIL,
+                    workers=config.MAIL_WORKERS,
+                    queue_size=config.MAIL_QUEUE_SIZE,
+                    batch_size=config.MAIL_BATCH_SIZE,
+                    max_retries=config.MAIL_MAX_RETRIES,
+                )
+                atexit.register(_mailer.close)
+    return _mailer
+
+
+def configure_mailer(mailer) -> Mailer:
+    """
+    Replaces the process-wide mailer, e.g. with one pointed at a local fake SMTP server.
+    The previous mailer delivers its queued messages and is closed.
+    """
+
+    global _mailer
+
+    with _mailer_lock:
+        old_mailer, _mailer = _mailer, mailer
+
+    if old_mailer is not None:
+        old_mailer.close()
+
+    atexit.register(mailer.close)
+    return mailer
@@ -1,7 +1,29 @@
 from ui import BLUE, RED, YELLOW, BOLD, RESET, print_start_page
-from auth import create_account, log_in
-from user_actions import logged_in_page, forgot_password
-import sys, state
+import sys
+
+def _flows():
+    """
+    Imports the account flows the first time a command needs them.
+
+    The flows pull in bcrypt, the database layer, the settings from .env and the
+    metrics exporters, none of which "help" or "quit" use, so deferring them lets the
+    start page appear without waiting. Later calls return the already imported modules.
+
+    Returns:
+        tuple: The auth, state and user_actions modules.
+    """
+
+    import auth, metrics, state, user_actions
+
+    metrics.start_exporters()
+    return auth, state, user_actions
+
+
+def _database_unavailable(error) -> bool:
+    # db is only imported by the flows, so an error raised before that cannot be a database one
+    db = sys.modules.get("db")
+    return db is not None and isinstance(error, db.DatabaseUnavailable)
+
 
 def start_page() -> None:
     """
@@ -27,29 +49,39 @@ def start_page() -> None:
             user_choice = input(">>> ").lower()
 
             # Handle the input using match-case
-            match user_choice:
+            try:
+                match user_choice:
+
+                    case "new account":
+                        auth, _, _ = _flows()
+                        auth.create_account()
 
-                case "new account":
-                    create_account()
+                    case "forgot password":
+                        _, _, user_actions = _flows()
+                        user_actions.forgot_password()
 
-                case "forgot password":
-                    forgot_password()
+                    case "login":
+                        auth, state, user_actions = _flows()
+                        auth.log_in()
+                        if state.current_user() is not None:
+                            user_actions.logged_in_page()
 
-                case "login":
-                    log_in()
-                    if state.user is not None:
-                        logged_in_page()
+                    case "help":
+                        print_start_page()
 
-                case "help":
-                    print_start_page()
+                    case "quit":
+                        print("Thank you for visiting Rahem's Login Simulator")
+                        print("See you soon!")
+                        sys.exit()
 
-                case "quit":
-                    print("Thank you for visiting Rahem's Login Simulator")
-                    print("See you soon!")
-                    sys.exit()
+                    case _:
+                        print("Invalid command")  # Handle unrecognized input
 
-                case _:
-                    print("Invalid command")  # Handle unrecognized input
+            except Exception as error:
+                # A database outage sends the user back here instead of crashing the CLI
+                if not _database_unavailable(error):
+                    raise
+                print("The service is temporarily unavailable. Try again later.")
 
     except KeyboardInterrupt:
         # Gracefully handle Ctrl+C interruption
@@ -59,4 +91,9 @@ def start_page() -> None:
 
 
 if __name__ == "__main__":
-    start_page()
\ No newline at end of file
+    # "python main.py --batch <file>" runs commands from a file instead of prompting
+    if sys.argv[1:2] == ["--batch"]:
+        import batch
+        batch.main(sys.argv[2:])
+    else:
+        start_page()
\ No newline at end of file
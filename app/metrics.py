@@ -0,0 +1,255 @@
+"""
+This module collects timing histograms and outcome counters for the hot paths.
+
+Spans time connection acquisition, queries, bcrypt hashing and verification, and
+email delivery; counters record outcomes such as successful logins and bad passwords.
+Histograms use fixed buckets, so recording is a bisect and two additions under a lock.
+Metrics can be scraped in Prometheus text format over HTTP (METRICS_PORT) or dumped to
+a file periodically (METRICS_DUMP_PATH).
+
+When METRICS_ENABLED is false, span() hands back one shared no-op context manager and
+count() returns immediately, so the instrumentation costs a single flag check.
+"""
+
+import threading, time
+from bisect import bisect_left
+from contextlib import nullcontext
+import config
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+enabled = config.METRICS_ENABLED
+
+_NO_SPAN = nullcontext()
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+class Histogram:
+    """
+    Cumulative-bucket latency histogram in the Prometheus style.
+    """
+
+    __slots__ = ("counts", "total", "count", "_lock")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)  # Last slot is the +Inf bucket
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds) -> None:
+        index = bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    def snapshot(self) -> tuple:
+        with self._lock:
+            return list(self.counts), self.total, self.count
+
+
+class _Span:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def histogram(name) -> Histogram:
+    """
+    Returns the histogram for a span name, creating it on first use.
+    """
+
+    found = _histograms.get(name)
+
+    if found is None:
+        with _lock:
+            found = _histograms.setdefault(name, Histogram())
+
+    return found
+
+
+def span(name):
+    """
+    Context manager that records how long its block takes under the given span name.
+
+    Example:
+        with metrics.span("db_query"):
+            cursor.execute(sql, params)
+    """
+
+    if not enabled:
+        return _NO_SPAN
+    return _Span(histogram(name))
+
+
+def observe(name, seconds) -> None:
+    """
+    Records a duration measured elsewhere, e.g. from a worker process or a queue.
+    """
+
+    if enabled:
+        histogram(name).observe(seconds)
+
+
+def count(name, **labels) -> None:
+    """
+    Increments a counter, e.g. count("auth_outcomes_total", flow="login", outcome="success").
+    """
+
+    if not enabled:
+        return
+
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + 1
+
+
+def reset() -> None:
+    """
+    Clears every histogram and counter.
+    """
+
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def snapshot() -> dict:
+    """
+    Returns the current counters and histogram summaries as plain data.
+    """
+
+    with _lock:
+        counters = dict(_counters)
+        histograms = dict(_histograms)
+
+    result = {"counters": [], "spans": {}}
+
+    for (name, labels), value in sorted(counters.items()):
+        result["counters"].append({"name": name, "labels": dict(labels), "value": value})
+
+    for name, hist in sorted(histograms.items()):
+        counts, total, observations = hist.snapshot()
+        result["spans"][name] = {"count": observations, "sum_seconds": total,
+                                 "buckets": dict(zip([*map(str, BUCKETS), "+Inf"], counts))}
+
+    return result
+
+
+def render_prometheus() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+    """
+
+    with _lock:
+        counters = dict(_counters)
+        histograms = dict(_histograms)
+
+    lines = []
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE loginsim_{name} counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                label_text = ",".join(f'{key}="{value_}"' for key, value_ in labels)
+                lines.append(f"loginsim_{name}{{{label_text}}} {value}")
+
+    if histograms:
+        lines.append("# TYPE loginsim_span_seconds histogram")
+
+    for name, hist in sorted(histograms.items()):
+        counts, total, observations = hist.snapshot()
+        cumulative = 0
+        for bound, bucket_count in zip([*map(str, BUCKETS), "+Inf"], counts):
+            cumulative += bucket_count
+            lines.append(f'loginsim_span_seconds_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'loginsim_span_seconds_sum{{span="{name}"}} {total}')
+        lines.append(f'loginsim_span_seconds_count{{span="{name}"}} {observations}')
+
+    return "\n".join(lines) + "\n"
+
+
+def serve(port, host="127.0.0.1"):
+    """
+    Serves /metrics in Prometheus text format from a background thread.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The running server; call shutdown() to stop it.
+    """
+
+    # http.server is only imported when the endpoint is turned on
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self) -> None:
+            if self.path not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass  # Keep scrapes out of the terminal
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def dump_periodically(path, interval) -> threading.Event:
+    """
+    Rewrites path with the Prometheus text every interval seconds from a background thread.
+
+    Returns:
+        threading.Event: Set it to stop dumping.
+    """
+
+    stop = threading.Event()
+
+    def dump() -> None:
+        while not stop.wait(interval):
+            with open(path, "w", encoding="utf-8") as target:
+                target.write(render_prometheus())
+
+    threading.Thread(target=dump, name="metrics-dump", daemon=True).start()
+    return stop
+
+
+_exporters_started = False
+
+
+def start_exporters() -> None:
+    """
+    Starts the HTTP endpoint and/or file dump configured by METRICS_PORT and
+    METRICS_DUMP_PATH. Safe to call more than once.
+    """
+
+    global _exporters_started
+
+    if not enabled or _exporters_started:
+        return
+    _exporters_started = True
+
+    if config.METRICS_PORT:
+        serve(config.METRICS_PORT)
+
+    if config.METRICS_DUMP_PATH:
+        dump_periodically(config.METRICS_DUMP_PATH, config.METRICS_DUMP_INTERVAL)
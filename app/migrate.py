@@ -0,0 +1,240 @@
+"""
+This module applies the numbered schema migrations in database/migrations.
+
+Each migration is a Python file named "<number>_<description>.py" with an up(migration)
+function. The function receives a Migration object, which runs SQL for the active
+dialect ("sqlserver" or "sqlite") and can check whether a table, column or index
+already exists. That lets every migration be written to be idempotent, even against a
+database that was set up by hand.
+
+Applied versions are recorded in the schema_version table. All pending migrations run
+in one transaction while holding an exclusive lock (sp_getapplock on SQL Server, BEGIN
+IMMEDIATE on sqlite), so processes starting at the same time cannot apply the same
+migration twice, and a failed migration leaves the schema as it was. The application
+runs the migrations when the connection pool is created (DB_AUTO_MIGRATE); when the
+schema is current, this costs a single query.
+
+Usage:
+    python migrate.py            # Apply every pending migration
+    python migrate.py --status   # List the migrations and whether they are applied
+
+With DB_SHARDS set, the command migrates the main database and then every shard.
+"""
+
+import argparse, importlib.util, os, re, sys, time
+import config, db, shards
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "database", "migrations")
+
+# Migration file names look like "0003_last_login.py"
+FILE_PATTERN = re.compile(r"^(\d+)_(\w+)\.py$")
+
+
+class Migration:
+    """
+    The helper handed to each migration's up() function.
+
+    Args:
+        connection: A connection with the migration transaction open.
+        dialect (str): "sqlserver" or "sqlite".
+    """
+
+    def __init__(self, connection, dialect) -> None:
+        self.connection = connection
+        self.dialect = dialect
+
+    def execute(self, sql=None, *, sqlserver=None, sqlite=None, params=()):
+        """
+        Runs a statement. Pass sql for SQL both dialects accept, or sqlserver= and sqlite=
+        for dialect-specific statements; a dialect given None skips the statement.
+        """
+
+        if sql is None:
+            sql = sqlserver if self.dialect == "sqlserver" else sqlite
+            if sql is None:
+                return None
+
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def _exists(self, sqlserver, sqlite, params) -> bool:
+        return bool(self.execute(sqlserver=sqlserver, sqlite=sqlite, params=params).fetchall())
+
+    def table_exists(self, table) -> bool:
+        return self._exists('SELECT 1 FROM sys.tables WHERE name = ?',
+                            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ? COLLATE NOCASE", (table,))
+
+    def column_exists(self, table, column) -> bool:
+        if self.dialect == "sqlite":
+            return any(row[1].lower() == column.lower() for row in self.execute(f'PRAGMA table_info({table})').fetchall())
+        return self._exists('SELECT 1 FROM sys.columns WHERE object_id = OBJECT_ID(?) AND name = ?', None, (table, column))
+
+    def index_exists(self, table, index) -> bool:
+        return self._exists('SELECT 1 FROM sys.indexes WHERE object_id = OBJECT_ID(?) AND name = ?',
+                            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = ? COLLATE NOCASE AND name = ?",
+                            (table, index))
+
+    def add_column(self, table, column, *, sqlserver, sqlite) -> None:
+        """
+        Adds a column unless it exists. sqlserver and sqlite give the column definition
+        (type, nullability, default) in each dialect.
+        """
+
+        if not self.column_exists(table, column):
+            definition = sqlserver if self.dialect == "sqlserver" else sqlite
+            self.execute(f'ALTER TABLE {table} ADD {column} {definition}')
+
+    def create_index(self, table, index, *, sqlserver=None, sqlite=None) -> None:
+        """
+        Runs the dialect's CREATE INDEX statement unless the index exists.
+        """
+
+        if not self.index_exists(table, index):
+            self.execute(sqlserver=sqlserver, sqlite=sqlite)
+
+
+def discover(directory=MIGRATIONS_DIR) -> list:
+    """
+    Returns (version, name, path) for every migration file, in version order.
+
+    Raises:
+        ValueError: If two migrations share a version number.
+    """
+
+    migrations = []
+
+    for file_name in os.listdir(directory):
+        match = FILE_PATTERN.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, file_name)))
+
+    migrations.sort()
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError("Two migrations share a version number")
+
+    return migrations
+
+
+def _load(version, path):
+    spec = importlib.util.spec_from_file_location(f"migration_{version}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _applied_versions(migration) -> set:
+    if not migration.table_exists("schema_version"):
+        return set()
+    return {row[0] for row in migration.execute('SELECT version FROM schema_version').fetchall()}
+
+
+def _lock(migration) -> None:
+    # Serialise concurrent runners; both locks are released when the transaction ends
+    migration.execute(
+        sqlserver="EXEC sp_getapplock @Resource = 'schema_migrations', @LockMode = 'Exclusive', @LockOwner = 'Transaction'",
+        sqlite="BEGIN IMMEDIATE")
+
+    migration.execute(
+        sqlserver="IF OBJECT_ID('schema_version', 'U') IS NULL "
+                  "CREATE TABLE schema_version (version INT PRIMARY KEY, name VARCHAR(200) NOT NULL, applied_at BIGINT NOT NULL)",
+        sqlite="CREATE TABLE IF NOT EXISTS schema_version "
+               "(version INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL, applied_at BIGINT NOT NULL)")
+
+
+def migrate(pool=None, target=None, directory=MIGRATIONS_DIR) -> list:
+    """
+    Applies every pending migration up to target (all of them by default).
+
+    Args:
+        pool (db.ConnectionPool | None): Pool to migrate; defaults to db.get_pool().
+        target (int | None): Highest version to apply.
+
+    Returns:
+        list: The (version, name) of each migration applied.
+    """
+
+    pool = pool or db.get_pool()
+    migrations = [entry for entry in discover(directory) if target is None or entry[0] <= target]
+
+    with pool.connection() as connection:
+        migration = Migration(connection, pool.backend.dialect)
+
+        # Fast path: nothing to do, so no lock is taken
+        if {version for version, _, _ in migrations} <= _applied_versions(migration):
+            return []
+
+        connection.rollback()
+        _lock(migration)
+
+        try:
+            applied = _applied_versions(migration)
+            done = []
+
+            for version, name, path in migrations:
+                if version in applied:
+                    continue
+
+                _load(version, path).up(migration)
+                migration.execute('INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                                  params=(version, name, int(time.time())))
+                done.append((version, name))
+
+            connection.commit()
+            return done
+
+        except BaseException:
+            connection.rollback()
+            raise
+
+
+def status(pool=None, directory=MIGRATIONS_DIR) -> list:
+    """
+    Returns (version, name, applied) for every migration.
+    """
+
+    pool = pool or db.get_pool()
+
+    with pool.connection() as connection:
+        applied = _applied_versions(Migration(connection, pool.backend.dialect))
+
+    return [(version, name, version in applied) for version, name, _ in discover(directory)]
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Apply the database schema migrations.")
+    parser.add_argument("--status", action="store_true", help="List migrations instead of applying them")
+    parser.add_argument("--target", type=int, help="Highest migration version to apply")
+    args = parser.parse_args(argv)
+
+    # The main database, then every shard of either layout when sharding is on
+    databases = [("main", db.BACKENDS[config.DB_BACKEND]())]
+    if config.DB_SHARDS:
+        current, previous = shards.configured_backends()
+        databases += [(f"shard {name}", backend) for name, backend in dict(previous or {}, **current).items()]
+
+    for label, backend in databases:
+        if len(databases) > 1:
+            print(f"== {label}")
+
+        # The runner applies migrations itself, so the pool must not do it on creation
+        pool = db.ConnectionPool(backend, min_size=0, max_size=1)
+
+        try:
+            if args.status:
+                for version, name, applied in status(pool):
+                    print(f"{version:04d} {name:<40} {'applied' if applied else 'pending'}")
+                continue
+
+            done = migrate(pool, args.target)
+            for version, name in done:
+                print(f"Applied {version:04d} {name}")
+            print(f"{len(done)} migration(s) applied")
+
+        finally:
+            pool.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,179 @@
+"""
+This module throttles log_in and forgot_password so they cannot be used to burn CPU
+on bcrypt or to flood inboxes.
+
+Two independent mechanisms are used:
+
+- Token buckets per email and per source (e.g. a client address), checked in O(1)
+  before any database query, bcrypt check or email. Buckets refill continuously; a
+  bucket that has refilled completely carries no information, so it is dropped, and
+  the number of tracked keys is capped with LRU eviction to keep memory bounded.
+- Progressive account lockout after repeated wrong passwords. The failure count and
+  lock expiry live in LoginInformation next to the password hash, so they survive
+  restarts and are shared by every process, and they are read by the same query that
+  loads the hash.
+"""
+
+import math, threading, time
+from collections import OrderedDict
+import config, metrics
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter keyed by an arbitrary string.
+
+    Each key may spend limit tokens in a burst, and tokens come back at limit/period
+    per second.
+
+    Args:
+        limit (int): Bucket size, i.e. requests allowed in a burst.
+        period (float): Seconds it takes an empty bucket to refill completely.
+        max_keys (int): Most keys tracked; the least recently used are dropped beyond this.
+    """
+
+    def __init__(self, limit, period, max_keys=100_000) -> None:
+        self.limit = limit
+        self.period = period
+        self.rate = limit / period
+        self.max_keys = max_keys
+
+        self._buckets = OrderedDict()  # key -> [tokens, last_refill], least recently used first
+        self._lock = threading.Lock()
+
+    def allow(self, key, cost=1.0) -> bool:
+        """
+        Takes cost tokens from key's bucket.
+
+        Returns:
+            bool: True if the request is within the limit, False if it should be rejected.
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.limit), now]
+                self._expire(now)
+            else:
+                bucket[0] = min(self.limit, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+
+            if bucket[0] < cost:
+                return False
+
+            bucket[0] -= cost
+            return True
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _expire(self, now) -> None:
+        # Must be called with the lock held. Drops refilled buckets from the old end, then
+        # the least recently used ones if there are still too many keys.
+        buckets = self._buckets
+
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            if now - oldest[1] < self.period and len(buckets) <= self.max_keys:
+                break
+            buckets.popitem(last=False)
+
+
+def _limiter(setting) -> RateLimiter | None:
+    # Settings look like "5/60" (5 requests per 60 seconds); "0" turns the limit off
+    limit, _, period = setting.partition("/")
+    if not int(limit):
+        return None
+    return RateLimiter(int(limit), float(period or 60), config.RATE_LIMIT_MAX_KEYS)
+
+
+# (flow, scope) -> limiter, where scope is "email" or "source"; built by _limiters()
+LIMITERS = {}
+_limiters_settings = None
+_limiters_lock = threading.Lock()
+
+
+def _limiters() -> dict:
+    # Rebuilt whenever the settings differ from the ones LIMITERS was built from, e.g.
+    # after config.reload(); rebuilding starts every bucket full
+    global LIMITERS, _limiters_settings
+
+    settings = (config.RATE_LIMIT_LOGIN_EMAIL, config.RATE_LIMIT_LOGIN_SOURCE, config.RATE_LIMIT_RESET_EMAIL,
+                config.RATE_LIMIT_RESET_SOURCE, config.RATE_LIMIT_MAX_KEYS)
+
+    if settings != _limiters_settings:
+        with _limiters_lock:
+            if settings != _limiters_settings:
+                LIMITERS = {
+                    ("login", "email"): _limiter(config.RATE_LIMIT_LOGIN_EMAIL),
+                    ("login", "source"): _limiter(config.RATE_LIMIT_LOGIN_SOURCE),
+                    ("reset", "email"): _limiter(config.RATE_LIMIT_RESET_EMAIL),
+                    ("reset", "source"): _limiter(config.RATE_LIMIT_RESET_SOURCE),
+                }
+                _limiters_settings = settings
+    return LIMITERS
+
+
+def allow(flow, email, source=None) -> bool:
+    """
+    Checks a login or reset attempt against the per-source and per-email limits.
+
+    Args:
+        flow (str): "login" or "reset".
+        email (str): The email the attempt is for. Case and surrounding spaces are ignored,
+                     as they are by the account lookup, so each account has one bucket.
+        source (str | None): Where the attempt comes from, e.g. a client address. The
+                             interactive CLI has no meaningful source and passes None.
+
+    Returns:
+        bool: True if the attempt may go ahead, False if it is over a limit.
+    """
+
+    limiters = _limiters()
+    email = email.strip().lower() if email is not None else None
+
+    for scope, key in (("source", source), ("email", email)):
+        limiter = limiters.get((flow, scope))
+
+        if limiter is not None and key is not None and not limiter.allow(key):
+            metrics.count("rate_limit_rejections_total", flow=flow, scope=scope)
+            return False
+
+    return True
+
+
+def locked_for(record, now=None) -> float:
+    """
+    Returns how many seconds an account stays locked, or 0 if it is not locked.
+
+    Args:
+        record (users.UserRecord): The account's record.
+    """
+
+    if not record.locked_until:
+        return 0.0
+    return max(0.0, record.locked_until - (now or time.time()))
+
+
+def lock_until(failures, now=None) -> int | None:
+    """
+    Returns when an account should unlock after failures consecutive wrong passwords.
+
+    Accounts are locked once failures reaches LOCKOUT_THRESHOLD; every further failure
+    doubles the lock, from LOCKOUT_BASE_SECONDS up to LOCKOUT_MAX_SECONDS.
+
+    Returns:
+        int | None: Unix time the lock ends, or None if the account should not be locked.
+    """
+
+    if not config.LOCKOUT_THRESHOLD or failures < config.LOCKOUT_THRESHOLD:
+        return None
+
+    # The exponent is capped so a long run of failures cannot overflow the float
+    doublings = min(failures - config.LOCKOUT_THRESHOLD, 32)
+    delay = min(config.LOCKOUT_MAX_SECONDS, config.LOCKOUT_BASE_SECONDS * 2 ** doublings)
+    return math.ceil((now or time.time()) + delay)
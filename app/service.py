@@ -0,0 +1,201 @@
+"""
+This module provides the asyncio login service used by non-interactive clients.
+
+The account flows themselves are in flows.py, shared with the CLI; the service is the
+runner they do their blocking work through. bcrypt runs on the hashing engine's process
+pool, database calls run on a bounded thread pool sized to the connection pool, and
+emails are handed to the background mailer, so the coroutines never block the event
+loop and one process can keep hundreds of logins in flight at the same time.
+"""
+
+import asyncio
+import codes, config, flows, hashing, mailer, sessions
+from concurrent.futures import ThreadPoolExecutor
+# The flows' result statuses, so clients of the service can compare against service.OK etc.
+from flows import (OK, UNKNOWN_EMAIL, BAD_PASSWORD, TWO_FA_REQUIRED, BAD_CODE, CODE_SENT, ACCOUNT_EXISTS,
+                   ALREADY_ENABLED, INVALID_EMAIL, INVALID_PASSWORD, RATE_LIMITED, LOCKED)
+
+
+class LoginService:
+    """
+    Async front end over the account flows in flows.py.
+
+    Use it as an async context manager so the worker pool is started and shut down
+    cleanly:
+
+        async with LoginService() as service:
+            status = await service.login(email, password)
+
+    Args:
+        db_workers (int): Threads running blocking database calls.
+        hash_engine (hashing.HashEngine): Engine running bcrypt; defaults to hashing.get_engine().
+        mail (mailer.Mailer): Mailer delivering codes; defaults to mailer.get_mailer().
+        code_store: Verification code store; defaults to codes.get_store().
+        session_store: Session store; defaults to sessions.get_store().
+    """
+
+    def __init__(self, db_workers=None, hash_engine=None, mail=None, code_store=None, session_store=None) -> None:
+        self.db_workers = db_workers or config.SERVICE_DB_WORKERS
+        self.hash_engine = hash_engine or hashing.get_engine()
+        self.mail = mail or mailer.get_mailer()
+        self.code_store = code_store or codes.get_store()
+        self.session_store = session_store or sessions.get_store()
+
+        self._db_executor = None
+
+    async def start(self) -> None:
+        """
+        Starts the database worker pool and makes the hash unknown-email logins are checked
+        against on the bcrypt pool, so the first of them does not hash on the event loop.
+        """
+
+        self._db_executor = ThreadPoolExecutor(self.db_workers, thread_name_prefix="login-db")
+        await self._hash(self.hash_engine.submit_dummy_hash())
+
+    async def close(self) -> None:
+        """
+        Waits for queued emails to be delivered, then shuts the worker pool down.
+        """
+
+        await asyncio.to_thread(self.mail.flush)
+        self._db_executor.shutdown()
+
+    async def __aenter__(self) -> "LoginService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def register(self, email, password) -> str:
+        """
+        Creates a new account; see flows.register().
+        """
+
+        return await flows.register(self, email, password)
+
+    async def login(self, email, password, source=None, code=None, email_code=False) -> str:
+        """
+        Checks an email and password. If the account has email 2FA enabled, a code is
+        emailed and must be confirmed with verify_2fa() to finish logging in.
+
+        Accounts enrolled in an authenticator app send the app's code (or a backup code)
+        along with the password, so the login finishes in one call. Without a code they
+        get TWO_FA_REQUIRED, and with email_code set they are emailed a code for
+        verify_2fa() instead, as a fallback for users without their app. See flows.login().
+
+        Args:
+            source (str | None): Client address or other origin, used for per-source rate limits.
+            code (str | None): Authenticator or backup code, for accounts enrolled in an app.
+            email_code (bool): Email a code instead of checking an authenticator code.
+
+        Returns:
+            str: OK, TWO_FA_REQUIRED, BAD_PASSWORD, BAD_CODE, UNKNOWN_EMAIL, RATE_LIMITED or LOCKED.
+        """
+
+        return await flows.login(self, email, password, source, code, email_code)
+
+    async def verify_2fa(self, email, code, source=None) -> str:
+        """
+        Finishes a 2FA login with the code emailed by login(); see flows.verify_2fa().
+        """
+
+        return await flows.verify_2fa(self, email, code, source)
+
+    async def request_reset(self, email, source=None) -> str:
+        """
+        Emails a password reset code to a registered account; see flows.request_reset().
+        """
+
+        return await flows.request_reset(self, email, source)
+
+    async def reset_password(self, email, code, new_password) -> str:
+        """
+        Sets a new password using the code emailed by request_reset(); see flows.reset_password().
+        """
+
+        return await flows.reset_password(self, email, code, new_password)
+
+    async def enable_2fa(self, email) -> str:
+        """
+        Turns on emailed 2FA codes for an account; see flows.enable_2fa().
+        """
+
+        return await flows.enable_2fa(self, email)
+
+    async def new_totp_secret(self, email) -> tuple:
+        """
+        Creates a secret for enrolling an account in an authenticator app; see flows.new_totp_secret().
+        """
+
+        return await flows.new_totp_secret(self, email)
+
+    async def enable_totp(self, email, secret, code) -> tuple:
+        """
+        Turns on authenticator-app 2FA once code matches secret; see flows.enable_totp().
+        """
+
+        return await flows.enable_totp(self, email, secret, code)
+
+    async def update_password(self, email, new_password) -> str:
+        """
+        Replaces the password of a logged-in user; see flows.update_password().
+        """
+
+        return await flows.update_password(self, email, new_password)
+
+    async def change_email(self, email, new_email) -> str:
+        """
+        Moves an account to a new email and ends its old sessions; see flows.change_email().
+        """
+
+        return await flows.change_email(self, email, new_email)
+
+    async def delete_account(self, email, password) -> str:
+        """
+        Deletes an account after checking its password once more; see flows.delete_account().
+        """
+
+        return await flows.delete_account(self, email, password)
+
+    async def start_session(self, email) -> str:
+        """
+        Starts a session for an authenticated user and returns its token.
+        """
+
+        return await self.db(self.session_store.create, email)
+
+    async def session_user(self, token) -> str | None:
+        """
+        Returns the email a session token belongs to, or None if it is not valid.
+        """
+
+        return await self.db(self.session_store.get, token)
+
+    async def end_session(self, token, email=None) -> None:
+        """
+        Ends one session. Pass the session's email to record the logout in the audit log.
+        """
+
+        await flows.end_session(self, token, email)
+
+    # The runner interface the flows do their blocking work through
+
+    async def db(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, function, *args)
+
+    async def check_password(self, password, stored_hash) -> bool:
+        return await self._hash(self.hash_engine.submit_check(password, stored_hash))
+
+    async def hash_password(self, password) -> str:
+        return await self._hash(self.hash_engine.submit_hash(password))
+
+    async def dummy_check(self, password) -> bool:
+        return await self.check_password(password, self.hash_engine.dummy_hash)
+
+    async def send_email(self, receiver_email, subject, message) -> None:
+        # Only waits if the mailer's queue is full
+        await asyncio.to_thread(self.mail.submit, receiver_email, subject, message)
+
+    async def _hash(self, future):
+        return await asyncio.wrap_future(future)
@@ -0,0 +1,265 @@
+"""
+This module issues and validates login sessions.
+
+A session is an opaque random token mapped to the user's email. Sessions expire after
+SESSION_IDLE_TIMEOUT seconds without use (sliding expiry) and SESSION_MAX_LIFETIME
+seconds after login (absolute expiry).
+
+MemorySessionStore spreads sessions over independently locked shards, each an LRU
+ordered dict, so lookups are O(1) and concurrent requests rarely contend on a lock.
+Revoking all of a user's sessions records the time, and sessions created before it
+are rejected, which is O(1) however many sessions they have; the record is dropped
+once SESSION_MAX_LIFETIME has passed, so it cannot outlive the sessions it revokes.
+SqliteSessionStore keeps a generation number per user, stamped on their sessions, in
+a shared file so several worker processes can validate the same sessions.
+"""
+
+import math, secrets, sqlite3, threading, time
+from collections import OrderedDict
+import config
+
+
+def new_token() -> str:
+    """
+    Returns a new unguessable session token.
+    """
+
+    return secrets.token_urlsafe(32)
+
+
+class MemorySessionStore:
+    """
+    Sharded in-process session store with LRU eviction.
+
+    Args:
+        idle_timeout (float): Seconds a session survives without being used.
+        max_lifetime (float): Seconds a session survives after it was created.
+        shards (int): Number of independently locked shards.
+        max_sessions (int): Most sessions kept; the least recently used are evicted beyond this.
+    """
+
+    def __init__(self, idle_timeout=1800.0, max_lifetime=43200.0, shards=16, max_sessions=100_000) -> None:
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.shard_capacity = max(1, max_sessions // shards)
+
+        self._shards = [(OrderedDict(), threading.Lock()) for _ in range(shards)]
+        # email -> when its sessions were last revoked, oldest first. An entry is dropped once
+        # max_lifetime has passed, since every session it revoked has expired by then.
+        self._revoked = OrderedDict()
+        self._revoked_lock = threading.Lock()
+
+    def create(self, email) -> str:
+        """
+        Starts a session for email.
+
+        Returns:
+            str: The session token.
+        """
+
+        token = new_token()
+        now = time.monotonic()
+        sessions, lock = self._shard(token)
+
+        with lock:
+            # [email, created_at, last_seen]
+            sessions[token] = [email, now, now]
+
+            if len(sessions) > self.shard_capacity:
+                sessions.popitem(last=False)
+
+        return token
+
+    def get(self, token) -> str | None:
+        """
+        Returns the email for a live session and extends its idle expiry, or None if the
+        token is unknown, expired or revoked.
+        """
+
+        if not token:
+            return None
+
+        now = time.monotonic()
+        sessions, lock = self._shard(token)
+
+        with lock:
+            entry = sessions.get(token)
+            if entry is None:
+                return None
+
+            email, created_at, last_seen = entry
+
+            if (now - last_seen > self.idle_timeout or now - created_at > self.max_lifetime
+                    or created_at <= self._revoked.get(email, -math.inf)):
+                del sessions[token]
+                return None
+
+            entry[2] = now
+            sessions.move_to_end(token)
+            return email
+
+    def revoke(self, token) -> None:
+        """
+        Ends one session.
+        """
+
+        if token:
+            sessions, lock = self._shard(token)
+            with lock:
+                sessions.pop(token, None)
+
+    def revoke_user(self, email) -> None:
+        """
+        Ends every session belonging to email in O(1). The revoked entries are dropped
+        lazily when they are next looked up or evicted.
+        """
+
+        now = time.monotonic()
+
+        with self._revoked_lock:
+            self._revoked[email] = now
+            self._revoked.move_to_end(email)
+
+            # Forget revocations older than any session could live
+            while next(iter(self._revoked.values())) < now - self.max_lifetime:
+                self._revoked.popitem(last=False)
+
+    def __len__(self) -> int:
+        return sum(len(sessions) for sessions, _ in self._shards)
+
+    def _shard(self, token) -> tuple:
+        return self._shards[hash(token) % len(self._shards)]
+
+
+class SqliteSessionStore:
+    """
+    Session store in a shared sqlite file so every worker process on a host sees the
+    same sessions.
+
+    Lookups use the token primary key, revoking a user updates one row of a generation
+    table, and expired sessions are removed with an indexed range delete. To keep reads
+    cheap, a session's last-seen time is only written back once it is touch_interval old.
+
+    Args:
+        path (str): Path of the sqlite file shared by the workers.
+        idle_timeout (float): Seconds a session survives without being used.
+        max_lifetime (float): Seconds a session survives after it was created.
+    """
+
+    def __init__(self, path, idle_timeout=1800.0, max_lifetime=43200.0) -> None:
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.touch_interval = min(60.0, idle_timeout / 10)
+
+        self._path = path
+        self._local = threading.local()
+
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, email TEXT NOT NULL, '
+                               'created_at REAL NOT NULL, last_seen REAL NOT NULL, generation INTEGER NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)')
+            connection.execute('CREATE TABLE IF NOT EXISTS session_generations (email TEXT PRIMARY KEY, generation INTEGER NOT NULL)')
+
+    def create(self, email) -> str:
+        """
+        Starts a session for email.
+
+        Returns:
+            str: The session token.
+        """
+
+        token = new_token()
+        now = time.time()
+        connection = self._connection()
+
+        with connection:
+            connection.execute('DELETE FROM sessions WHERE last_seen < ?', (now - self.idle_timeout,))
+            connection.execute('INSERT INTO sessions (token, email, created_at, last_seen, generation) '
+                               'SELECT ?, ?, ?, ?, COALESCE((SELECT generation FROM session_generations WHERE email = ?), 0)',
+                               (token, email, now, now, email))
+
+        return token
+
+    def get(self, token) -> str | None:
+        """
+        Returns the email for a live session and extends its idle expiry, or None if the
+        token is unknown, expired or revoked.
+        """
+
+        if not token:
+            return None
+
+        now = time.time()
+        connection = self._connection()
+
+        row = connection.execute('SELECT s.email, s.created_at, s.last_seen, s.generation, COALESCE(g.generation, 0) '
+                                 'FROM sessions s LEFT JOIN session_generations g ON g.email = s.email '
+                                 'WHERE s.token = ?', (token,)).fetchone()
+        if row is None:
+            return None
+
+        email, created_at, last_seen, generation, current_generation = row
+
+        with connection:
+            if (now - last_seen > self.idle_timeout or now - created_at > self.max_lifetime
+                    or generation != current_generation):
+                connection.execute('DELETE FROM sessions WHERE token = ?', (token,))
+                return None
+
+            if now - last_seen > self.touch_interval:
+                connection.execute('UPDATE sessions SET last_seen = ? WHERE token = ?', (now, token))
+
+        return email
+
+    def revoke(self, token) -> None:
+        """
+        Ends one session.
+        """
+
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM sessions WHERE token = ?', (token,))
+
+    def revoke_user(self, email) -> None:
+        """
+        Ends every session belonging to email by bumping the user's generation.
+        """
+
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT INTO session_generations (email, generation) VALUES (?, 1) '
+                               'ON CONFLICT (email) DO UPDATE SET generation = generation + 1', (email,))
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite handles locking between processes
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self._path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+
+        return connection
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the process-wide session store selected by SESSION_STORE ("memory" or "sqlite").
+    """
+
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if config.SESSION_STORE == "sqlite":
+                    _store = SqliteSessionStore(config.SESSION_STORE_PATH, config.SESSION_IDLE_TIMEOUT,
+                                                config.SESSION_MAX_LIFETIME)
+                else:
+                    _store = MemorySessionStore(config.SESSION_IDLE_TIMEOUT, config.SESSION_MAX_LIFETIME,
+                                                config.SESSION_SHARDS, config.SESSION_MAX_SESSIONS)
+    return _store
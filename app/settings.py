@@ -0,0 +1,163 @@
+"""
+This module defines every setting and its default. It is imported by config.load()
+once the .env file has been read; use config.<NAME> rather than importing it directly.
+"""
+
+import os
+
+# E-Mail variables
+SENDER_EMAIL = os.getenv("SENDER_EMAIL")
+SENDER_PASSWORD = os.getenv("SENDER_PASSWORD")
+
+# SMTP server variables (SMTP_USE_SSL=false for a local fake server)
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_USE_SSL = os.getenv("SMTP_USE_SSL", "true").lower() == "true"
+
+# Mail delivery queue variables
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", "2"))
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", "1000"))
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "20"))
+MAIL_MAX_RETRIES = int(os.getenv("MAIL_MAX_RETRIES", "3"))
+
+# Database variables
+DB_SERVER = os.getenv("DB_SERVER")
+DB_DATABASE = os.getenv("DB_DATABASE")
+
+# Database backend ("pyodbc" for SQL Server, "sqlite" for a local stand-in database)
+DB_BACKEND = os.getenv("DB_BACKEND", "pyodbc")
+DB_SQLITE_PATH = os.getenv("DB_SQLITE_PATH", "LoginSimulator.db")
+
+# Database resilience variables: login and statement timeouts in seconds, retries of
+# failed reads, and the circuit breaker that fails fast after DB_BREAKER_THRESHOLD
+# consecutive failures until DB_BREAKER_RESET seconds have passed
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_QUERY_TIMEOUT = int(os.getenv("DB_QUERY_TIMEOUT", "10"))
+DB_READ_RETRIES = int(os.getenv("DB_READ_RETRIES", "2"))
+DB_RETRY_BACKOFF = float(os.getenv("DB_RETRY_BACKOFF", "0.05"))
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+DB_BREAKER_RESET = float(os.getenv("DB_BREAKER_RESET", "10"))
+
+# Sharding variables: DB_SHARDS lists the LoginInformation shards as "name=target,..."
+# (a file path per shard for sqlite, "server/database" for pyodbc); empty turns sharding
+# off. DB_SHARDS_PREVIOUS holds the old layout while shards.py rebalance moves rows.
+DB_SHARDS = os.getenv("DB_SHARDS", "")
+DB_SHARDS_PREVIOUS = os.getenv("DB_SHARDS_PREVIOUS", "")
+DB_SHARD_VNODES = int(os.getenv("DB_SHARD_VNODES", "160"))
+DB_SHARD_BATCH_SIZE = int(os.getenv("DB_SHARD_BATCH_SIZE", "500"))
+
+# Apply pending schema migrations when the connection pool is created
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() == "true"
+
+# Connection pool variables
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", "300"))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "30"))
+
+# Async login service variables
+SERVICE_DB_WORKERS = int(os.getenv("SERVICE_DB_WORKERS", str(DB_POOL_MAX_SIZE)))
+SERVICE_HASH_WORKERS = int(os.getenv("SERVICE_HASH_WORKERS", "0"))  # 0 means one per CPU
+
+# Password hashing variables ("auto" calibrates the cost factor against BCRYPT_TARGET_MS)
+BCRYPT_ROUNDS = os.getenv("BCRYPT_ROUNDS", "12")
+BCRYPT_TARGET_MS = float(os.getenv("BCRYPT_TARGET_MS", "250"))
+
+# Verification code variables (CODE_STORE=sqlite shares codes between worker processes)
+CODE_STORE = os.getenv("CODE_STORE", "memory")
+CODE_STORE_PATH = os.getenv("CODE_STORE_PATH", "verification_codes.db")
+CODE_TTL = float(os.getenv("CODE_TTL", "600"))
+CODE_MAX_ATTEMPTS = int(os.getenv("CODE_MAX_ATTEMPTS", "5"))
+CODE_MAX_ENTRIES = int(os.getenv("CODE_MAX_ENTRIES", "100000"))
+CODE_DIGITS = int(os.getenv("CODE_DIGITS", "6"))
+
+# Authenticator-app 2FA variables (TOTP_WINDOW is how many 30-second steps either side
+# of the current one are accepted; TOTP_BACKUP_CODES is how many are issued at enrolment)
+TOTP_ISSUER = os.getenv("TOTP_ISSUER", "LoginSimulator")
+TOTP_WINDOW = int(os.getenv("TOTP_WINDOW", "1"))
+TOTP_BACKUP_CODES = int(os.getenv("TOTP_BACKUP_CODES", "10"))
+
+# Password policy variables (by default a password only has to be non-empty)
+PASSWORD_MIN_LENGTH = int(os.getenv("PASSWORD_MIN_LENGTH", "1"))
+PASSWORD_MAX_LENGTH = int(os.getenv("PASSWORD_MAX_LENGTH", "0"))  # UTF-8 bytes; 0 or over 72 means bcrypt's 72
+PASSWORD_MIN_CLASSES = int(os.getenv("PASSWORD_MIN_CLASSES", "0"))
+PASSWORD_BREACH_FILE = os.getenv("PASSWORD_BREACH_FILE")  # Built with breached.py
+
+# Metrics variables (METRICS_PORT serves Prometheus text at /metrics; 0 turns it off)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_DUMP_PATH = os.getenv("METRICS_DUMP_PATH")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "60"))
+
+# Session variables (SESSION_STORE=sqlite shares sessions between worker processes)
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.db")
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "1800"))
+SESSION_MAX_LIFETIME = float(os.getenv("SESSION_MAX_LIFETIME", "43200"))
+SESSION_SHARDS = int(os.getenv("SESSION_SHARDS", "16"))
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "100000"))
+
+# Rate limit variables, as "<requests>/<seconds>" per email or per source; "0" turns a limit off
+RATE_LIMIT_LOGIN_EMAIL = os.getenv("RATE_LIMIT_LOGIN_EMAIL", "10/60")
+RATE_LIMIT_LOGIN_SOURCE = os.getenv("RATE_LIMIT_LOGIN_SOURCE", "100/60")
+RATE_LIMIT_RESET_EMAIL = os.getenv("RATE_LIMIT_RESET_EMAIL", "3/900")
+RATE_LIMIT_RESET_SOURCE = os.getenv("RATE_LIMIT_RESET_SOURCE", "20/900")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# Account lockout variables (LOCKOUT_THRESHOLD=0 turns lockout off)
+LOCKOUT_THRESHOLD = int(os.getenv("LOCKOUT_THRESHOLD", "5"))
+LOCKOUT_BASE_SECONDS = float(os.getenv("LOCKOUT_BASE_SECONDS", "30"))
+LOCKOUT_MAX_SECONDS = float(os.getenv("LOCKOUT_MAX_SECONDS", "3600"))
+
+# Unknown-email filter variables (set EMAIL_FILTER=false if other processes create accounts
+# and a login must see them before the next EMAIL_FILTER_REFRESH)
+EMAIL_FILTER = os.getenv("EMAIL_FILTER", "true").lower() == "true"
+EMAIL_FILTER_CAPACITY = int(os.getenv("EMAIL_FILTER_CAPACITY", "100000"))
+EMAIL_FILTER_ERROR_RATE = float(os.getenv("EMAIL_FILTER_ERROR_RATE", "0.01"))
+EMAIL_FILTER_REFRESH = float(os.getenv("EMAIL_FILTER_REFRESH", "300"))
+
+# User record cache variables (USER_CACHE_TTL bounds how long another process's writes go unseen)
+USER_CACHE = os.getenv("USER_CACHE", "true").lower() == "true"
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+
+# HTTP API variables (API_WORKERS=0 starts one worker per CPU)
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8080"))
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+API_KEEPALIVE_TIMEOUT = float(os.getenv("API_KEEPALIVE_TIMEOUT", "15"))
+API_MAX_BODY = int(os.getenv("API_MAX_BODY", "65536"))
+API_REQUEST_TIMEOUT = float(os.getenv("API_REQUEST_TIMEOUT", "10"))
+
+# API supervisor variables (API_MAX_REQUESTS=0 never recycles workers; API_STATS_PATH
+# rewrites a JSON file with the per-worker statistics every API_STATS_INTERVAL seconds)
+API_MAX_REQUESTS = int(os.getenv("API_MAX_REQUESTS", "0"))
+API_MAX_REQUESTS_JITTER = int(os.getenv("API_MAX_REQUESTS_JITTER", "0"))
+API_GRACEFUL_TIMEOUT = float(os.getenv("API_GRACEFUL_TIMEOUT", "30"))
+API_STATS_INTERVAL = float(os.getenv("API_STATS_INTERVAL", "10"))
+API_STATS_PATH = os.getenv("API_STATS_PATH")
+
+# Audit log variables (AUDIT_SINK is "db" or "file"; AUDIT_ON_FULL is "drop_oldest",
+# "drop_newest" or "block")
+AUDIT_LOG = os.getenv("AUDIT_LOG", "true").lower() == "true"
+AUDIT_SINK = os.getenv("AUDIT_SINK", "db")
+AUDIT_FILE = os.getenv("AUDIT_FILE", "audit.jsonl")
+AUDIT_BUFFER_SIZE = int(os.getenv("AUDIT_BUFFER_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "100"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1"))
+AUDIT_ON_FULL = os.getenv("AUDIT_ON_FULL", "drop_oldest")
+
+# Credential snapshot variables (SNAPSHOT_PATH="" turns the degraded-mode fallback off;
+# SNAPSHOT_MAX_AGE=0 accepts a snapshot of any age)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "86400"))
+SNAPSHOT_REFRESH_INTERVAL = float(os.getenv("SNAPSHOT_REFRESH_INTERVAL", "300"))
+SNAPSHOT_CHANGE_RETENTION = float(os.getenv("SNAPSHOT_CHANGE_RETENTION", "604800"))
+SNAPSHOT_SORT_CHUNK = int(os.getenv("SNAPSHOT_SORT_CHUNK", "100000"))
+
+# Notification campaign variables (CAMPAIGN_RATE is messages per second over all
+# CAMPAIGN_SESSIONS; 0 sends as fast as the server accepts)
+CAMPAIGN_DIR = os.getenv("CAMPAIGN_DIR", "campaigns")
+CAMPAIGN_RATE = float(os.getenv("CAMPAIGN_RATE", "10"))
+CAMPAIGN_SESSIONS = int(os.getenv("CAMPAIGN_SESSIONS", "4"))
+CAMPAIGN_BATCH_SIZE = int(os.getenv("CAMPAIGN_BATCH_SIZE", "500"))
@@ -0,0 +1,449 @@
+"""
+This module spreads the LoginInformation table over several databases (shards).
+
+Each email is routed to one shard by consistent hashing: every shard owns many points
+(virtual nodes) on a hash ring, and an email belongs to the shard owning the first point
+at or after the email's hash. Adding a shard to N existing ones therefore only moves
+about 1/(N+1) of the accounts, all of them onto the new shard. Emails are hashed in
+lower case, so every spelling of an address lands on the same shard.
+
+Every shard has its own connection pool and circuit breaker, so one shard being down
+only affects the accounts stored on it. Sharding is off unless DB_SHARDS lists the
+shards; the audit log and other tables stay on the main database from db.get_pool().
+
+To add or remove shards while the application keeps running:
+
+    1. Set DB_SHARDS to the new layout and DB_SHARDS_PREVIOUS to the old one, then
+       restart the application.
+    2. Run "python shards.py rebalance". It moves the misplaced rows in batches.
+    3. Once it reports nothing left to move, remove DB_SHARDS_PREVIOUS and restart.
+
+While DB_SHARDS_PREVIOUS is set, a statement for an email whose shard changed between
+the layouts runs on its old shard first and, if that finds no row, on its new one. Only
+those emails can pay for a second statement; all others go straight to their shard.
+
+Usage:
+    python shards.py status
+    python shards.py rebalance --batch-size 500 --pause 0.05
+"""
+
+import argparse, bisect, hashlib, json, sys, threading, time
+import config, db, metrics
+
+# Builds a shard's backend from the target given for it in DB_SHARDS
+SHARD_BACKENDS = {
+    "pyodbc": lambda target: db.PyodbcBackend(*target.split("/", 1), config.DB_CONNECT_TIMEOUT, config.DB_QUERY_TIMEOUT),
+    "sqlite": lambda target: db.SqliteBackend(target, config.DB_QUERY_TIMEOUT),
+}
+
+# Keyset-paginated scan used by the rebalancer, per dialect
+SCAN = {
+    "sqlserver": 'SELECT TOP (?) email FROM LoginInformation WHERE email > ? ORDER BY email',
+    "sqlite": 'SELECT email FROM LoginInformation WHERE email > ? ORDER BY email LIMIT ?',
+}
+
+# Largest number of parameters SQL Server accepts in one statement
+MAX_PARAMETERS = 2100
+
+# Held while rows move between shards; two moves in opposite directions would each hold
+# the lock the other one needs
+_move_lock = threading.Lock()
+
+
+def _hash(key) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring mapping keys to shard names.
+
+    Args:
+        names (list): The shard names.
+        vnodes (int): Points each shard owns on the ring; more points spread keys more evenly.
+    """
+
+    def __init__(self, names, vnodes=160) -> None:
+        if not names:
+            raise ValueError("A hash ring needs at least one shard")
+
+        points = sorted((_hash(f"{name}#{index}"), name) for name in names for index in range(vnodes))
+        self.names = tuple(sorted(set(names)))
+        self._hashes = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    def owner(self, key) -> str:
+        """
+        Returns the name of the shard that owns key.
+        """
+
+        index = bisect.bisect_left(self._hashes, _hash(key.lower()))
+        return self._owners[index % len(self._owners)]
+
+
+class ShardSet:
+    """
+    The shard pools and the ring routing emails to them.
+
+    Args:
+        pools (dict): Shard name -> db.ConnectionPool for every shard of either layout.
+        current (list): Names of the shards in the current layout.
+        previous (list | None): Names of the shards in the layout being rebalanced away from.
+        vnodes (int): Points each shard owns on the rings.
+    """
+
+    def __init__(self, pools, current, previous=None, vnodes=160) -> None:
+        missing = (set(current) | set(previous or ())) - set(pools)
+        if missing:
+            raise ValueError(f"No pool for shard(s): {', '.join(sorted(missing))}")
+
+        self.pools = dict(pools)
+        self.ring = HashRing(current, vnodes)
+        self.previous_ring = HashRing(previous, vnodes) if previous else None
+
+    def owner(self, email) -> str:
+        return self.ring.owner(email)
+
+    def candidates(self, email) -> list:
+        """
+        Returns the pools that may hold email's row, in the order to try them. During a
+        rebalance, an email whose shard changed may still be on its old shard, which is
+        tried first: rows are committed on their new shard before they are deleted from
+        the old one, so a row missing from the old shard is already on the new one.
+        """
+
+        owner = self.pools[self.ring.owner(email)]
+        if self.previous_ring is None:
+            return [owner]
+
+        previous_owner = self.pools[self.previous_ring.owner(email)]
+        return [owner] if previous_owner is owner else [previous_owner, owner]
+
+    def close(self) -> None:
+        for pool in self.pools.values():
+            pool.close()
+
+
+@db.idempotent
+def holds(pool, email) -> bool:
+    """
+    Returns True if the database behind pool has a LoginInformation row for email.
+    """
+
+    with pool.connection() as connection:
+        return bool(db.execute(connection, 'SELECT 1 FROM LoginInformation WHERE email = ?', (email,)).fetchall())
+
+
+def parse(spec) -> dict:
+    """
+    Parses a shard list such as "a=shard_a.db,b=shard_b.db" into {name: target}. With
+    the pyodbc backend, a target is "server/database".
+
+    Raises:
+        ValueError: If an entry has no name or target, or a name is used twice.
+    """
+
+    shards = {}
+
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, target = entry.partition("=")
+        name, target = name.strip(), target.strip()
+
+        if not name or not target:
+            raise ValueError(f"Shard entry '{entry}' must look like name=target")
+        if name in shards:
+            raise ValueError(f"Shard '{name}' is listed twice")
+
+        shards[name] = target
+
+    return shards
+
+
+def configured_backends() -> tuple:
+    """
+    Builds the backends listed in DB_SHARDS and DB_SHARDS_PREVIOUS.
+
+    Returns:
+        tuple: {name: backend} of the current layout, and of the previous one or None.
+
+    Raises:
+        ValueError: If a shard is given different targets in the two layouts.
+    """
+
+    current = parse(config.DB_SHARDS)
+    previous = parse(config.DB_SHARDS_PREVIOUS) if config.DB_SHARDS_PREVIOUS else None
+
+    for name, target in (previous or {}).items():
+        if current.get(name, target) != target:
+            raise ValueError(f"Shard '{name}' has different targets in DB_SHARDS and DB_SHARDS_PREVIOUS")
+
+    make = SHARD_BACKENDS[config.DB_BACKEND]
+    return ({name: make(target) for name, target in current.items()},
+            {name: make(target) for name, target in previous.items()} if previous is not None else None)
+
+
+def _build(backends, previous=None, **options) -> ShardSet:
+    names = dict(previous or {}, **backends)
+    pools = {name: db.new_pool(backend, **options) for name, backend in names.items()}
+    return ShardSet(pools, list(backends), list(previous) if previous else None, config.DB_SHARD_VNODES)
+
+
+_shards = None
+_shards_lock = threading.Lock()
+
+
+def get_shards() -> ShardSet | None:
+    """
+    Returns the process-wide shard set, building it from DB_SHARDS on first use, or None
+    if sharding is not configured.
+    """
+
+    global _shards
+
+    if _shards is None and config.DB_SHARDS:
+        with _shards_lock:
+            if _shards is None:
+                _shards = _build(*configured_backends())
+    return _shards
+
+
+def configure_shards(backends, previous=None, **options) -> ShardSet | None:
+    """
+    Replaces the process-wide shard set, e.g. with local SQLite files standing in for
+    the shards. None drops it, so the next get_shards() reads DB_SHARDS again.
+
+    Args:
+        backends (dict | None): Shard name -> backend of the current layout.
+        previous (dict | None): Shard name -> backend of the layout being rebalanced away from.
+        **options: Keyword arguments passed on to every shard's ConnectionPool.
+    """
+
+    global _shards
+
+    new_shards = _build(backends, previous, **options) if backends else None
+
+    with _shards_lock:
+        old_shards, _shards = _shards, new_shards
+
+    if old_shards is not None:
+        old_shards.close()
+
+    return new_shards
+
+
+def candidates(email) -> list:
+    """
+    Returns the pools that may hold email's LoginInformation row, in the order to try
+    them: one shard's pool (two while its row is being rebalanced), or the main pool
+    when sharding is off.
+    """
+
+    shard_set = get_shards()
+    return [db.get_pool()] if shard_set is None else shard_set.candidates(email)
+
+
+def home(email) -> db.ConnectionPool:
+    """
+    Returns the pool new rows for email are written to: its shard in the current layout,
+    or the main pool when sharding is off.
+    """
+
+    return candidates(email)[-1]
+
+
+def pools() -> list:
+    """
+    Returns every pool holding LoginInformation rows, for scans over all accounts.
+    """
+
+    shard_set = get_shards()
+    return [db.get_pool()] if shard_set is None else list(shard_set.pools.values())
+
+
+def topology():
+    """
+    Returns an object identifying where the accounts live: the shard set, or the main
+    pool when sharding is off. Caches compare it to notice they were pointed elsewhere.
+    """
+
+    return get_shards() or db.get_pool()
+
+
+def move_rows(source, destination, emails, new_email=None) -> int:
+    """
+    Moves accounts from one database to another, with every column of their rows.
+
+    The rows are deleted from the source and inserted into the destination in two
+    transactions. The destination commits first, so a failure between the commits
+    leaves an account on both shards rather than on neither; any earlier failure
+    changes neither shard. Writes to the rows wait for the source transaction, since
+    its DELETE holds their locks until it commits. Moves within a process run one at a
+    time, so they cannot deadlock on each other's locks.
+
+    Args:
+        source (db.ConnectionPool): Pool the rows are taken from.
+        destination (db.ConnectionPool): Pool the rows are written to.
+        emails (list): Emails of the rows to move.
+        new_email (str | None): New email for a single row being renamed as it moves.
+
+    Returns:
+        int: The number of rows moved; rows no longer in the source are skipped.
+
+    Raises:
+        IntegrityError: If the destination already holds one of the emails; nothing is moved.
+    """
+
+    placeholders = ", ".join("?" * len(emails))
+    delete = {
+        "sqlserver": f'DELETE FROM LoginInformation OUTPUT DELETED.* WHERE email IN ({placeholders})',
+        "sqlite": f'DELETE FROM LoginInformation WHERE email IN ({placeholders}) RETURNING *',
+    }[source.backend.dialect]
+
+    with _move_lock, source.connection() as source_connection, destination.connection() as destination_connection:
+        cursor = db.execute(source_connection, delete, tuple(emails))
+        rows = [list(row) for row in cursor.fetchall()]
+        if not rows:
+            return 0
+
+        columns = [column[0] for column in cursor.description]
+        if new_email is not None:
+            for row in rows:
+                row[columns.index("email")] = new_email
+
+        # Multi-row INSERTs, each within SQL Server's parameter limit
+        per_statement = max(1, MAX_PARAMETERS // len(columns))
+        row_placeholders = "(" + ", ".join("?" * len(columns)) + ")"
+
+        for start in range(0, len(rows), per_statement):
+            chunk = rows[start:start + per_statement]
+            db.execute(destination_connection,
+                       f'INSERT INTO LoginInformation ({", ".join(columns)}) VALUES {", ".join([row_placeholders] * len(chunk))}',
+                       tuple(value for row in chunk for value in row))
+
+        destination_connection.commit()
+        source_connection.commit()
+
+    return len(rows)
+
+
+def rebalance(shard_set=None, batch_size=None, pause=0.0) -> dict:
+    """
+    Moves every row stored on a shard other than its owner in the current layout. Each
+    shard is scanned in email order, batch_size rows at a time, and the misplaced rows
+    of a batch are moved together, so the application keeps running throughout.
+
+    Args:
+        shard_set (ShardSet | None): Shards to rebalance; defaults to get_shards().
+        batch_size (int | None): Rows scanned and moved per batch; defaults to DB_SHARD_BATCH_SIZE.
+        pause (float): Seconds to sleep between batches to limit the load on the shards.
+
+    Returns:
+        dict: Rows scanned and moved, and conflicts: emails found on two shards, left in place.
+
+    Raises:
+        ValueError: If sharding is not configured.
+    """
+
+    shard_set = shard_set or get_shards()
+    if shard_set is None:
+        raise ValueError("Sharding is not configured; set DB_SHARDS")
+
+    batch_size = min(batch_size or config.DB_SHARD_BATCH_SIZE, MAX_PARAMETERS - 100)
+    summary = {"scanned": 0, "moved": 0, "conflicts": []}
+
+    for name, pool in shard_set.pools.items():
+        last = ""
+
+        while True:
+            with pool.connection() as connection:
+                params = (batch_size, last) if pool.backend.dialect == "sqlserver" else (last, batch_size)
+                emails = [row[0] for row in db.execute(connection, SCAN[pool.backend.dialect], params).fetchall()]
+
+            if not emails:
+                break
+
+            summary["scanned"] += len(emails)
+            last = emails[-1]
+
+            misplaced = {}
+            for email in emails:
+                owner = shard_set.owner(email)
+                if owner != name:
+                    misplaced.setdefault(owner, []).append(email)
+
+            for owner, batch in misplaced.items():
+                summary["moved"] += _move_batch(pool, shard_set.pools[owner], batch, summary["conflicts"])
+                metrics.count("shard_rebalance_batches_total")
+
+            if misplaced and pause:
+                time.sleep(pause)
+
+    return summary
+
+
+def _move_batch(source, destination, emails, conflicts) -> int:
+    # Move the batch in one go; if the destination rejects it, move row by row
+    try:
+        return move_rows(source, destination, emails)
+    except source.backend.IntegrityError:
+        pass
+
+    moved = 0
+    for email in emails:
+        try:
+            moved += move_rows(source, destination, [email])
+        except source.backend.IntegrityError:
+            conflicts.append(email)
+    return moved
+
+
+def status(shard_set=None) -> dict:
+    """
+    Counts each shard's rows and those of them that belong on another shard.
+    """
+
+    shard_set = shard_set or get_shards()
+    if shard_set is None:
+        raise ValueError("Sharding is not configured; set DB_SHARDS")
+
+    report = {}
+
+    for name, pool in shard_set.pools.items():
+        rows = misplaced = 0
+
+        with pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute('SELECT email FROM LoginInformation')
+            while batch := cursor.fetchmany(1000):
+                rows += len(batch)
+                misplaced += sum(shard_set.owner(email) != name for (email,) in batch)
+
+        report[name] = {"rows": rows, "misplaced": misplaced, "in_layout": name in shard_set.ring.names}
+
+    return report
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Inspect and rebalance the LoginInformation shards.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("status", help="Count each shard's rows and misplaced rows")
+    rebalance_parser = subcommands.add_parser("rebalance", help="Move misplaced rows to their shard")
+    rebalance_parser.add_argument("--batch-size", type=int, help="Rows scanned and moved per batch")
+    rebalance_parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "status":
+            print(json.dumps(status(), indent=2))
+        else:
+            summary = rebalance(batch_size=args.batch_size, pause=args.pause)
+            print(json.dumps(summary, indent=2))
+            if summary["conflicts"]:
+                sys.exit(1)
+
+    except ValueError as error:
+        sys.exit(str(error))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,595 @@
+"""
+This module keeps a local, read-only snapshot of the credentials a login needs, so
+logins keep working while the database is unreachable or overloaded.
+
+The snapshot is a single file with the email, password_hash, two_fa and locked_until
+of every account:
+
+    header    4 KiB holding a magic number and JSON metadata: offsets, the shards the
+              accounts were read from and the change version each was read up to
+    records   The accounts sorted by lower-cased email, each a 13-byte fixed part
+              followed by the email and the hash
+    index     An open-addressing hash table of (tag, record offset) slots that is at
+              most half full, so a lookup reads about one slot and one record
+
+The file is memory-mapped, so opening it costs nothing, lookups parse only the record
+they return, and the processes on a host share its pages through the page cache.
+
+build() streams the rows of every shard through an external sort with bounded memory
+into a new file. refresh() reads only the rows changed since the last refresh, from
+SQL Server change tracking or the change log migration 0007 keeps on sqlite, and merges
+them into the sorted records of the current file. It falls back to a full build when
+the shards changed or the changes it needs were already cleaned up. Either way the new
+file is written next to the old one and renamed over it, so readers always see a
+complete snapshot. The file holds password hashes and is created readable by its owner only.
+
+auth.log_in and LoginService.login fall back to the snapshot when the database raises
+DatabaseUnavailable. Such logins check the password and the lockout as they were at the
+last refresh, use emailed codes for 2FA and record nothing in the database; every write
+stays blocked until the database is back.
+
+Usage:
+    python snapshot.py build
+    python snapshot.py refresh --every 300
+    python snapshot.py status
+"""
+
+import argparse, hashlib, heapq, json, mmap, os, struct, sys, tempfile, threading, time
+from operator import itemgetter
+import config, db, metrics, shards, users
+
+MAGIC = b"LSNAP001"
+HEADER_SIZE = 4096
+
+# Fixed part of a record: email length, hash length, flags, shard number, locked_until (-1: not locked)
+RECORD = struct.Struct("<HBBBq")
+
+# Index slot: upper 32 bits of the email's hash, and the record offset (0: empty slot)
+SLOT = struct.Struct("<IQ")
+
+# Record flags
+TWO_FA = 1
+
+SELECT_ACCOUNTS = 'SELECT email, password_hash, two_fa, locked_until FROM LoginInformation'
+
+# Change tracking queries per dialect. A change version covers every change committed
+# at or before it; on sqlite it is the last AUTOINCREMENT key of the change log.
+CURRENT_VERSION = {
+    "sqlserver": "SELECT CHANGE_TRACKING_CURRENT_VERSION()",
+    "sqlite": "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'LoginInformation_changes'), 0)",
+}
+MIN_VALID_VERSION = {
+    "sqlserver": "SELECT CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('LoginInformation'))",
+    "sqlite": "SELECT MIN(version) - 1 FROM LoginInformation_changes",
+}
+
+# The changed emails since a version, with their rows as they are now (NULLs if deleted).
+# On SQL Server, updates that touched none of the snapshot's columns are skipped; without
+# column tracking SYS_CHANGE_COLUMNS is NULL and every update counts.
+_COLUMN_CHANGED = ("CHANGE_TRACKING_IS_COLUMN_IN_MASK(COLUMNPROPERTY(OBJECT_ID('LoginInformation'), '{}', 'ColumnId'), "
+                   "c.SYS_CHANGE_COLUMNS) = 1")
+CHANGES = {
+    "sqlserver": 'SELECT c.email, t.email, t.password_hash, t.two_fa, t.locked_until '
+                 'FROM CHANGETABLE(CHANGES LoginInformation, ?) AS c '
+                 'LEFT JOIN LoginInformation AS t ON t.email = c.email '
+                 "WHERE c.SYS_CHANGE_OPERATION <> 'U' OR c.SYS_CHANGE_COLUMNS IS NULL OR "
+                 + " OR ".join(_COLUMN_CHANGED.format(column) for column in ("password_hash", "two_fa", "locked_until")),
+    "sqlite": 'SELECT DISTINCT c.email, t.email, t.password_hash, t.two_fa, t.locked_until '
+              'FROM LoginInformation_changes AS c '
+              'LEFT JOIN LoginInformation AS t ON t.email = c.email WHERE c.version > ?',
+}
+
+PRUNE_CHANGES = 'DELETE FROM LoginInformation_changes WHERE changed_at < ?'
+
+# Records are handled as (key, email, password_hash, two_fa, locked_until, shard) tuples,
+# where key is the lower-cased email and shard the position of its shard in the metadata
+_key = itemgetter(0)
+
+_current = None  # (file identity, CredentialSnapshot) of the last snapshot opened
+_current_lock = threading.Lock()
+
+
+class SnapshotUnavailable(db.DatabaseUnavailable):
+    """
+    Raised when the database is unavailable and there is no usable snapshot either.
+    """
+
+
+def _hash(key) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _record(row, shard) -> tuple:
+    # Builds a record from an (email, password_hash, two_fa, locked_until) row
+    email, password_hash, two_fa, locked_until = row
+    if isinstance(password_hash, bytes):
+        password_hash = password_hash.decode("ascii")
+    return email.lower(), email, password_hash, bool(two_fa), locked_until, shard
+
+
+def _pack(record) -> bytes:
+    _, email, password_hash, two_fa, locked_until, shard = record
+    email_bytes = email.encode("utf-8")
+    hash_bytes = password_hash.encode("ascii")
+    return RECORD.pack(len(email_bytes), len(hash_bytes), TWO_FA if two_fa else 0, shard,
+                       -1 if locked_until is None else int(locked_until)) + email_bytes + hash_bytes
+
+
+def _unpack(data, offset) -> tuple:
+    # Returns the record at offset and the offset of the next one
+    email_length, hash_length, flags, shard, locked_until = RECORD.unpack_from(data, offset)
+    start = offset + RECORD.size
+    email = data[start:start + email_length].decode("utf-8")
+    password_hash = data[start + email_length:start + email_length + hash_length].decode("ascii")
+    record = (email.lower(), email, password_hash, bool(flags & TWO_FA), None if locked_until < 0 else locked_until, shard)
+    return record, start + email_length + hash_length
+
+
+def _iter_records(data, start, end):
+    offset = start
+    while offset < end:
+        record, offset = _unpack(data, offset)
+        yield record
+
+
+class CredentialSnapshot:
+    """
+    A memory-mapped snapshot file, opened read-only.
+
+    Args:
+        path (str): A file written by build() or refresh().
+
+    Attributes:
+        meta (dict): The file's metadata: count, offsets, shards, watermarks, built_at and refreshed_at.
+
+    Raises:
+        ValueError: If the file is not a snapshot.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+
+        with open(path, "rb") as source:
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < HEADER_SIZE or self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a credential snapshot")
+
+        length = struct.unpack_from("<I", self._map, len(MAGIC))[0]
+        self.meta = json.loads(self._map[len(MAGIC) + 4:len(MAGIC) + 4 + length])
+        self._mask = self.meta["slots"] - 1
+        self._index = self.meta["index_offset"]
+
+    def get(self, email) -> users.UserRecord | None:
+        """
+        Looks an account up by email, ignoring case as SQL Server does.
+
+        Returns:
+            users.UserRecord | None: The account as of the snapshot, or None if it was not registered.
+        """
+
+        key = email.lower()
+        hashed = _hash(key)
+        tag = hashed >> 32
+        slot = hashed & self._mask
+
+        while True:
+            slot_tag, offset = SLOT.unpack_from(self._map, self._index + slot * SLOT.size)
+            if not offset:
+                return None
+
+            if slot_tag == tag:
+                record, _ = _unpack(self._map, offset)
+                if record[0] == key:
+                    _, email, password_hash, two_fa, locked_until, _ = record
+                    return users.UserRecord(email, password_hash, 1 if two_fa else 0, 0, locked_until)
+
+            slot = (slot + 1) & self._mask
+
+    def records(self):
+        """
+        Yields every record in key order.
+        """
+
+        return _iter_records(self._map, self.meta["records_offset"], self.meta["records_end"])
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def close(self) -> None:
+        self._map.close()
+
+
+def _write(path, records, meta) -> int:
+    """
+    Writes records, which must be in key order, to a new snapshot file and renames it
+    over path. The records are streamed to disk; the index is then filled in through a
+    memory map of the file, so memory use does not grow with the number of accounts.
+
+    Returns:
+        int: The number of records written.
+    """
+
+    temporary = f"{path}.tmp"
+    descriptor = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    with open(descriptor, "r+b") as file:
+        file.write(bytes(HEADER_SIZE))
+        count = 0
+        for record in records:
+            file.write(_pack(record))
+            count += 1
+        records_end = file.tell()
+
+        slots = 8
+        while slots < 2 * count:
+            slots *= 2
+        index_offset = (records_end + 7) // 8 * 8
+        file.truncate(index_offset + slots * SLOT.size)
+        file.flush()
+
+        with mmap.mmap(file.fileno(), 0) as data:
+            mask = slots - 1
+            offset = HEADER_SIZE
+            while offset < records_end:
+                record, next_offset = _unpack(data, offset)
+                hashed = _hash(record[0])
+                slot = hashed & mask
+                while SLOT.unpack_from(data, index_offset + slot * SLOT.size)[1]:
+                    slot = (slot + 1) & mask
+                SLOT.pack_into(data, index_offset + slot * SLOT.size, hashed >> 32, offset)
+                offset = next_offset
+
+            header = json.dumps({**meta, "count": count, "records_offset": HEADER_SIZE, "records_end": records_end,
+                                 "index_offset": index_offset, "slots": slots}).encode("utf-8")
+            if len(MAGIC) + 4 + len(header) > HEADER_SIZE:
+                raise ValueError("Snapshot metadata does not fit in the header")
+
+            data[:len(MAGIC)] = MAGIC
+            struct.pack_into("<I", data, len(MAGIC), len(header))
+            data[len(MAGIC) + 4:len(MAGIC) + 4 + len(header)] = header
+            data.flush()
+
+        os.fsync(file.fileno())
+
+    os.replace(temporary, path)
+    return count
+
+
+def _sorted(records, chunk_size):
+    """
+    Yields records in key order. Runs of chunk_size records are sorted in memory and
+    spilled to temporary files, which are then merged, so at most one run is held.
+    """
+
+    runs = []
+    chunk = []
+
+    try:
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                chunk.sort(key=_key)
+                run = tempfile.TemporaryFile()
+                run.write(b"".join(_pack(record) for record in chunk))
+                run.flush()
+                runs.append((run, mmap.mmap(run.fileno(), 0, access=mmap.ACCESS_READ)))
+                chunk = []
+
+        chunk.sort(key=_key)
+        yield from heapq.merge(*(_iter_records(data, 0, len(data)) for _, data in runs), chunk, key=_key)
+
+    finally:
+        for run, data in runs:
+            data.close()
+            run.close()
+
+
+def _sources() -> list:
+    # (label, pool) of every database holding accounts, in the order recorded in the metadata
+    shard_set = shards.get_shards()
+    return [("main", db.get_pool())] if shard_set is None else sorted(shard_set.pools.items())
+
+
+def _home(email) -> str:
+    shard_set = shards.get_shards()
+    return "main" if shard_set is None else shard_set.owner(email)
+
+
+def _prefer_home(first, second, labels) -> tuple:
+    # Of two copies of an account caught moving between shards, keeps the one on its home shard
+    return second if labels[second[5]] == _home(second[1]) else first
+
+
+def _versions(connection, dialect, retention) -> tuple:
+    """
+    Returns the current change version and the oldest version changes are still known
+    from, or (None, None) if changes are not tracked. On sqlite, change log entries
+    older than retention seconds are deleted first.
+    """
+
+    if dialect == "sqlite":
+        db.execute(connection, PRUNE_CHANGES, (int(time.time() - retention),))
+        connection.commit()
+
+    current = db.execute(connection, CURRENT_VERSION[dialect]).fetchone()[0]
+    minimum = db.execute(connection, MIN_VALID_VERSION[dialect]).fetchone()[0]
+
+    if current is None:
+        return None, None
+    return current, current if minimum is None and dialect == "sqlite" else minimum
+
+
+def _path(path) -> str:
+    path = path or config.SNAPSHOT_PATH
+    if not path:
+        raise ValueError("Set SNAPSHOT_PATH or pass a path")
+    return path
+
+
+def build(path=None, chunk_size=None) -> dict:
+    """
+    Writes a new snapshot from a full read of every shard.
+
+    Args:
+        path (str | None): The snapshot file; defaults to SNAPSHOT_PATH.
+        chunk_size (int | None): Records sorted in memory at a time; defaults to SNAPSHOT_SORT_CHUNK.
+
+    Returns:
+        dict: mode "full", the number of accounts and the seconds taken.
+    """
+
+    path = _path(path)
+    started = time.perf_counter()
+    sources = _sources()
+    labels = [label for label, _ in sources]
+    watermarks = {}
+
+    def rows():
+        for shard, (label, pool) in enumerate(sources):
+            with pool.connection() as connection:
+                # Read before the scan, so changes the scan misses are picked up by the next refresh
+                watermarks[label] = _versions(connection, pool.backend.dialect, config.SNAPSHOT_CHANGE_RETENTION)[0]
+                cursor = connection.cursor()
+                cursor.execute(SELECT_ACCOUNTS)
+                while batch := cursor.fetchmany(1000):
+                    for row in batch:
+                        yield _record(row, shard)
+
+    def deduplicated(records):
+        previous = None
+        for record in records:
+            if previous is not None and record[0] == previous[0]:
+                previous = _prefer_home(previous, record, labels)
+                continue
+            if previous is not None:
+                yield previous
+            previous = record
+        if previous is not None:
+            yield previous
+
+    now = time.time()
+    count = _write(path, deduplicated(_sorted(rows(), chunk_size or config.SNAPSHOT_SORT_CHUNK)),
+                   {"shards": labels, "watermarks": watermarks, "built_at": now, "refreshed_at": now})
+
+    metrics.observe("snapshot_build", time.perf_counter() - started)
+    return {"mode": "full", "accounts": count, "seconds": round(time.perf_counter() - started, 3)}
+
+
+def refresh(path=None, chunk_size=None) -> dict:
+    """
+    Brings the snapshot up to date with the rows changed since its last refresh, or
+    builds it from scratch if there is none or the changes cannot be read.
+
+    Returns:
+        dict: mode "incremental" or "full", the number of accounts, the seconds taken and,
+        for an incremental refresh, the number of changed emails; a full build says why.
+    """
+
+    path = _path(path)
+    started = time.perf_counter()
+
+    try:
+        current = CredentialSnapshot(path)
+    except (OSError, ValueError):
+        return {**build(path, chunk_size), "reason": "no snapshot"}
+
+    try:
+        sources = _sources()
+        labels = [label for label, _ in sources]
+        if current.meta["shards"] != labels:
+            return {**build(path, chunk_size), "reason": "shards changed"}
+
+        changes = {}  # key -> the record as it is now, or the set of shards it was removed from
+        watermarks = {}
+
+        for shard, (label, pool) in enumerate(sources):
+            since = current.meta["watermarks"].get(label)
+
+            with pool.connection() as connection:
+                version, minimum = _versions(connection, pool.backend.dialect, config.SNAPSHOT_CHANGE_RETENTION)
+                if since is None or version is None or minimum is None or since < minimum:
+                    return {**build(path, chunk_size), "reason": f"changes on {label} not tracked since the last refresh"}
+
+                cursor = connection.cursor()
+                cursor.execute(CHANGES[pool.backend.dialect], (since,))
+                while batch := cursor.fetchmany(1000):
+                    for changed_email, *row in batch:
+                        key = changed_email.lower()
+                        change = changes.get(key)
+
+                        if row[0] is None:
+                            if not isinstance(change, tuple):
+                                changes[key] = (change or set()) | {shard}
+                        else:
+                            record = _record(row, shard)
+                            changes[key] = record if not isinstance(change, tuple) else _prefer_home(change, record, labels)
+
+            watermarks[label] = version
+
+        updates = sorted(changes.items(), key=_key)
+
+        def merged():
+            position = 0
+            for record in current.records():
+                while position < len(updates) and updates[position][0] < record[0]:
+                    change = updates[position][1]
+                    position += 1
+                    if isinstance(change, tuple):
+                        yield change
+
+                if position < len(updates) and updates[position][0] == record[0]:
+                    change = updates[position][1]
+                    position += 1
+                    if isinstance(change, tuple):
+                        yield change
+                    elif record[5] not in change:
+                        yield record  # Removed from a shard it moved away from; this copy is current
+                    continue
+
+                yield record
+
+            for _, change in updates[position:]:
+                if isinstance(change, tuple):
+                    yield change
+
+        count = _write(path, merged(), {**current.meta, "watermarks": watermarks, "refreshed_at": time.time()})
+
+    finally:
+        current.close()
+
+    metrics.observe("snapshot_refresh", time.perf_counter() - started)
+    return {"mode": "incremental", "accounts": count, "changed": len(changes),
+            "seconds": round(time.perf_counter() - started, 3)}
+
+
+def get_snapshot(path=None) -> CredentialSnapshot | None:
+    """
+    Returns the snapshot at path (default SNAPSHOT_PATH), or None if there is none. The
+    file is reopened once a refresh has replaced it.
+    """
+
+    global _current
+
+    path = path or config.SNAPSHOT_PATH
+    if not path:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    identity = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    with _current_lock:
+        # The previous map is left to the garbage collector, as other threads may still be reading it
+        if _current is None or _current[0] != identity:
+            _current = (identity, CredentialSnapshot(path))
+        return _current[1]
+
+
+def get_credentials(email) -> users.UserRecord | None:
+    """
+    Looks an account up in the snapshot.
+
+    Raises:
+        SnapshotUnavailable: If there is no snapshot, or it is older than SNAPSHOT_MAX_AGE.
+    """
+
+    try:
+        snapshot = get_snapshot()
+    except (OSError, ValueError) as error:
+        raise SnapshotUnavailable(f"The credential snapshot cannot be read: {error}") from error
+
+    if snapshot is None:
+        raise SnapshotUnavailable("There is no credential snapshot")
+
+    if config.SNAPSHOT_MAX_AGE and time.time() - snapshot.meta["refreshed_at"] > config.SNAPSHOT_MAX_AGE:
+        raise SnapshotUnavailable("The credential snapshot is too old to use")
+
+    metrics.count("snapshot_lookups_total")
+    return snapshot.get(email)
+
+
+def login_record(email) -> tuple:
+    """
+    Fetches an account's credentials for a login: from the database, or from the snapshot
+    while the database is unavailable.
+
+    Returns:
+        tuple: The users.UserRecord (or None for an unknown email), and True if it came from the snapshot.
+
+    Raises:
+        DatabaseUnavailable: If the database is unavailable and no usable snapshot is configured.
+    """
+
+    try:
+        return users.get_credentials(email), False
+
+    except db.DatabaseUnavailable as error:
+        if not config.SNAPSHOT_PATH:
+            raise
+
+        try:
+            return get_credentials(email), True
+        except SnapshotUnavailable:
+            raise error
+
+
+def status(path=None) -> dict:
+    """
+    Returns the snapshot's metadata and age, or {"exists": False}.
+    """
+
+    try:
+        snapshot = CredentialSnapshot(_path(path))
+    except (OSError, ValueError):
+        return {"exists": False}
+
+    try:
+        return {"exists": True, "age_seconds": round(time.time() - snapshot.meta["refreshed_at"], 1),
+                "size_bytes": os.path.getsize(snapshot.path), **snapshot.meta}
+    finally:
+        snapshot.close()
+
+
+def main(argv=None) -> None:
+    """
+    Command-line entry point: build, refresh (once or every N seconds) or inspect the snapshot.
+    """
+
+    parser = argparse.ArgumentParser(description="Build and refresh the local credential snapshot.")
+    parser.add_argument("action", choices=("build", "refresh", "status"))
+    parser.add_argument("--path", help="Snapshot file (default: SNAPSHOT_PATH)")
+    parser.add_argument("--every", type=float, nargs="?", const=-1.0,
+                        help="Keep refreshing, every SNAPSHOT_REFRESH_INTERVAL seconds or the given number")
+    args = parser.parse_args(argv)
+
+    if args.action == "status":
+        print(json.dumps(status(args.path), indent=2))
+        return
+
+    if args.action == "build":
+        print(json.dumps(build(args.path)))
+        return
+
+    interval = config.SNAPSHOT_REFRESH_INTERVAL if args.every == -1.0 else args.every
+
+    while True:
+        try:
+            print(json.dumps(refresh(args.path)), flush=True)
+        except db.DatabaseUnavailable as error:
+            # The snapshot is needed most while the database is down; keep the last one
+            if interval is None:
+                raise
+            print(f"Refresh failed, keeping the current snapshot: {error}", file=sys.stderr, flush=True)
+
+        if interval is None:
+            return
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,54 @@
 """
 This module maintains global state for the application, such as the currently logged-in user.
+
+The CLI only holds the token of its session; the session itself lives in the session
+store (see sessions.py), which is where expiry and revocation are enforced.
 """
 
-user = None  # Currently logged-in user; set to a user object after successful login
+import sessions
+
+token = None  # Session token of the currently logged-in user; None when logged out
+
+
+def start_session(email) -> str:
+    """
+    Starts a session for email and makes it the CLI's current session.
+
+    Returns:
+        str: The new session token.
+    """
+
+    global token
+
+    token = sessions.get_store().create(email)
+    return token
+
+
+def current_user() -> str | None:
+    """
+    Returns the email of the logged-in user, or None if nobody is logged in or the
+    session has expired or been revoked.
+    """
+
+    global token
+
+    if token is None:
+        return None
+
+    email = sessions.get_store().get(token)
+    if email is None:
+        token = None  # The session is gone, forget the stale token
+
+    return email
+
+
+def end_session() -> None:
+    """
+    Revokes the CLI's current session, if any.
+    """
+
+    global token
+
+    if token is not None:
+        sessions.get_store().revoke(token)
+        token = None
@@ -0,0 +1,432 @@
+"""
+This module runs the HTTP API as a pre-fork group of worker processes.
+
+The supervisor opens the listening socket once and forks one worker per slot. Every
+worker runs api.serve() on the shared socket with its own event loop, and the kernel
+spreads the incoming connections between them. The supervisor serves no requests
+itself; it looks after the workers:
+
+    crash       A worker that exits without being asked to is restarted in its slot.
+                A worker that keeps dying within seconds of starting is restarted
+                with an exponential backoff, so a broken setting cannot fork-bomb
+                the host.
+    recycle     After API_MAX_REQUESTS requests (plus a random extra of up to
+                API_MAX_REQUESTS_JITTER, so the workers do not all retire at once) a
+                worker stops accepting connections and tells the supervisor, which
+                starts its replacement at once. The old worker exits once its
+                requests in flight are answered, which bounds the memory a
+                long-running worker can accumulate.
+    SIGHUP      The settings are read again with config.reload(), a new generation
+                of workers is started with them, and the old workers drain and exit.
+                Logins in flight finish on the worker that started them.
+                API_HOST, API_PORT and the number of workers keep their values.
+    SIGTERM     Every worker drains and exits, and then the supervisor; SIGINT
+                (Ctrl+C) does the same. Workers still running API_GRACEFUL_TIMEOUT
+                seconds later are killed.
+
+Each worker reports its load over a pipe every API_STATS_INTERVAL seconds: requests
+answered, requests in flight, open connections, 5xx responses, CPU time and peak
+memory. The supervisor prints a summary line per interval and, with API_STATS_PATH
+set, rewrites a JSON file with the totals and the figures of every worker.
+
+Usage:
+    python api.py --workers 4
+    kill -HUP <supervisor pid>    # reload the settings
+"""
+
+import asyncio, json, multiprocessing, os, pickle, random, signal, sys, time
+from multiprocessing.connection import wait
+import api, config, metrics
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# A worker exiting within this many seconds of starting counts as a quick crash
+QUICK_EXIT = 5.0
+
+# Restart delays after quick crashes double from RESTART_BACKOFF up to MAX_RESTART_BACKOFF
+RESTART_BACKOFF = 0.5
+MAX_RESTART_BACKOFF = 30.0
+
+# Seconds a draining worker is given beyond API_GRACEFUL_TIMEOUT before it is killed
+KILL_GRACE = 5.0
+
+
+class Worker:
+    """
+    A worker process as seen by the supervisor.
+
+    Attributes:
+        slot (int): Position of the worker; a restarted or recycled worker takes over its slot.
+        generation (int): Reload count when the worker was started.
+        process (multiprocessing.Process): The worker process.
+        channel (multiprocessing.connection.Connection): Receiving end of the worker's reports.
+        started (float): Monotonic time the worker was started.
+        retiring (bool): True once the worker has been asked to, or decided to, drain and exit.
+        deadline (float | None): Monotonic time after which a retiring worker is killed.
+        stats (dict): The worker's last report.
+    """
+
+    __slots__ = ("slot", "generation", "process", "channel", "started", "retiring", "deadline", "stats")
+
+    def __init__(self, slot, generation, process, channel) -> None:
+        self.slot = slot
+        self.generation = generation
+        self.process = process
+        self.channel = channel
+        self.started = time.monotonic()
+        self.retiring = False
+        self.deadline = None
+        self.stats = {}
+
+
+class Supervisor:
+    """
+    Forks the API workers and keeps them running.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on; 0 picks a free one.
+        workers (int | None): Worker processes; defaults to one per CPU.
+        max_requests (int | None): Requests before a worker is recycled; defaults to API_MAX_REQUESTS.
+        jitter (int | None): Most extra requests added per worker; defaults to API_MAX_REQUESTS_JITTER.
+        graceful_timeout (float | None): Seconds workers get to drain; defaults to API_GRACEFUL_TIMEOUT.
+        stats_interval (float | None): Seconds between load reports; defaults to API_STATS_INTERVAL.
+        stats_path (str | None): JSON file rewritten with every report; defaults to API_STATS_PATH.
+
+    Options left to their defaults are read from the settings again after each reload.
+    """
+
+    def __init__(self, host, port, workers=None, max_requests=None, jitter=None, graceful_timeout=None,
+                 stats_interval=None, stats_path=None) -> None:
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count()
+
+        self._options = {"max_requests": max_requests, "max_requests_jitter": jitter,
+                         "graceful_timeout": graceful_timeout, "stats_interval": stats_interval,
+                         "stats_path": stats_path}
+
+        self.sock = None
+        self.generation = 0
+
+        # Lifetime counters
+        self.restarts = 0
+        self.recycles = 0
+        self.reloads = 0
+
+        self._workers = {}  # pid -> Worker, including retiring ones
+        self._pending = {}  # slot -> monotonic time a crashed worker is restarted at
+        self._crashes = {}  # slot -> consecutive quick crashes
+        self._retired = {"requests": 0, "errors": 0, "cpu_seconds": 0.0}  # Totals of exited workers
+
+        self._stop_requested = False
+        self._reload_requested = False
+        self._stopping = False
+        self._last_report = (time.monotonic(), 0)
+
+    def _option(self, name):
+        value = self._options[name]
+        return getattr(config, f"API_{name.upper()}") if value is None else value
+
+    def run(self) -> None:
+        """
+        Binds the socket, starts the workers and supervises them until SIGTERM or SIGINT,
+        then waits for every worker to exit.
+        """
+
+        self.sock = api.bind(self.host, self.port)
+        api.adjust_settings(self.workers)
+        print(f"Serving the login API on http://{self.host}:{self.sock.getsockname()[1]} "
+              f"with {self.workers} worker(s) (supervisor pid {os.getpid()})")
+
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._request_reload)
+
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        next_report = time.monotonic() + self._option("stats_interval")
+
+        try:
+            while not (self._stopping and not self._workers):
+                if self._stop_requested and not self._stopping:
+                    self._stop()
+
+                if self._reload_requested:
+                    self._reload_requested = False
+                    if not self._stopping:
+                        self._reload()
+
+                self._poll(min(0.5, max(0.0, next_report - time.monotonic())))
+
+                now = time.monotonic()
+                self._restart_due(now)
+                self._kill_overdue(now)
+
+                if now >= next_report:
+                    self.report()
+                    next_report = now + self._option("stats_interval")
+
+        finally:
+            for worker in self._workers.values():
+                worker.process.kill()
+            self.sock.close()
+
+        self.report()
+
+    def _request_stop(self, signum, frame) -> None:
+        self._stop_requested = True
+
+    def _request_reload(self, signum, frame) -> None:
+        self._reload_requested = True
+
+    def _spawn(self, slot) -> None:
+        # Forks a worker into slot, replacing any pending restart of it
+        self._pending.pop(slot, None)
+
+        max_requests = self._option("max_requests")
+        if max_requests:
+            max_requests += random.randint(0, max(0, self._option("max_requests_jitter")))
+
+        # Split the cores between the workers' bcrypt pools instead of giving each one per CPU
+        hash_workers = config.SERVICE_HASH_WORKERS or max(1, os.cpu_count() // self.workers)
+
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_work, args=(self.sock, hash_workers, max_requests, sender, self._option("stats_interval")),
+            name=f"api-worker-{slot}")
+        process.start()
+        sender.close()
+
+        self._workers[process.pid] = Worker(slot, self.generation, process, receiver)
+
+    def _retire(self, worker) -> None:
+        # Asks a worker to drain and exit, and sets when it is killed if it has not
+        if worker.deadline is None:
+            worker.deadline = time.monotonic() + self._option("graceful_timeout") + KILL_GRACE
+        worker.retiring = True
+        worker.process.terminate()
+
+    def _poll(self, timeout) -> None:
+        # Waits for reports and exits, and handles them
+        channels = {worker.channel: worker for worker in self._workers.values() if not worker.channel.closed}
+        sentinels = {worker.process.sentinel: worker for worker in self._workers.values()}
+
+        for ready in wait(list(channels) + list(sentinels), timeout):
+            worker = channels.get(ready)
+            if worker is not None:
+                try:
+                    self._handle(worker, ready.recv())
+                except (EOFError, OSError, pickle.UnpicklingError):
+                    ready.close()  # The worker exited, possibly in the middle of a report
+
+        for worker in list(self._workers.values()):
+            if not worker.process.is_alive():
+                self._reap(worker)
+
+    def _handle(self, worker, message) -> None:
+        kind = message.pop("kind")
+        worker.stats = message or worker.stats
+
+        if kind == "retiring" and not worker.retiring:
+            # The worker reached its request limit and is draining; its replacement starts now
+            worker.retiring = True
+            worker.deadline = time.monotonic() + self._option("graceful_timeout") + KILL_GRACE
+            self.recycles += 1
+            if not self._stopping and not self._replaced(worker):
+                self._spawn(worker.slot)
+
+    def _replaced(self, worker) -> bool:
+        # True if a newer worker already serves the worker's slot
+        return any(other.slot == worker.slot and not other.retiring for other in self._workers.values())
+
+    def _reap(self, worker) -> None:
+        # Accounts for an exited worker and restarts it if it crashed
+        del self._workers[worker.process.pid]
+        worker.process.join()
+
+        # Its final report may still be waiting in the pipe
+        try:
+            while not worker.channel.closed and worker.channel.poll():
+                self._handle(worker, worker.channel.recv())
+        except (EOFError, OSError, pickle.UnpicklingError):
+            pass
+        worker.channel.close()
+
+        for name in self._retired:
+            self._retired[name] += worker.stats.get(name, 0)
+
+        # A worker that was killed leaves its bcrypt processes behind, blocked on their queue
+        if hasattr(os, "killpg"):
+            try:
+                os.killpg(worker.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+        if worker.retiring or self._stopping or self._replaced(worker):
+            return
+
+        uptime = time.monotonic() - worker.started
+        quick_crashes = self._crashes[worker.slot] = self._crashes.get(worker.slot, 0) + 1 if uptime < QUICK_EXIT else 0
+        delay = min(MAX_RESTART_BACKOFF, RESTART_BACKOFF * 2 ** (quick_crashes - 1)) if quick_crashes else 0.0
+
+        print(f"Worker {worker.slot} (pid {worker.process.pid}) exited with code {worker.process.exitcode}; "
+              f"restarting it in {delay:g}s", file=sys.stderr)
+        self.restarts += 1
+        self._pending[worker.slot] = time.monotonic() + delay
+
+    def _restart_due(self, now) -> None:
+        for slot, due in list(self._pending.items()):
+            if now >= due and not self._stopping:
+                self._spawn(slot)
+
+    def _kill_overdue(self, now) -> None:
+        for worker in self._workers.values():
+            if worker.deadline is not None and now >= worker.deadline and worker.process.is_alive():
+                print(f"Worker {worker.slot} (pid {worker.process.pid}) did not drain in time; killing it",
+                      file=sys.stderr)
+                worker.process.kill()
+
+    def _reload(self) -> None:
+        # Starts a new generation of workers with the reloaded settings and drains the old one
+        try:
+            config.reload()
+        except Exception as error:
+            print(f"Reloading the settings failed, keeping the running workers: {error}", file=sys.stderr)
+            return
+
+        api.adjust_settings(self.workers)
+        metrics.enabled = config.METRICS_ENABLED
+
+        self.generation += 1
+        self.reloads += 1
+        old = [worker for worker in self._workers.values() if not worker.retiring]
+
+        for slot in range(self.workers):
+            self._spawn(slot)
+        for worker in old:
+            self._retire(worker)
+
+        print(f"Reloaded the settings; started worker generation {self.generation}", file=sys.stderr)
+
+    def _stop(self) -> None:
+        self._stopping = True
+        self._pending.clear()
+        print(f"Stopping: draining {len(self._workers)} worker(s)", file=sys.stderr)
+
+        for worker in self._workers.values():
+            self._retire(worker)
+
+    def stats(self) -> dict:
+        """
+        Returns the aggregated load of the workers: lifetime totals (including workers that
+        have exited), current figures, and the last report of every running worker.
+        """
+
+        now = time.monotonic()
+        workers = [{"slot": worker.slot, "pid": worker.process.pid, "generation": worker.generation,
+                    "uptime": round(now - worker.started, 1), "retiring": worker.retiring, **worker.stats}
+                   for worker in sorted(self._workers.values(), key=lambda worker: (worker.slot, worker.started))]
+
+        def total(name) -> float:
+            return self._retired.get(name, 0) + sum(worker.get(name, 0) for worker in workers)
+
+        return {
+            "requests": total("requests"),
+            "errors": total("errors"),
+            "cpu_seconds": round(total("cpu_seconds"), 2),
+            "in_flight": sum(worker.get("in_flight", 0) for worker in workers),
+            "connections": sum(worker.get("connections", 0) for worker in workers),
+            "restarts": self.restarts,
+            "recycles": self.recycles,
+            "reloads": self.reloads,
+            "workers": workers,
+        }
+
+    def report(self) -> None:
+        """
+        Prints a summary of stats() and, with a stats path set, writes all of it as JSON.
+        """
+
+        stats = self.stats()
+        now = time.monotonic()
+        last_time, last_requests = self._last_report
+        rate = (stats["requests"] - last_requests) / max(now - last_time, 1e-9)
+        self._last_report = (now, stats["requests"])
+
+        per_worker = ", ".join(f"#{worker['slot']} {worker.get('requests', 0)} req "
+                               f"{worker.get('max_rss_mb', 0):.0f} MB" for worker in stats["workers"])
+        print(f"[supervisor] {len(stats['workers'])} worker(s), {stats['requests']} requests ({rate:.1f}/s), "
+              f"{stats['in_flight']} in flight, {stats['errors']} errors, {stats['restarts']} restarts, "
+              f"{stats['recycles']} recycles | {per_worker}", file=sys.stderr)
+
+        path = self._option("stats_path")
+        if path:
+            # Written next to the target and renamed over it, so readers never see half a file
+            temporary = f"{path}.tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump({"time": time.time(), "requests_per_second": round(rate, 1), **stats}, file, indent=2)
+            os.replace(temporary, path)
+
+
+def _usage() -> dict:
+    # CPU time and peak memory of the calling process (its bcrypt pool not included)
+    usage = {"cpu_seconds": round(time.process_time(), 3)}
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+        usage["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor, 1)
+    return usage
+
+
+def _work(sock, hash_workers, max_requests, channel, stats_interval) -> None:
+    # Entry point of each worker process. Ctrl+C reaches the whole process group, but
+    # only the supervisor acts on it and stops the workers in order.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Lead a process group with the worker's bcrypt pool, so the supervisor can clean it up
+    # if the worker dies without closing it
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+
+    try:
+        asyncio.run(_serve(sock, hash_workers, max_requests, channel, stats_interval))
+    finally:
+        channel.close()
+
+
+async def _serve(sock, hash_workers, max_requests, channel, stats_interval) -> None:
+    # Serves until SIGTERM or the request limit, reporting the load over channel
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    server = None
+
+    def send(kind, **stats) -> None:
+        try:
+            channel.send({"kind": kind, **stats})
+        except OSError:
+            pass  # The supervisor is gone; the worker still drains
+
+    def limit_reached() -> None:
+        send("retiring")
+        stop.set()
+
+    async def monitor(api_server) -> None:
+        nonlocal server
+        server = api_server
+        while True:
+            send("stats", **server.stats(), **_usage())
+            await asyncio.sleep(stats_interval)
+
+    await api.serve(sock, hash_workers, stop, max_requests, limit_reached, monitor)
+
+    if server is not None:
+        send("exit", **server.stats(), **_usage())
@@ -0,0 +1,222 @@
+"""
+This module implements the authenticator-app second factor (RFC 6238 TOTP).
+
+Each enrolled account has a random 160-bit secret, shared once with the user's
+authenticator app through an otpauth:// URI. A code is the HMAC-SHA1 of the current
+30-second time step under that secret, truncated to six digits, so checking one is a
+local computation instead of an emailed code and the wait for its delivery.
+
+Codes are accepted for the current step and TOTP_WINDOW steps either side of it, to
+allow for clock drift and slow typing. The codes of that window are computed once per
+secret and step and kept in a small LRU, so checks within the same step only compare
+strings. A code is only accepted for a step later than the account's totp_last_step,
+and users.record_totp_step() makes that check part of its UPDATE, so a code cannot be
+replayed, not even by two logins racing each other.
+
+Backup codes are for users without their app. They are random 60-bit strings, shown
+once at enrolment and stored only as SHA-256 hashes; each one works a single time.
+"""
+
+import base64, hashlib, hmac, secrets, struct, threading, time
+from collections import OrderedDict
+from urllib.parse import quote, urlencode
+import config, users
+
+# RFC 6238 parameters understood by every common authenticator app
+DIGITS = 6
+PERIOD = 30
+
+# Characters of a base32 secret (RFC 4648)
+_BASE32 = "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
+
+# Backup code characters; 32 symbols without the easily confused 0/O and 1/I
+BACKUP_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+BACKUP_LENGTH = 12
+
+# Second factors reported by verify()
+TOTP = "totp"
+BACKUP_CODE = "backup_code"
+
+
+def new_secret() -> str:
+    """
+    Returns a new random secret, base32-encoded as authenticator apps expect.
+    """
+
+    return base64.b32encode(secrets.token_bytes(20)).decode("ascii")
+
+
+def is_secret(secret) -> bool:
+    """
+    Returns True if secret has the form new_secret() produces: 32 base32 characters.
+    """
+
+    return isinstance(secret, str) and len(secret) == 32 and all(character in _BASE32 for character in secret.upper())
+
+
+def provisioning_uri(secret, email, issuer=None) -> str:
+    """
+    Returns the otpauth:// URI that enrols secret in an authenticator app, typically
+    shown as a QR code.
+
+    Args:
+        secret (str): The base32 secret from new_secret().
+        email (str): The account, shown as the entry's name in the app.
+        issuer (str | None): Name shown alongside it; defaults to TOTP_ISSUER.
+    """
+
+    issuer = issuer or config.TOTP_ISSUER
+    parameters = urlencode({"secret": secret, "issuer": issuer, "algorithm": "SHA1", "digits": DIGITS, "period": PERIOD})
+    return f"otpauth://totp/{quote(f'{issuer}:{email}')}?{parameters}"
+
+
+def current_step(now=None) -> int:
+    """
+    Returns the TOTP time step of now (Unix time), or of the current time.
+    """
+
+    return int((time.time() if now is None else now) // PERIOD)
+
+
+def code_at(secret, step) -> str:
+    """
+    Returns the code for one time step (the HOTP value of RFC 4226 with the step as counter).
+    """
+
+    key = base64.b32decode(secret.upper() + "=" * (-len(secret) % 8))
+    digest = hmac.new(key, struct.pack(">Q", step), hashlib.sha1).digest()
+
+    # Dynamic truncation: four bytes at an offset taken from the digest's last nibble
+    offset = digest[-1] & 0x0F
+    value = struct.unpack(">I", digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    return str(value % 10 ** DIGITS).zfill(DIGITS)
+
+
+class WindowCache:
+    """
+    Bounded LRU of the codes accepted around a time step, per secret.
+
+    Args:
+        max_size (int): Most windows kept; the least recently used one is evicted beyond this.
+    """
+
+    def __init__(self, max_size=10000) -> None:
+        self.max_size = max(1, max_size)
+
+        self._windows = OrderedDict()  # (secret, step, window) -> ((step, code), ...)
+        self._lock = threading.Lock()
+
+    def codes(self, secret, step, window) -> tuple:
+        """
+        Returns (step, code) for every step from step - window to step + window.
+        """
+
+        key = (secret, step, window)
+
+        with self._lock:
+            codes = self._windows.get(key)
+            if codes is not None:
+                self._windows.move_to_end(key)
+                return codes
+
+        codes = tuple((candidate, code_at(secret, candidate)) for candidate in range(step - window, step + window + 1))
+
+        with self._lock:
+            self._windows[key] = codes
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_size:
+                self._windows.popitem(last=False)
+
+        return codes
+
+
+_windows = WindowCache()
+
+
+def match(secret, code, last_step=None, now=None) -> int | None:
+    """
+    Checks a code against the validation window around now.
+
+    Args:
+        secret (str): The account's base32 secret.
+        code (str): The code the user entered; spaces are ignored.
+        last_step (int | None): Last step already used; codes for it or earlier steps are rejected.
+        now (float | None): Unix time to check against; defaults to the current time.
+
+    Returns:
+        int | None: The time step the code belongs to, or None if it is not valid.
+    """
+
+    code = code.replace(" ", "")
+    if len(code) != DIGITS or not (code.isascii() and code.isdigit()):
+        return None
+
+    matched = None
+
+    # Compare against every code in the window so the time taken does not depend on which one matched
+    for step, expected in _windows.codes(secret, current_step(now), config.TOTP_WINDOW):
+        if hmac.compare_digest(expected, code) and (last_step is None or step > last_step):
+            matched = step
+
+    return matched
+
+
+def _normalize_backup_code(code) -> str:
+    return code.replace("-", "").replace(" ", "").upper()
+
+
+def hash_backup_code(code) -> str:
+    """
+    Returns the stored form of a backup code. Hyphens, spaces and case are ignored.
+    """
+
+    return hashlib.sha256(_normalize_backup_code(code).encode("ascii", "replace")).hexdigest()
+
+
+def new_backup_codes(count=None) -> tuple:
+    """
+    Generates a set of one-time backup codes.
+
+    Args:
+        count (int | None): Number of codes; defaults to TOTP_BACKUP_CODES.
+
+    Returns:
+        tuple: The codes to show the user once, and their hashes to store with users.enable_totp().
+    """
+
+    codes = []
+
+    for _ in range(count or config.TOTP_BACKUP_CODES):
+        raw = "".join(secrets.choice(BACKUP_ALPHABET) for _ in range(BACKUP_LENGTH))
+        codes.append("-".join(raw[index:index + 4] for index in range(0, BACKUP_LENGTH, 4)))
+
+    return codes, [hash_backup_code(code) for code in codes]
+
+
+def is_backup_code(code) -> bool:
+    normalized = _normalize_backup_code(code)
+    return len(normalized) == BACKUP_LENGTH and all(character in BACKUP_ALPHABET for character in normalized)
+
+
+def verify(record, code) -> str | None:
+    """
+    Checks the second factor of a login for an account with a TOTP secret. The code may
+    come from the authenticator app or be one of the account's backup codes; either is
+    consumed, so it cannot be used again.
+
+    Args:
+        record (users.UserRecord): The account's record, with totp_secret set.
+        code (str): The code the user entered.
+
+    Returns:
+        str | None: TOTP or BACKUP_CODE for the factor that matched, or None if the code was rejected.
+    """
+
+    step = match(record.totp_secret, code, record.totp_last_step)
+    if step is not None:
+        return TOTP if users.record_totp_step(record.email, step) else None
+
+    if is_backup_code(code) and users.use_backup_code(record.email, hash_backup_code(code)):
+        return BACKUP_CODE
+
+    return None
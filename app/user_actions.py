@@ -1,10 +1,9 @@
-import bcrypt, pyodbc, sys, db, state
+import sys, audit, db, flows, state
 from validators import email_valid_check, password_valid_check
 from getpass import getpass
 from ui import BLUE, RED, YELLOW, BOLD, RESET, print_logged_in_page
 from auth import two_factor_authentication
-from random import randint
-from email_utils import send_email
+from flows import INLINE, run
 
 def logged_in_page():
     """
@@ -25,41 +24,53 @@ def logged_in_page():
     while True:
         # Display page heading and current user
         print(f"\n{BOLD}--->>>            {RED}LOGGED IN PAGE{RESET}         {BOLD}<<<---{RESET}\n")
-        print(f"User: {state.user}")
+        email = state.current_user()
+
+        # The session may have expired or been revoked since the last command
+        if email is None:
+            print("Your session has expired. Returning to start page.")
+            return
+
+        print(f"User: {email}")
 
         # Take user input and handle it using match-case
         user_choice = input(">>> ").lower()
 
-        match user_choice:
+        try:
+            match user_choice:
 
-            case "update password":
-                update_password()
+                case "update password":
+                    update_password()
                 
-            case "change email":
-                change_email()
+                case "change email":
+                    change_email()
 
-            case "delete account":
-                if delete_account():  # If account deletion is confirmed
-                    return  # Exit page and return to start page
+                case "delete account":
+                    if delete_account():  # If account deletion is confirmed
+                        return  # Exit page and return to start page
                 
-            case "2fa":
-                two_factor_authentication()
+                case "2fa":
+                    two_factor_authentication()
 
-            case "logout":
-                log_out()
-                return  # Exit to login
+                case "logout":
+                    log_out()
+                    return  # Exit to login
             
-            case "help":
-                print_logged_in_page()
+                case "help":
+                    print_logged_in_page()
+
+                case "quit":
+                    log_out()
+                    print("Thank you for visiting Rahem's Login Simulator")
+                    print("See you soon!")
+                    sys.exit()
 
-            case "quit":
-                log_out()
-                print("Thank you for visiting Rahem's Login Simulator")
-                print("See you soon!")
-                sys.exit()
+                case _:
+                    print("Invalid command")  # Fallback for unknown input
 
-            case _:
-                print("Invalid command")  # Fallback for unknown input
+        except db.DatabaseUnavailable:
+            # Stay logged in; the user can try again once the database is back
+            print("The service is temporarily unavailable. Try again later.")
 
 
 def update_password():
@@ -71,31 +82,22 @@ def update_password():
     # Display the update password page heading
     print(f"\n{BOLD}--->>>        {RED}UPDATE PASSWORD PAGE{RESET}       {BOLD}<<<---{RESET}\n")
 
-    # Connect to the database
-    connection = db.get_connection_to_db()
-    cursor = connection.cursor()
-
     # Prompt user for a new password that passes password validation
     new_password = input("New Password: ")
     new_password = password_valid_check(new_password, "New Password: ")
-    hashed_password = bcrypt.hashpw(new_password.encode("utf-8"), bcrypt.gensalt())
 
-    # Commit changes to the database
-    cursor.execute('UPDATE LoginInformation SET password_hash = ? WHERE email = ?', (hashed_password, state.user))
-    connection.commit()
+    # Hash the new password and commit it to the database
+    run(flows.update_password(INLINE, state.current_user(), new_password))
 
     print("Password is now updated.")
 
-    # Always close the database connection
-    db.close_connection(connection)
-
 
 def forgot_password() -> None:
     """
     Reset the password for a given user.
 
     Prompts the user for an email and sends the given email a verification code.
-    If the verification code matches then user is allowed to change the password for the given email.
+    Then prompts for the code and a new password, which is only set if the code matches.
     Else fail the authentication and send them to the home page
     """
     
@@ -105,50 +107,31 @@ def forgot_password() -> None:
     # Prompt user for an email
     email = input("E-Mail: ")
 
-    # Connect to the database
-    connection = db.get_connection_to_db()
-    cursor = connection.cursor()
-
-    try:
-        # Fetch email from the database
-        cursor.execute('SELECT email FROM LoginInformation WHERE email = ?', (email,))
-        cursor.fetchone()[0]
-        
-        # Generate a random number for authentication
-        authentication_number = randint(1, 1000)
+    status = run(flows.request_reset(INLINE, email))
 
-        # Send an authentication code to the provided email  
-        send_email(email, "Your Authentication Code", "Authentication Code: " + str(authentication_number))
-        print("Authentication code sent. Check your E-Mail.")
+    if status == flows.RATE_LIMITED:
+        print("Too many reset requests for this E-Mail. Try again later.")
+        return
 
-        # Compare user inputted code to generated authentication number
-        if input("Code: ") == str(authentication_number):
-
-            print("Authentication successful")
-
-            # Prompt user for a new password that passes password validation
-            new_password = input("New Password: ")
-            new_password = password_valid_check(new_password, "New Password: ")
-            hashed_password = bcrypt.hashpw(new_password.encode("utf-8"), bcrypt.gensalt())
+    if status == flows.UNKNOWN_EMAIL:
+        # Handle case where the email was not found in the database
+        print("E-Mail does not exist within database. Going back to main menu")
+        return
 
-            # Commit changes to the database
-            cursor.execute('UPDATE LoginInformation SET password_hash = ? WHERE email = ?', (hashed_password, email))
-            connection.commit()
+    print("Authentication code sent. Check your E-Mail.")
+    code = input("Code: ")
 
-            print("Password is now updated.")
+    # Prompt user for a new password that passes password validation
+    new_password = input("New Password: ")
+    new_password = password_valid_check(new_password, "New Password: ")
 
-        else:
-            # Send user back to homepage if code did not match authentication number
-            print("Authentication failed. Going back to main menu")
-            return
-        
-    except TypeError as acc_exists:
-        # Handle case where the email was not found in the database
-        print("E-Mail does not exist within database. Going back to main menu")
+    # The password is only changed if the code matches the one emailed
+    if run(flows.reset_password(INLINE, email, code, new_password)) != flows.OK:
+        # Send user back to homepage if code did not match the stored code
+        print("Authentication failed. Going back to main menu")
+        return
 
-    finally:
-        # Always close the database connection
-        db.close_connection(connection)
+    print("Password is now updated.")
 
 
 def change_email():
@@ -161,32 +144,22 @@ def change_email():
     # Display the change email page heading
     print(f"\n{BOLD}--->>>         {RED}CHANGE EMAIL PAGE{RESET}         {BOLD}<<<---{RESET}\n")
     
-    # Connect to the database
-    connection = db.get_connection_to_db()
-    cursor = connection.cursor()
+    # Prompt user for email input
+    newEmail = input("New E-Mail: ")
 
-    try:
-        # Prompt user for email input
-        newEmail = input("New E-Mail: ")
-
-        # Validate email
-        newEmail = email_valid_check(newEmail, "New E-Mail: ")
-
-        # Update the database with the new email
-        cursor.execute('UPDATE LoginInformation SET email = ? WHERE email = ?', (newEmail, state.user))
-        connection.commit()
-        state.user = newEmail
+    # Validate email
+    newEmail = email_valid_check(newEmail, "New E-Mail: ")
 
+    # Update the database with the new email, which ends the sessions under the old one
+    if run(flows.change_email(INLINE, state.current_user(), newEmail)) == flows.OK:
+        # Continue under the new email
+        state.start_session(newEmail)
         print("Email updated successfuly!")
 
-    except pyodbc.IntegrityError as accErr:
+    else:
         # Handle case where the email already exists in the database
         print("Email is already asssociated with another account. Returning to logged in page.")
 
-    finally:
-        # Always close the database connection
-        connection.close()
-
 
 def delete_account() -> bool:
     """
@@ -219,28 +192,16 @@ def delete_account() -> bool:
     # Prompt the user for their password
     password = getpass("Password: ")
 
-    # Connect to the database
-    connection = db.get_connection_to_db()
-    cursor = connection.cursor()
-
-    # Fetch the stored hashed password for the current user
-    cursor.execute('SELECT password_hash FROM LoginInformation WHERE email = ?', (state.user,))
-    stored_hash = cursor.fetchone()[0]
-
-    # Check if the entered password matches the stored hash
-    if bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8')):
+    # Check the password once more, then delete the account and end all of its sessions
+    if run(flows.delete_account(INLINE, state.current_user(), password)) == flows.OK:
 
         print("Password accepted. Terminating account...")
 
-        # Delete the user’s account from the database
-        cursor.execute('DELETE FROM LoginInformation WHERE email = ?', (state.user,))
-        connection.commit()  # Make sure the deletion is saved
-
         # Confirm deletion and log the user out
         print("I hope you make another account with us :(")
         log_out()
         return True
-    
+
     else:
         # Password did not match
         print("Incorrect password. Returning to logged in page.")
@@ -252,7 +213,11 @@ def log_out():
     """
     Log out the currently logged-in user.
 
-    Resets the global 'user' variable to None, effectively ending the session.
+    Revokes the current session token in the session store, effectively ending the session.
     """
 
-    state.user = None  # Clear the user to log out
\ No newline at end of file
+    email = state.current_user()
+    state.end_session()  # Revoke the session to log out
+
+    if email is not None:
+        audit.emit(audit.LOGGED_OUT, email)
\ No newline at end of file
@@ -0,0 +1,336 @@
+"""
+This module is the data-access layer for the LoginInformation table.
+
+Each helper borrows a pooled connection for exactly the statements it runs, so callers
+never hold a connection while waiting on user input, bcrypt or email delivery. Every
+helper costs a single round trip; db.count_queries() can be used to check that a flow
+stays at its minimum. With sharding on, each helper runs on the shard holding the
+email's row (see the shards module); while that row is being rebalanced, a statement
+that finds no row on the old shard is repeated on the new one. Lookups of emails the
+bloom filter knows are not registered skip the database altogether, and records read
+recently are served from the cache module; every helper that writes a cached column
+invalidates the email it wrote.
+"""
+
+import time
+import bloom, cache, db, shards
+
+# Columns loaded into a UserRecord, in order. When adding new ones, add a migration that
+# rebuilds the covering index from database/migrations/0005_login_lookup_index.py (as
+# 0006_totp.py does) so it keeps covering them.
+RECORD_COLUMNS = ("email", "password_hash", "two_fa", "failed_logins", "locked_until", "totp_secret", "totp_last_step")
+
+SELECT_RECORD = f"SELECT {', '.join(RECORD_COLUMNS)} FROM LoginInformation WHERE email = ?"
+
+
+class UserRecord:
+    """
+    The credential fields of one LoginInformation row, loaded by a single query.
+
+    Attributes:
+        email (str): The account's email address.
+        password_hash (str | bytes): The stored bcrypt hash.
+        two_fa (bool): True if 2FA is enabled for the account.
+        failed_logins (int): Wrong passwords since the last successful login.
+        locked_until (int | None): Unix time the account unlocks, or None if it is not locked.
+        totp_secret (str | None): Base32 authenticator-app secret, or None if 2FA codes are emailed.
+        totp_last_step (int | None): Last TOTP time step accepted, so no code is accepted twice.
+    """
+
+    __slots__ = RECORD_COLUMNS
+
+    def __init__(self, email, password_hash, two_fa, failed_logins=0, locked_until=None,
+                 totp_secret=None, totp_last_step=None) -> None:
+        self.email = email
+        self.password_hash = password_hash
+        self.two_fa = two_fa == 1
+        self.failed_logins = failed_logins or 0
+        self.locked_until = locked_until
+        self.totp_secret = totp_secret
+        self.totp_last_step = totp_last_step
+
+    def __repr__(self) -> str:
+        return f"UserRecord(email={self.email!r}, two_fa={self.two_fa})"
+
+
+def _fetch_one(cursor):
+    # Drain the result set so the cursor can be reused for its prepared statement
+    rows = cursor.fetchall()
+    return rows[0] if rows else None
+
+
+def _read(email, sql, params):
+    # Run a SELECT on each database that may hold email's row until one returns it
+    for pool in shards.candidates(email):
+        with pool.connection() as connection:
+            row = _fetch_one(db.execute(connection, sql, params))
+        if row is not None:
+            return row
+    return None
+
+
+def _write(email, sql, params) -> int:
+    # Run an UPDATE or DELETE on each database that may hold email's row until one changes it
+    for pool in shards.candidates(email):
+        with pool.connection() as connection:
+            changed = db.execute(connection, sql, params).rowcount
+            connection.commit()
+        if changed:
+            return changed
+    return 0
+
+
+def get_credentials(email) -> UserRecord | None:
+    """
+    Fetches everything a login needs for an account in one round trip, or none if the
+    record is cached.
+
+    Args:
+        email (str): The account's email address.
+
+    Returns:
+        UserRecord | None: The account's record, or None if the email is not registered.
+    """
+
+    if not bloom.might_exist(email):
+        return None
+
+    record_cache = cache.get_cache()
+    return _load_record(email) if record_cache is None else record_cache.get(email, _load_record)
+
+
+@db.idempotent
+def _load_record(email) -> UserRecord | None:
+    row = _read(email, SELECT_RECORD, (email,))
+    return None if row is None else UserRecord(*row)
+
+
+def email_exists(email) -> bool:
+    """
+    Returns True if an account is registered under the given email.
+    """
+
+    if not bloom.might_exist(email):
+        return False
+
+    # Reading the whole record costs the same round trip and warms the cache for the next step
+    if cache.get_cache() is not None:
+        return get_credentials(email) is not None
+
+    return _select_email(email)
+
+
+@db.idempotent
+def _select_email(email) -> bool:
+    return _read(email, 'SELECT email FROM LoginInformation WHERE email = ?', (email,)) is not None
+
+
+def create_user(email, password_hash) -> bool:
+    """
+    Inserts a new account.
+
+    Returns:
+        bool: True if the account was created, False if the email is already registered.
+    """
+
+    pools = shards.candidates(email)
+
+    # While the email's shard is being rebalanced, it is only free if its old shard lacks it too
+    if len(pools) > 1 and shards.holds(pools[0], email):
+        return False
+
+    with pools[-1].connection() as connection:
+        try:
+            db.execute(connection, 'INSERT INTO LoginInformation (email, password_hash) VALUES (?,?)', (email, password_hash))
+            connection.commit()
+
+        except db.integrity_error():
+            return False
+
+    bloom.added(email)
+    return True
+
+
+def update_password_hash(email, password_hash) -> None:
+    """
+    Replaces the stored password hash for an account.
+    """
+
+    _write(email, 'UPDATE LoginInformation SET password_hash = ? WHERE email = ?', (password_hash, email))
+
+    cache.invalidate(email)
+
+
+def record_failed_login(email, locked_until) -> None:
+    """
+    Counts a wrong password against an account and stores its new lock expiry.
+
+    Args:
+        email (str): The account's email address.
+        locked_until (int | None): Unix time the account unlocks, or None to leave it unlocked.
+    """
+
+    _write(email, 'UPDATE LoginInformation SET failed_logins = failed_logins + 1, locked_until = ? WHERE email = ?',
+           (locked_until, email))
+
+    cache.invalidate(email)
+
+
+def clear_failed_logins(email) -> None:
+    """
+    Resets an account's wrong-password count and lock after a successful login.
+    """
+
+    _write(email, 'UPDATE LoginInformation SET failed_logins = 0, locked_until = NULL WHERE email = ?', (email,))
+
+    cache.invalidate(email)
+
+
+def record_login(email) -> None:
+    """
+    Stores the time of a successful login in the account's last_login column.
+    """
+
+    _write(email, 'UPDATE LoginInformation SET last_login = ? WHERE email = ?', (int(time.time()), email))
+
+
+def change_email(email, new_email) -> bool:
+    """
+    Moves an account to a new email address. If the new email hashes to another shard,
+    the row is moved to that shard.
+
+    Returns:
+        bool: True if the email was changed, False if the new email is already registered
+              or no account has the old one (e.g. it was deleted meanwhile).
+    """
+
+    destinations = shards.candidates(new_email)
+    if len(destinations) > 1 and shards.holds(destinations[0], new_email):
+        return False
+
+    changed = 0
+
+    try:
+        for source in shards.candidates(email):
+            if source is destinations[-1]:
+                with source.connection() as connection:
+                    changed = db.execute(connection, 'UPDATE LoginInformation SET email = ? WHERE email = ?', (new_email, email)).rowcount
+                    connection.commit()
+            else:
+                # The new email belongs on another shard, so the row moves there
+                changed = shards.move_rows(source, destinations[-1], [email], new_email)
+
+            if changed:
+                break
+
+    except db.integrity_error():
+        return False
+
+    # The record moves to a new key, so neither email may keep serving the old one
+    cache.invalidate(email, new_email)
+
+    if changed == 1:
+        bloom.removed(email)
+        bloom.added(new_email)
+    return changed == 1
+
+
+def enable_two_fa(email) -> bool:
+    """
+    Turns on 2FA for an account. The "already enabled" check is part of the UPDATE, so
+    this needs no separate SELECT.
+
+    Returns:
+        bool: True if 2FA was switched on, False if it was already enabled or the account does not exist.
+    """
+
+    changed = _write(email, 'UPDATE LoginInformation SET two_fa = 1 WHERE email = ? AND (two_fa IS NULL OR two_fa = 0)', (email,))
+
+    cache.invalidate(email)
+    return changed == 1
+
+
+def enable_totp(email, secret, step, backup_hashes) -> bool:
+    """
+    Turns on authenticator-app 2FA for an account, replacing any earlier secret and
+    backup codes. An account using emailed codes is switched over to the app.
+
+    Args:
+        email (str): The account's email address.
+        secret (str): The base32 TOTP secret the user enrolled in their app.
+        step (int): Time step of the code that confirmed the enrolment; it cannot be used again.
+        backup_hashes (list): Hashes of the new backup codes, from totp.new_backup_codes().
+
+    Returns:
+        bool: True if the account was updated, False if it does not exist.
+    """
+
+    changed = _write(email, 'UPDATE LoginInformation SET two_fa = 1, totp_secret = ?, totp_last_step = ?, backup_codes = ? '
+                            'WHERE email = ?', (secret, step, ",".join(backup_hashes), email))
+
+    cache.invalidate(email)
+    return changed == 1
+
+
+def record_totp_step(email, step) -> bool:
+    """
+    Marks a TOTP time step as used. The "newer than the last one" check is part of the
+    UPDATE, so two logins racing with the same code cannot both succeed.
+
+    Returns:
+        bool: True if the step was recorded, False if it (or a later one) was already used.
+    """
+
+    changed = _write(email, 'UPDATE LoginInformation SET totp_last_step = ? WHERE email = ? '
+                            'AND (totp_last_step IS NULL OR totp_last_step < ?)', (step, email, step))
+
+    cache.invalidate(email)
+    return changed == 1
+
+
+def use_backup_code(email, code_hash) -> bool:
+    """
+    Consumes one of an account's backup codes. The UPDATE only applies if the stored
+    list is unchanged since it was read, so a code cannot be used twice concurrently.
+
+    Args:
+        email (str): The account's email address.
+        code_hash (str): Hash of the entered code, from totp.hash_backup_code().
+
+    Returns:
+        bool: True if the code was unused and is now consumed, False otherwise.
+    """
+
+    for pool in shards.candidates(email):
+        with pool.connection() as connection:
+            row = _fetch_one(db.execute(connection, 'SELECT backup_codes FROM LoginInformation WHERE email = ?', (email,)))
+            if row is None:
+                continue  # Already moved to the email's new shard
+
+            stored = row[0] or ""
+            hashes = stored.split(",") if stored else []
+
+            if code_hash not in hashes:
+                return False
+
+            hashes.remove(code_hash)
+            cursor = db.execute(connection, 'UPDATE LoginInformation SET backup_codes = ? WHERE email = ? AND backup_codes = ?',
+                                (",".join(hashes), email, stored))
+            connection.commit()
+            return cursor.rowcount == 1
+
+    return False
+
+
+def delete_user(email) -> None:
+    """
+    Deletes an account.
+    """
+
+    deleted = _write(email, 'DELETE FROM LoginInformation WHERE email = ?', (email,))
+
+    cache.invalidate(email)
+
+    # Only forget emails that were really deleted, or the filter could lose a live one
+    if deleted == 1:
+        bloom.removed(email)
@@ -1,4 +1,217 @@
 import re
+import config
+from hashing import MAX_PASSWORD_BYTES
+
+# Regex pattern for a valid email address, compiled once at import
+EMAIL_PATTERN = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
+EMAIL_REGEX = re.compile(EMAIL_PATTERN)
+
+# Error messages returned by the validators
+INVALID_EMAIL = "Not valid E-Mail syntax"
+INVALID_LENGTH = "Password is of invalid length"
+
+
+class MinLength:
+    """
+    Password rule requiring at least `length` characters.
+    """
+
+    def __init__(self, length) -> None:
+        self.length = length
+
+    def __call__(self, password) -> str | None:
+        return INVALID_LENGTH if len(password) < self.length else None
+
+
+class MaxLength:
+    """
+    Password rule allowing at most `length` bytes once UTF-8 encoded. bcrypt refuses
+    passwords over MAX_PASSWORD_BYTES, so the default policy always has this rule.
+    """
+
+    def __init__(self, length) -> None:
+        self.length = length
+
+    def __call__(self, password) -> str | None:
+        if len(password.encode("utf-8")) > self.length:
+            return f"Password is too long (at most {self.length} bytes)"
+        return None
+
+
+class CharacterClasses:
+    """
+    Password rule requiring characters from at least `minimum` of the classes
+    lowercase, uppercase, digit and symbol.
+    """
+
+    def __init__(self, minimum) -> None:
+        self.minimum = minimum
+
+    def __call__(self, password) -> str | None:
+        classes = (any(char.islower() for char in password)
+                   + any(char.isupper() for char in password)
+                   + any(char.isdigit() for char in password)
+                   + any(not char.isalnum() for char in password))
+
+        if classes < self.minimum:
+            return f"Password must mix at least {self.minimum} of: lowercase, uppercase, digits, symbols"
+        return None
+
+
+class NotBreached:
+    """
+    Password rule rejecting passwords found in a local breach list.
+
+    Args:
+        breached_passwords (breached.BreachedPasswords): The breach list to check against.
+    """
+
+    def __init__(self, breached_passwords) -> None:
+        self.breached_passwords = breached_passwords
+
+    def __call__(self, password) -> str | None:
+        if password in self.breached_passwords:
+            return "Password has appeared in a data breach"
+        return None
+
+
+class PasswordPolicy:
+    """
+    An ordered list of password rules. Each rule is a callable that takes the password
+    and returns an error message, or None if the password passes.
+
+    Args:
+        rules (list): The rules to apply, cheapest first.
+    """
+
+    def __init__(self, rules) -> None:
+        self.rules = list(rules)
+
+    def check(self, password) -> list:
+        """
+        Returns the error message of every rule the password fails.
+        """
+
+        return [error for error in (rule(password) for rule in self.rules) if error is not None]
+
+
+_default_policy = None
+
+
+def default_policy() -> PasswordPolicy:
+    """
+    Returns the password policy built from config, creating it on first use.
+
+    By default passwords need to be non-empty and at most MAX_PASSWORD_BYTES long.
+    PASSWORD_MIN_LENGTH, PASSWORD_MAX_LENGTH, PASSWORD_MIN_CLASSES and
+    PASSWORD_BREACH_FILE tighten it.
+    """
+
+    global _default_policy
+
+    if _default_policy is None:
+        rules = [MinLength(max(config.PASSWORD_MIN_LENGTH, 1)),
+                 MaxLength(min(config.PASSWORD_MAX_LENGTH or MAX_PASSWORD_BYTES, MAX_PASSWORD_BYTES))]
+
+        if config.PASSWORD_MIN_CLASSES:
+            rules.append(CharacterClasses(config.PASSWORD_MIN_CLASSES))
+
+        if config.PASSWORD_BREACH_FILE:
+            from breached import BreachedPasswords
+            rules.append(NotBreached(BreachedPasswords(config.PASSWORD_BREACH_FILE)))
+
+        _default_policy = PasswordPolicy(rules)
+
+    return _default_policy
+
+
+def validate_email(email) -> list:
+    '''
+    Checks the syntax of an email address without prompting the user.
+
+    Args:
+        email (str): The email address to validate.
+
+    Returns:
+        list: Error messages; empty if the email is valid.
+    '''
+
+    return [] if EMAIL_REGEX.match(email) else [INVALID_EMAIL]
+
+
+def validate_password(password, policy=None) -> list:
+    '''
+    Checks a password against a password policy without prompting the user.
+
+    Args:
+        password (str): The password to validate.
+        policy (PasswordPolicy | None): The policy to apply; defaults to default_policy().
+
+    Returns:
+        list: Error messages; empty if the password is valid.
+    '''
+
+    return (policy or default_policy()).check(password)
+
+
+VALIDATORS = {"email": validate_email, "password": validate_password}
+
+
+def validate(value, kind="email") -> list:
+    '''
+    Validates one value of the given kind ("email" or "password").
+
+    Returns:
+        list: Error messages; empty if the value is valid.
+    '''
+
+    return VALIDATORS[kind](value)
+
+
+def validate_many(values, kind="email") -> list:
+    '''
+    Validates many values of the same kind in one call, e.g. for bulk imports.
+
+    Returns:
+        list: One list of error messages per value, in order.
+    '''
+
+    if kind == "email":
+        # Bind the compiled matcher once instead of looking it up per value
+        match = EMAIL_REGEX.match
+        return [[] if match(value) else [INVALID_EMAIL] for value in values]
+
+    validator = VALIDATORS[kind]
+    return [validator(value) for value in values]
+
+
+def is_valid_email(email) -> bool:
+    '''
+    Checks the syntax of an email address without prompting the user.
+
+    Args:
+        email (str): The email address to validate.
+
+    Returns:
+        bool: True if the email matches EMAIL_PATTERN.
+    '''
+
+    return EMAIL_REGEX.match(email) is not None
+
+
+def is_valid_password(password) -> bool:
+    '''
+    Checks a password against the default password policy without prompting the user.
+
+    Args:
+        password (str): The password to validate.
+
+    Returns:
+        bool: True if the password passes every rule.
+    '''
+
+    return not validate_password(password)
+
 
 def email_valid_check(email, terminal_message) -> str:
     '''
@@ -13,17 +226,10 @@ def email_valid_check(email, terminal_message) -> str:
         str: A valid email address entered by the user.
     '''
 
-    # Define the regex pattern for a valid email address
-    pattern = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
-
-    # Check if the initial email matches the pattern
-    valid = re.match(pattern, email)
-
     # Keep prompting the user until a valid email is entered
-    while not valid:
-        print("Not valid E-Mail syntax. Try again")
+    while not is_valid_email(email):
+        print(f"{INVALID_EMAIL}. Try again")
         email = input(terminal_message)
-        valid = re.match(pattern, email)
 
     # Return the valid email
     return email
@@ -31,9 +237,9 @@ def email_valid_check(email, terminal_message) -> str:
 
 def password_valid_check(password, terminal_message) -> str:
     '''
-    Validates the syntax of a password by checking its length.
+    Validates a password against the password policy.
     If the provided password is invalid, repeatedly prompts the user for a valid password.
-    
+
     Args:
         password (str): The initial password to validate.
         terminal_message (str): The prompt message displayed when asking for a new password input.
@@ -43,9 +249,9 @@ def password_valid_check(password, terminal_message) -> str:
     '''
 
     # Loop until valid password is entered
-    while len(password) <= 0:
-        print("Password is of invalid length. Try again")
+    while errors := validate_password(password):
+        print(f"{errors[0]}. Try again")
         password = input(terminal_message)
-    
+
     # Return the valid password
-    return password
\ No newline at end of file
+    return password
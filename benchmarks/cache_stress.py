@@ -0,0 +1,184 @@
+"""
+Consistency stress run for the user record cache.
+
+Writer threads keep changing a set of accounts through the users module: new password
+hashes, 2FA enrolment, failed logins and email renames. Meanwhile, reader threads look
+the accounts up with users.get_credentials(). Before each read, a reader notes the
+newest write that had already completed for that account. The record it gets back
+must be at least that new: same or later password version, 2FA not switched back off,
+no fewer failed logins. A renamed-away email must not be found at all. Any read that
+breaks this is reported as a violation and fails the run.
+
+Runs against a temporary SQLite database. The report includes the cache's hit rate and
+the read throughput; --no-cache runs the same workload without the cache to compare.
+
+Usage:
+    python benchmarks/cache_stress.py --accounts 50 --readers 8 --writers 4 --seconds 10
+    python benchmarks/cache_stress.py --no-cache
+"""
+
+import argparse, json, os, random, sys, tempfile, threading, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+
+class Account:
+    """
+    The last completed write to one account, as the writers know it.
+    """
+
+    def __init__(self, email) -> None:
+        self.email = email
+        self.version = 0
+        self.two_fa = False
+        self.failed_logins = 0
+        self.renames = 0
+        self.renaming = False  # Set before a rename is written, so readers can tell it is in flight
+        self.write_lock = threading.Lock()  # One writer per account, so this model stays exact
+
+
+def run(accounts=50, readers=8, writers=4, seconds=5.0, use_cache=True, seed=None) -> dict:
+    """
+    Runs the stress workload and returns its counters, violations and cache statistics.
+    """
+
+    import cache, config, db, users
+
+    config.USER_CACHE = use_cache
+    config.AUDIT_LOG = False
+    random.seed(seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db.configure_pool(db.SqliteBackend(os.path.join(directory, "stress.db")), max_size=readers + writers)
+        cache.configure_cache(cache.RecordCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL) if use_cache else None)
+
+        model = [Account(f"user{number}@example.com") for number in range(accounts)]
+        for account in model:
+            users.create_user(account.email, "v0")
+
+        model_lock = threading.Lock()
+        retired = []  # Emails renamed away; they must never be found again
+        violations = []
+        counts = {"reads": 0, "writes": 0}
+        stop = threading.Event()
+
+        def violation(kind, email, expected, got) -> None:
+            with model_lock:
+                violations.append({"kind": kind, "email": email, "expected": expected, "got": got})
+
+        def write() -> None:
+            while not stop.is_set():
+                account = random.choice(model)
+                with account.write_lock:
+                    operation = random.choice(("password", "password", "failed_login", "two_fa", "rename"))
+
+                    if operation == "password":
+                        users.update_password_hash(account.email, f"v{account.version + 1}")
+                        with model_lock:
+                            account.version += 1
+
+                    elif operation == "failed_login":
+                        users.record_failed_login(account.email, None)
+                        with model_lock:
+                            account.failed_logins += 1
+
+                    elif operation == "two_fa":
+                        users.enable_two_fa(account.email)
+                        with model_lock:
+                            account.two_fa = True
+
+                    else:
+                        name, _ = account.email.split("@")
+                        new_email = f"{name.split('.')[0]}.{account.renames + 1}@example.com"
+                        with model_lock:
+                            account.renaming = True
+                        renamed = users.change_email(account.email, new_email)
+                        with model_lock:
+                            if renamed:
+                                retired.append(account.email)
+                                account.email = new_email
+                                account.renames += 1
+                            account.renaming = False
+
+                with model_lock:
+                    counts["writes"] += 1
+
+        def read() -> None:
+            while not stop.is_set():
+                if retired and random.random() < 0.1:
+                    with model_lock:
+                        email = random.choice(retired)
+                    record = users.get_credentials(email)
+                    if record is not None:
+                        violation("renamed_email_found", email, None, record.password_hash)
+                    continue
+
+                account = random.choice(model)
+                with model_lock:
+                    email, version, two_fa, failed_logins = (account.email, account.version,
+                                                             account.two_fa, account.failed_logins)
+
+                record = users.get_credentials(email)
+
+                if record is None:
+                    # Only acceptable if the account was renamed while we were reading
+                    with model_lock:
+                        if account.email == email and not account.renaming:
+                            violation("missing", email, version, None)
+                elif int(record.password_hash[1:]) < version:
+                    violation("stale_password", email, version, record.password_hash)
+                elif two_fa and not record.two_fa:
+                    violation("stale_two_fa", email, True, False)
+                elif record.failed_logins < failed_logins:
+                    violation("stale_failed_logins", email, failed_logins, record.failed_logins)
+
+                with model_lock:
+                    counts["reads"] += 1
+
+        threads = [threading.Thread(target=write) for _ in range(writers)] + \
+                  [threading.Thread(target=read) for _ in range(readers)]
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        record_cache = cache.get_cache()
+        db.get_pool().close()
+
+    return {
+        "config": {"accounts": accounts, "readers": readers, "writers": writers, "seconds": seconds, "cache": use_cache},
+        "reads": counts["reads"],
+        "writes": counts["writes"],
+        "reads_per_second": round(counts["reads"] / elapsed, 1),
+        "cache": record_cache.stats() if record_cache is not None else None,
+        "violations": violations[:20],
+        "violation_count": len(violations),
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Check the user record cache under concurrent writers.")
+    parser.add_argument("--accounts", type=int, default=50, help="Accounts read and written")
+    parser.add_argument("--readers", type=int, default=8, help="Reader threads")
+    parser.add_argument("--writers", type=int, default=4, help="Writer threads")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Length of the run")
+    parser.add_argument("--no-cache", action="store_true", help="Run the same workload without the cache")
+    parser.add_argument("--seed", type=int, help="Random seed")
+    args = parser.parse_args(argv)
+
+    results = run(args.accounts, args.readers, args.writers, args.seconds, not args.no_cache, args.seed)
+    print(json.dumps(results, indent=2))
+
+    if results["violation_count"]:
+        print(f"FAILED {results['violation_count']} stale or inconsistent reads")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,162 @@
+"""
+Checks for notification campaigns, sent to a local fake SMTP server from SQLite files
+standing in for SQL Server.
+
+    send        Every account gets exactly one message with its own email substituted,
+                over no more connections than sessions, and no faster than the rate.
+    resume      A campaign stopped part way resumes after its checkpoint; together the
+                runs send every account exactly one message.
+    crash       With the checkpoint rolled back as if the process died mid-batch, the
+                resumed run skips the recipients already recorded in the deliveries.
+    report      Addresses the server refuses are reported as refused, and the audience
+                filter picks only the accounts with 2FA, across two shards.
+
+Usage:
+    python benchmarks/campaign_check.py
+    python benchmarks/campaign_check.py --accounts 5000 --rate 1000
+"""
+
+import argparse, json, os, sys, tempfile, time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+
+def check(results, name, passed, **details) -> None:
+    results.append({"scenario": name, "passed": bool(passed), **details})
+    print(f"{'PASS' if passed else 'FAIL'} {name} {json.dumps(details)}")
+
+
+def run(accounts=2000, rate=500.0, sessions=4) -> list:
+    """
+    Runs every scenario and returns one result per scenario.
+    """
+
+    import config
+    config.AUDIT_LOG = False
+    config.USER_CACHE = False
+    config.EMAIL_FILTER = False
+
+    import campaign, db, fake_smtp, mailer, shards, users
+
+    results = []
+    emails = [f"user{number:05d}@example.com" for number in range(accounts)]
+
+    def received(smtp) -> Counter:
+        return Counter(receiver.strip("<>") for _, receivers, _ in smtp.messages for receiver in receivers)
+
+    with tempfile.TemporaryDirectory() as directory, fake_smtp.FakeSMTPServer() as smtp:
+
+        def new_campaign(name, **options) -> campaign.Campaign:
+            options = {"rate": rate, "sessions": sessions, "batch_size": 100, **options}
+            return campaign.Campaign(name, "Security notice for $email",
+                                     "Hello $email,\n\nPlease reset your password at $url.\n",
+                                     {"url": "https://example.com/reset"}, directory=directory,
+                                     session_factory=lambda: mailer.SMTPSession("127.0.0.1", smtp.port, use_ssl=False),
+                                     sender_email="security@example.com", **options)
+
+        db.configure_pool(db.SqliteBackend(os.path.join(directory, "main.db")), max_size=2)
+        for number, email in enumerate(emails):
+            users.create_user(email, f"hash-{number}")
+            if number % 3 == 0:
+                users.enable_two_fa(email)
+
+        # send
+        started = time.perf_counter()
+        summary = new_campaign("send").run()
+        seconds = time.perf_counter() - started
+        counts = received(smtp)
+        personalised = all(f"Hello {receivers[0].strip('<>')}," in message for _, receivers, message in smtp.messages)
+        check(results, "send", summary["status"] == "completed" and summary["sent"] == accounts
+              and set(counts) == set(emails) and set(counts.values()) == {1} and personalised
+              and smtp.connections <= sessions and seconds >= (accounts - 1) / rate * 0.95,
+              sent=summary["sent"], connections=smtp.connections, seconds=round(seconds, 2),
+              messages_per_second=round(accounts / seconds, 1), rate_limit=rate)
+
+        # resume
+        smtp.messages.clear()
+        stopping = new_campaign("resume")
+        stopped = []
+
+        def stop_part_way(email, error, record=stopping._record) -> None:
+            record(email, error)
+            stopped.append(email)
+            if len(stopped) == accounts // 3:
+                stopping.stop()
+
+        stopping._record = stop_part_way
+        first = stopping.run()
+        second = new_campaign("resume").run()
+        counts = received(smtp)
+        check(results, "resume", first["status"] == "interrupted" and 0 < first["sent"] < accounts
+              and second["status"] == "completed" and second["sent"] == accounts
+              and set(counts) == set(emails) and set(counts.values()) == {1},
+              first_run_sent=first["sent"], total_sent=second["sent"], duplicates=sum(counts.values()) - len(counts))
+
+        # crash
+        smtp.messages.clear()
+        crashing = new_campaign("crash")
+        crashing._record = lambda email, error, record=crashing._record: (
+            record(email, error), len(smtp.messages) == accounts // 2 and crashing.stop())
+        crashing.run()
+
+        # Roll the checkpoint back two batches, as if the process died before writing them
+        checkpoint_path = os.path.join(directory, "crash", "checkpoint.json")
+        checkpoint = json.loads(Path(checkpoint_path).read_text())
+        journal = Path(directory, "crash", "deliveries.jsonl").read_text().splitlines(keepends=True)
+        kept = journal[:len(journal) - 200]
+        checkpoint.update(after=json.loads(kept[-1])["email"], journal_offset=len("".join(kept)))
+        Path(checkpoint_path).write_text(json.dumps(checkpoint))
+        with open(os.path.join(directory, "crash", "deliveries.jsonl"), "a") as file:
+            file.write('{"email": "cut-off')  # A line the crash left half written
+
+        summary = new_campaign("crash").run()
+        counts = received(smtp)
+        check(results, "crash", summary["status"] == "completed" and summary["sent"] == accounts
+              and set(counts) == set(emails) and set(counts.values()) == {1},
+              total_sent=summary["sent"], duplicates=sum(counts.values()) - len(counts))
+
+        db.get_pool().close()
+
+        # report
+        smtp.messages.clear()
+        shards.configure_shards({name: db.SqliteBackend(os.path.join(directory, f"{name}.db"))
+                                 for name in ("s0", "s1")}, max_size=2)
+        db.configure_pool(db.SqliteBackend(os.path.join(directory, "sharded-main.db")), max_size=2)
+        for number, email in enumerate(emails):
+            users.create_user(email, f"hash-{number}")
+            if number % 3 == 0:
+                users.enable_two_fa(email)
+
+        with_two_fa = {email for number, email in enumerate(emails) if number % 3 == 0}
+        smtp.rejected = set(sorted(with_two_fa)[:5])
+        summary = new_campaign("report", audience="two_fa", rate=0).run()
+        stored = campaign.report("report", directory)
+        counts = received(smtp)
+        check(results, "report", summary["status"] == "completed" and set(counts) == with_two_fa - smtp.rejected
+              and summary["refused"] == 5 and {failure["email"] for failure in summary["failures"]} == smtp.rejected
+              and stored == summary,
+              recipients=summary["recipients"], sent=summary["sent"], refused=summary["refused"])
+
+        shards.configure_shards(None)
+        db.get_pool().close()
+
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Check sending, resuming and reporting notification campaigns.")
+    parser.add_argument("--accounts", type=int, default=2000, help="Accounts to send to")
+    parser.add_argument("--rate", type=float, default=500.0, help="Messages per second limit")
+    parser.add_argument("--sessions", type=int, default=4, help="Parallel SMTP sessions")
+    args = parser.parse_args(argv)
+
+    results = run(args.accounts, args.rate, args.sessions)
+
+    if not all(result["passed"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,274 @@
+"""
+Throughput and latency benchmark for the account flows.
+
+Drives the real auth and user_actions functions with scripted answers in place of
+input() and getpass(), against a local SQLite stand-in database and a fake SMTP server,
+so no SQL Server or mail account is needed. Each simulated user runs in its own process
+(the CLI flows keep the logged-in user in process-global state) and goes through
+register, login, login with 2FA, password reset, change email and delete account.
+2FA and reset codes are read back from the fake SMTP server, so email delivery is part
+of the measured path.
+
+For every flow the report gives p50/p95/p99/mean latency in milliseconds and operations
+per second across all users. Results are written as JSON, and --compare fails the run
+if a flow got slower than a previous result by more than --tolerance.
+
+Usage:
+    python benchmarks/login_bench.py --users 8 --iterations 20 --output bench.json
+    python benchmarks/login_bench.py --users 8 --compare bench.json --tolerance 0.15
+"""
+
+import argparse, builtins, io, json, multiprocessing, os, platform, sqlite3, sys, tempfile, time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+FLOWS = ("register", "login", "login_2fa", "reset", "change_email", "delete")
+CODE_PROMPTS = ("2-FA Code: ", "Code: ")
+
+
+class ScriptedInput:
+    """
+    Stands in for input() and getpass(), answering prompts from a list. Prompts asking
+    for an emailed code are answered with the code from the latest message delivered
+    to the fake SMTP server.
+    """
+
+    def __init__(self, smtp_server, timeout=10.0) -> None:
+        self.smtp_server = smtp_server
+        self.timeout = timeout
+        self.answers = []
+        self._seen_messages = 0
+
+    def script(self, *answers) -> None:
+        self.answers = list(answers)
+
+    def __call__(self, prompt="") -> str:
+        if prompt in CODE_PROMPTS:
+            return self._wait_for_code()
+        return self.answers.pop(0)
+
+    def _wait_for_code(self) -> str:
+        deadline = time.monotonic() + self.timeout
+
+        while len(self.smtp_server.messages) <= self._seen_messages:
+            if time.monotonic() > deadline:
+                raise TimeoutError("No verification email arrived")
+            time.sleep(0.0005)
+
+        self._seen_messages = len(self.smtp_server.messages)
+        return self.smtp_server.messages[-1][2].strip().rsplit(": ", 1)[1]
+
+
+def _run_user(worker, iterations, db_path, password, results) -> None:
+    # Each simulated user runs in its own process with its own fake SMTP server
+    import auth, db, mailer, state, user_actions, users
+    from fake_smtp import FakeSMTPServer
+
+    smtp_server = FakeSMTPServer().start()
+    mailer.configure_mailer(mailer.Mailer(
+        lambda: mailer.SMTPSession("127.0.0.1", smtp_server.port, use_ssl=False), "bench@localhost", workers=1))
+    db.configure_pool(db.SqliteBackend(db_path), max_size=2)
+
+    scripted = ScriptedInput(smtp_server)
+    builtins.input = scripted
+    auth.getpass = user_actions.getpass = scripted
+
+    emails = [f"user{worker}-{number}@bench.local" for number in range(iterations)]
+    new_emails = [f"moved{worker}-{number}@bench.local" for number in range(iterations)]
+
+    def register(index):
+        scripted.script(emails[index], password)
+        auth.create_account()
+        return users.email_exists(emails[index])
+
+    def login(index):
+        scripted.script(emails[index], password)
+        return auth.log_in() == emails[index]
+
+    def login_2fa(index):
+        scripted.script(emails[index], password)
+        return auth.log_in() == emails[index]
+
+    def reset(index):
+        scripted.script(emails[index], password)
+        user_actions.forgot_password()
+        return True
+
+    def change_email(index):
+        state.start_session(emails[index])
+        scripted.script(new_emails[index])
+        user_actions.change_email()
+        return state.current_user() == new_emails[index]
+
+    def delete(index):
+        state.start_session(new_emails[index])
+        scripted.script("y", password)
+        return user_actions.delete_account()
+
+    flows = {"register": register, "login": login, "login_2fa": login_2fa,
+             "reset": reset, "change_email": change_email, "delete": delete}
+    report = {}
+
+    for name in FLOWS:
+        if name == "login_2fa":
+            # Setup, not measured
+            for email in emails:
+                users.enable_two_fa(email)
+
+        latencies, errors = [], 0
+        started = time.time()
+
+        for index in range(iterations):
+            state.end_session()
+            begin = time.perf_counter()
+            try:
+                with redirect_stdout(io.StringIO()):
+                    ok = flows[name](index)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - begin)
+            errors += not ok
+
+        report[name] = {"latencies": latencies, "errors": errors, "started": started, "finished": time.time()}
+
+    mailer.get_mailer().close()
+    smtp_server.stop()
+    results.put(report)
+
+
+def _percentile(sorted_values, fraction) -> float:
+    # Nearest-rank percentile
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(reports) -> dict:
+    """
+    Combines the per-user reports into per-flow latency percentiles and throughput.
+    """
+
+    flows = {}
+
+    for name in FLOWS:
+        latencies = sorted(latency for report in reports for latency in report[name]["latencies"])
+        wall = max(report[name]["finished"] for report in reports) - min(report[name]["started"] for report in reports)
+
+        flows[name] = {
+            "count": len(latencies),
+            "errors": sum(report[name]["errors"] for report in reports),
+            "p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+            "p95_ms": round(_percentile(latencies, 0.95) * 1000, 3),
+            "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "ops_per_sec": round(len(latencies) / wall, 2) if wall > 0 else None,
+        }
+
+    return flows
+
+
+def compare(current, baseline, tolerance) -> list:
+    """
+    Returns a description of every flow whose p95 latency rose, or whose throughput fell,
+    by more than tolerance (a fraction) relative to the baseline results.
+    """
+
+    regressions = []
+
+    for name, stats in current["flows"].items():
+        before = baseline["flows"].get(name)
+        if before is None:
+            continue
+
+        if stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {stats['p95_ms']}ms")
+
+        if before["ops_per_sec"] and stats["ops_per_sec"] and stats["ops_per_sec"] < before["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {before['ops_per_sec']} ops/s -> {stats['ops_per_sec']} ops/s")
+
+    return regressions
+
+
+def run(users=4, iterations=10, rounds=None, password="Benchmark-Password-1") -> dict:
+    """
+    Runs the benchmark and returns the results.
+
+    Args:
+        users (int): Simulated users running at the same time, one process each.
+        iterations (int): Accounts each user takes through every flow.
+        rounds (int | None): bcrypt cost factor; defaults to BCRYPT_ROUNDS.
+        password (str): Password used for every account.
+
+    Returns:
+        dict: Run metadata and per-flow statistics.
+    """
+
+    if rounds is not None:
+        os.environ["BCRYPT_ROUNDS"] = str(rounds)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bench.db")
+
+        # WAL lets the user processes read while another one writes
+        with sqlite3.connect(db_path) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_run_user, args=(worker, iterations, db_path, password, results))
+                     for worker in range(users)]
+
+        started = time.time()
+        for process in processes:
+            process.start()
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        elapsed = time.time() - started
+
+    import config
+
+    return {
+        "meta": {
+            "users": users,
+            "iterations": iterations,
+            "bcrypt_rounds": os.environ.get("BCRYPT_ROUNDS", config.BCRYPT_ROUNDS),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "elapsed_sec": round(elapsed, 3),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "flows": summarize(reports),
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the login simulator's account flows.")
+    parser.add_argument("--users", type=int, default=4, help="Concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=10, help="Accounts per user")
+    parser.add_argument("--rounds", type=int, help="bcrypt cost factor (default: BCRYPT_ROUNDS)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Fail if slower than the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression as a fraction")
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.iterations, args.rounds)
+
+    print(f"{'flow':<14}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>10}")
+    for name, stats in results["flows"].items():
+        print(f"{name:<14}{stats['count']:>7}{stats['errors']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['ops_per_sec']:>10}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
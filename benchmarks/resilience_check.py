@@ -0,0 +1,147 @@
+"""
+Fault-injection checks for the database resilience layer.
+
+Runs the account lookups and the HTTP API against a local SQLite database wrapped in
+db.FaultInjector, which makes connects and statements fail or stall on demand, and
+checks each scenario:
+
+    flaky       A share of statements fail; retried reads still succeed.
+    slow        Statements stall past the query timeout; callers get DatabaseUnavailable
+                within the timeout budget instead of hanging.
+    down        Every connect fails; the circuit breaker opens and later calls fail in
+                well under a millisecond, without touching the database.
+    recovery    Once the database is back, a probe after the reset timeout closes the
+                breaker and lookups work again.
+    api         While the database is down, the API answers 503 instead of 500 or hanging.
+
+Usage:
+    python benchmarks/resilience_check.py
+    python benchmarks/resilience_check.py --failure-rate 0.3 --lookups 2000
+"""
+
+import argparse, asyncio, json, os, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+QUERY_TIMEOUT = 0.2
+BREAKER_RESET = 0.5
+
+
+def check(results, name, passed, **details) -> None:
+    results.append({"scenario": name, "passed": bool(passed), **details})
+    print(f"{'PASS' if passed else 'FAIL'} {name} {json.dumps(details)}")
+
+
+def run(failure_rate=0.2, lookups=1000, seed=1) -> list:
+    """
+    Runs every scenario and returns one result per scenario.
+    """
+
+    import config
+    config.USER_CACHE = False  # Cached records would hide the faults
+    config.EMAIL_FILTER = False
+    config.AUDIT_LOG = False
+    config.DB_READ_RETRIES = 3
+    config.DB_RETRY_BACKOFF = 0.001
+
+    import api, db, service, users
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        injector = db.FaultInjector(db.SqliteBackend(os.path.join(directory, "faults.db"), QUERY_TIMEOUT), seed)
+        breaker = db.CircuitBreaker(failure_threshold=5, reset_timeout=BREAKER_RESET)
+        db.configure_pool(injector, max_size=4, breaker=breaker)
+        users.create_user("user@example.com", "hash")
+
+        # flaky: reads are retried with backoff
+        injector.query_failure_rate = failure_rate
+        succeeded = failed = 0
+        for _ in range(lookups):
+            try:
+                succeeded += users.get_credentials("user@example.com") is not None
+            except db.DatabaseUnavailable:
+                failed += 1
+            if breaker.state != breaker.CLOSED:
+                time.sleep(BREAKER_RESET)  # A rare run of failures opened it; let it probe again
+        injector.query_failure_rate = 0.0
+        expected = 1 - failure_rate ** (config.DB_READ_RETRIES + 1)
+        check(results, "flaky", succeeded / lookups >= expected - 0.02,
+              success_rate=round(succeeded / lookups, 4), expected=round(expected, 4), failed=failed)
+
+        # slow: statements time out instead of hanging
+        injector.query_delay = QUERY_TIMEOUT * 10
+        started = time.perf_counter()
+        try:
+            users.get_credentials("user@example.com")
+            outcome = "answered"
+        except db.DatabaseUnavailable as error:
+            outcome = type(error).__name__
+        elapsed = time.perf_counter() - started
+        injector.query_delay = 0.0
+        budget = QUERY_TIMEOUT * (config.DB_READ_RETRIES + 1) + 0.5
+        check(results, "slow", outcome != "answered" and elapsed < budget,
+              outcome=outcome, seconds=round(elapsed, 3), budget=budget)
+        time.sleep(BREAKER_RESET)
+        users.get_credentials("user@example.com")
+
+        # down: the breaker opens and then fails fast
+        db.get_pool().close()
+        db.configure_pool(injector, max_size=4, breaker=breaker)
+        injector.down = True
+        for _ in range(breaker.failure_threshold):
+            try:
+                users.get_credentials("user@example.com")
+            except db.DatabaseUnavailable:
+                pass
+
+        started = time.perf_counter()
+        fast_failures = 0
+        for _ in range(1000):
+            try:
+                users.get_credentials("user@example.com")
+            except db.CircuitOpen:
+                fast_failures += 1
+        per_call = (time.perf_counter() - started) / 1000
+        check(results, "down", breaker.state == breaker.OPEN and fast_failures == 1000 and per_call < 0.001,
+              state=breaker.state, fast_failures=fast_failures, microseconds_per_call=round(per_call * 1e6, 2))
+
+        # api: 503 while the database is down
+        async def api_login() -> tuple:
+            async with service.LoginService(db_workers=2) as login_service:
+                server = api.ApiServer(login_service)
+                return await server.dispatch("POST", "/login", {}, b'{"email": "user@example.com", "password": "x"}', None)
+
+        status, payload = asyncio.run(api_login())
+        check(results, "api", status == 503, status=status, payload=payload)
+
+        # recovery: a probe after the reset timeout closes the breaker
+        injector.down = False
+        time.sleep(BREAKER_RESET)
+        try:
+            recovered = users.get_credentials("user@example.com") is not None
+        except db.DatabaseUnavailable:
+            recovered = False
+        check(results, "recovery", recovered and breaker.state == breaker.CLOSED, state=breaker.state)
+
+        db.get_pool().close()
+
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Check retries, timeouts and the circuit breaker with injected faults.")
+    parser.add_argument("--failure-rate", type=float, default=0.2, help="Share of statements failing in the flaky scenario")
+    parser.add_argument("--lookups", type=int, default=1000, help="Lookups in the flaky scenario")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the injected faults")
+    args = parser.parse_args(argv)
+
+    results = run(args.failure_rate, args.lookups, args.seed)
+
+    if not all(result["passed"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+"""
+Checks for the sharding layer, with local SQLite files standing in for the shards.
+
+    placement   Accounts created through the users module land on the shard that owns
+                their email, and the shards hold similar numbers of them.
+    rename      change_email to an email owned by another shard moves the row there
+                with every column intact, and the old email is gone from every shard.
+    rebalance   A shard is added and the rows are moved by shards.rebalance() while
+                reader threads keep looking every account up and a writer keeps counting
+                failed logins against them. No lookup may miss, no write may be lost,
+                only about 1/(N+1) of the rows may move, and none may be left misplaced.
+
+Usage:
+    python benchmarks/shard_check.py
+    python benchmarks/shard_check.py --accounts 5000 --shards 4
+"""
+
+import argparse, json, os, sys, tempfile, threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+
+def check(results, name, passed, **details) -> None:
+    results.append({"scenario": name, "passed": bool(passed), **details})
+    print(f"{'PASS' if passed else 'FAIL'} {name} {json.dumps(details)}")
+
+
+def run(accounts=2000, shard_count=3, readers=4) -> list:
+    """
+    Runs every scenario and returns one result per scenario.
+    """
+
+    import config
+    config.AUDIT_LOG = False
+    config.USER_CACHE = False  # Lookups must reach the shards, not the cache
+
+    import db, shards, users
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        def backends(count) -> dict:
+            return {f"s{index}": db.SqliteBackend(os.path.join(directory, f"s{index}.db")) for index in range(count)}
+
+        db.configure_pool(db.SqliteBackend(os.path.join(directory, "main.db")), max_size=2)
+        shard_set = shards.configure_shards(backends(shard_count), max_size=readers + 2)
+
+        # placement
+        emails = [f"user{number}@example.com" for number in range(accounts)]
+        for email in emails:
+            users.create_user(email, "hash")
+
+        report = shards.status()
+        counts = [entry["rows"] for entry in report.values()]
+        misplaced = sum(entry["misplaced"] for entry in report.values())
+        check(results, "placement", sum(counts) == accounts and misplaced == 0 and min(counts) > accounts / shard_count / 2,
+              rows_per_shard=counts, misplaced=misplaced)
+
+        # rename across shards
+        email = emails[0]
+        new_email = next(f"moved{number}@example.com" for number in range(1000)
+                         if shard_set.owner(f"moved{number}@example.com") != shard_set.owner(email))
+        users.record_failed_login(email, 12345)
+        users.change_email(email, new_email)
+        record = users.get_credentials(new_email)
+        holders = [name for name, pool in shard_set.pools.items() if shards.holds(pool, new_email)]
+        old_holders = [name for name, pool in shard_set.pools.items() if shards.holds(pool, email)]
+        check(results, "rename", record is not None and record.locked_until == 12345 and record.failed_logins == 1
+              and holders == [shard_set.owner(new_email)] and not old_holders,
+              holders=holders, old_holders=old_holders)
+        emails[0] = new_email
+
+        # rebalance onto one more shard while readers look every account up
+        shard_set = shards.configure_shards(backends(shard_count + 1), previous=backends(shard_count), max_size=readers + 2)
+        stop = threading.Event()
+        misses = []
+        lookups = [0]
+        failed_logins = {email: 0 for email in emails}
+        failed_logins[emails[0]] = 1
+
+        def read() -> None:
+            while not stop.is_set():
+                for email in emails:
+                    if users.get_credentials(email) is None:
+                        misses.append(email)
+                    lookups[0] += 1
+                    if stop.is_set():
+                        return
+
+        def write() -> None:
+            while not stop.is_set():
+                for email in emails[::7]:
+                    users.record_failed_login(email, None)
+                    failed_logins[email] += 1
+                    if stop.is_set():
+                        return
+
+        threads = [threading.Thread(target=read) for _ in range(readers)] + [threading.Thread(target=write)]
+        for thread in threads:
+            thread.start()
+
+        summary = shards.rebalance(batch_size=100, pause=0.01)
+
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        report = shards.status()
+        misplaced = sum(entry["misplaced"] for entry in report.values())
+        lost_writes = sum(users.get_credentials(email).failed_logins != count for email, count in failed_logins.items())
+        share = summary["moved"] / accounts
+        expected = 1 / (shard_count + 1)
+        check(results, "rebalance", not misses and not lost_writes and misplaced == 0 and not summary["conflicts"]
+              and abs(share - expected) < expected / 2 and all(users.get_credentials(email) for email in emails),
+              moved=summary["moved"], moved_share=round(share, 3), expected_share=round(expected, 3),
+              lookups=lookups[0], misses=len(misses), lost_writes=lost_writes, misplaced=misplaced)
+
+        shards.configure_shards(None)
+        db.get_pool().close()
+
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Check shard routing, cross-shard renames and online rebalancing.")
+    parser.add_argument("--accounts", type=int, default=2000, help="Accounts created")
+    parser.add_argument("--shards", type=int, default=3, help="Shards before the rebalance adds one")
+    parser.add_argument("--readers", type=int, default=4, help="Reader threads during the rebalance")
+    args = parser.parse_args(argv)
+
+    results = run(args.accounts, args.shards, args.readers)
+
+    if not all(result["passed"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,186 @@
+"""
+Checks for the local credential snapshot, with SQLite files standing in for SQL Server.
+
+    build       A full build, sorted in several spilled runs, holds every account with
+                its hash, 2FA flag and lockout; unknown emails are not found.
+    refresh     After password changes, 2FA, lockouts, deletions, renames and new
+                accounts, an incremental refresh reads only the changed emails and
+                leaves the same records as a full build would.
+    shards      The same on two shards, including a rename that moves an account to the
+                other shard.
+    degraded    With the database down, LoginService.login checks passwords against the
+                snapshot, while writes fail with DatabaseUnavailable.
+
+Lookup latency is reported for the build scenario.
+
+Usage:
+    python benchmarks/snapshot_check.py
+    python benchmarks/snapshot_check.py --accounts 20000
+"""
+
+import argparse, asyncio, json, os, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+
+def check(results, name, passed, **details) -> None:
+    results.append({"scenario": name, "passed": bool(passed), **details})
+    print(f"{'PASS' if passed else 'FAIL'} {name} {json.dumps(details)}")
+
+
+def run(accounts=5000) -> list:
+    """
+    Runs every scenario and returns one result per scenario.
+    """
+
+    import config
+    config.AUDIT_LOG = False
+    config.USER_CACHE = False
+    config.EMAIL_FILTER = False
+
+    import db, shards, snapshot, users
+
+    results = []
+
+    def contents(path) -> list:
+        current = snapshot.CredentialSnapshot(path)
+        try:
+            return [record[:5] for record in current.records()]
+        finally:
+            current.close()
+
+    def churn(emails) -> None:
+        # One of each kind of write the snapshot has to follow
+        users.update_password_hash(emails[1], "changed-hash")
+        users.enable_two_fa(emails[2])
+        users.record_failed_login(emails[3], 4102444800)
+        users.delete_user(emails[4])
+        users.change_email(emails[5], "renamed@example.com")
+        for number in range(10):
+            users.create_user(f"new{number}@example.com", f"new-hash-{number}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "credentials.snap")
+        db.configure_pool(db.SqliteBackend(os.path.join(directory, "main.db")), max_size=2)
+
+        # build
+        emails = [f"User{number}@example.com" for number in range(accounts)]
+        for number, email in enumerate(emails):
+            users.create_user(email, f"hash-{number}")
+
+        summary = snapshot.build(path, chunk_size=max(1, accounts // 4))
+        current = snapshot.CredentialSnapshot(path)
+        found = sum(current.get(email.upper()) is not None and current.get(email).password_hash == f"hash-{number}"
+                    for number, email in enumerate(emails))
+        unknown = sum(current.get(f"nobody{number}@example.com") is not None for number in range(1000))
+        keys = [record[0] for record in current.records()]
+
+        started = time.perf_counter()
+        for email in emails:
+            current.get(email)
+        microseconds = (time.perf_counter() - started) / accounts * 1e6
+        current.close()
+
+        check(results, "build", found == accounts and not unknown and keys == sorted(keys) and summary["accounts"] == accounts,
+              accounts=summary["accounts"], found=found, unknown_found=unknown,
+              lookup_microseconds=round(microseconds, 2), size_bytes=os.path.getsize(path))
+
+        # refresh
+        churn(emails)
+        summary = snapshot.refresh(path)
+        incremental = contents(path)
+        snapshot.build(os.path.join(directory, "full.snap"))
+        full = contents(os.path.join(directory, "full.snap"))
+        current = snapshot.CredentialSnapshot(path)
+        record = current.get(emails[3])
+        current.close()
+        check(results, "refresh", summary["mode"] == "incremental" and incremental == full
+              and summary["changed"] < 20 and record.locked_until == 4102444800,
+              mode=summary["mode"], changed=summary["changed"], accounts=summary["accounts"],
+              matches_full_build=incremental == full)
+
+        db.get_pool().close()
+
+        # shards
+        shard_set = shards.configure_shards({name: db.SqliteBackend(os.path.join(directory, f"{name}.db"))
+                                             for name in ("s0", "s1")}, max_size=2)
+        db.configure_pool(db.SqliteBackend(os.path.join(directory, "sharded-main.db")), max_size=2)
+        for number, email in enumerate(emails[:1000]):
+            users.create_user(email, f"hash-{number}")
+
+        sharded_path = os.path.join(directory, "sharded.snap")
+        snapshot.build(sharded_path)
+        churn(emails)
+        mover = emails[10]
+        new_email = next(f"moved{number}@example.com" for number in range(1000)
+                         if shard_set.owner(f"moved{number}@example.com") != shard_set.owner(mover))
+        users.change_email(mover, new_email)
+
+        summary = snapshot.refresh(sharded_path)
+        incremental = contents(sharded_path)
+        snapshot.build(os.path.join(directory, "sharded-full.snap"))
+        full = contents(os.path.join(directory, "sharded-full.snap"))
+        check(results, "shards", summary["mode"] == "incremental" and incremental == full
+              and new_email in [record[1] for record in incremental],
+              mode=summary["mode"], changed=summary["changed"], matches_full_build=incremental == full)
+
+        shards.configure_shards(None)
+        db.get_pool().close()
+
+        # degraded
+        import fake_smtp, mailer, service
+        smtp = fake_smtp.FakeSMTPServer().start()
+        mailer.configure_mailer(mailer.Mailer(lambda: mailer.SMTPSession("127.0.0.1", smtp.port, use_ssl=False),
+                                              "sender@example.com"))
+
+        import hashing
+        injector = db.FaultInjector(db.SqliteBackend(os.path.join(directory, "degraded.db")))
+        db.configure_pool(injector, max_size=2, breaker=db.CircuitBreaker(failure_threshold=3, reset_timeout=60))
+        password_hash = hashing.hash_password("Password1!")
+        users.create_user("plain@example.com", password_hash)
+        users.create_user("2fa@example.com", password_hash)
+        users.enable_two_fa("2fa@example.com")
+
+        degraded_path = os.path.join(directory, "degraded.snap")
+        snapshot.build(degraded_path)
+        config.SNAPSHOT_PATH = degraded_path
+        injector.down = True
+
+        async def logins() -> list:
+            async with service.LoginService(db_workers=2) as login_service:
+                return [await login_service.login("plain@example.com", "Password1!"),
+                        await login_service.login("plain@example.com", "wrong"),
+                        await login_service.login("nobody@example.com", "Password1!"),
+                        await login_service.login("2fa@example.com", "Password1!")]
+
+        statuses = asyncio.run(logins())
+        try:
+            users.update_password_hash("plain@example.com", "x")
+            write = "succeeded"
+        except db.DatabaseUnavailable as error:
+            write = type(error).__name__
+
+        expected = [service.OK, service.BAD_PASSWORD, service.UNKNOWN_EMAIL, service.TWO_FA_REQUIRED]
+        check(results, "degraded", statuses == expected and write != "succeeded", statuses=statuses, write=write)
+
+        mailer.get_mailer().close()
+        smtp.stop()
+        db.get_pool().close()
+
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Check building, refreshing and using the credential snapshot.")
+    parser.add_argument("--accounts", type=int, default=5000, help="Accounts in the snapshot")
+    args = parser.parse_args(argv)
+
+    results = run(args.accounts)
+
+    if not all(result["passed"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+"""
+Startup benchmark for the CLI.
+
+Measures how long `python main.py` takes to show its first ">>> " prompt, and profiles
+`import main` with `python -X importtime` to list the heaviest imports on that path.
+The start page must not load any of the modules in DEFERRED (bcrypt, the database
+driver, SMTP, python-dotenv, ...); the run fails if one of them shows up, so import
+bloat cannot creep back into startup unnoticed.
+
+Results are written as JSON, and --compare fails the run if time-to-first-prompt got
+slower than a previous result by more than --tolerance.
+
+Usage:
+    python benchmarks/startup_bench.py --runs 20 --output startup.json
+    python benchmarks/startup_bench.py --compare startup.json --tolerance 0.20
+"""
+
+import argparse, json, os, platform, statistics, subprocess, sys, time
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+
+# Modules that must only be imported once a command needs them
+DEFERRED = ("bcrypt", "pyodbc", "smtplib", "ssl", "dotenv", "sqlite3", "concurrent.futures.process", "http.server")
+
+
+def time_to_first_prompt(python=sys.executable, timeout=30.0) -> float:
+    """
+    Starts the CLI, waits for its first prompt, answers "quit" and returns the seconds
+    from launch to prompt.
+    """
+
+    started = time.perf_counter()
+    process = subprocess.Popen([python, "main.py"], cwd=APP_DIR, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    output = b""
+    try:
+        while b">>> " not in output:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                raise RuntimeError("The CLI exited before showing a prompt")
+            output += chunk
+            if time.perf_counter() - started > timeout:
+                raise TimeoutError("No prompt within the timeout")
+
+        elapsed = time.perf_counter() - started
+
+    finally:
+        process.communicate(b"quit\n", timeout=timeout)
+
+    return elapsed
+
+
+def import_profile(module="main", python=sys.executable) -> dict:
+    """
+    Runs `python -X importtime -c "import <module>"` and returns the cumulative import
+    time of every module it loaded, in microseconds.
+    """
+
+    result = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"], cwd=APP_DIR,
+                            capture_output=True, text=True, check=True)
+    profile = {}
+
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:       512 |      79425 | auth"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        profile[name.strip()] = int(cumulative)
+
+    return profile
+
+
+def run(runs=10) -> dict:
+    """
+    Measures time-to-first-prompt over several launches and profiles the start page's imports.
+
+    Returns:
+        dict: Run metadata, prompt latency statistics and the import profile.
+    """
+
+    time_to_first_prompt()  # Warm the file system cache and bytecode, not measured
+
+    samples = sorted(time_to_first_prompt() for _ in range(runs))
+    profile = import_profile()
+
+    return {
+        "meta": {
+            "runs": runs,
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "first_prompt": {
+            "p50_ms": round(statistics.median(samples) * 1000, 3),
+            "max_ms": round(samples[-1] * 1000, 3),
+            "min_ms": round(samples[0] * 1000, 3),
+        },
+        "import_main_ms": round(profile.get("main", 0) / 1000, 3),
+        "heaviest_imports_ms": {name: round(micros / 1000, 3)
+                                for name, micros in sorted(profile.items(), key=lambda item: -item[1])[:10]},
+        "deferred_imported": [name for name in DEFERRED if name in profile],
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the CLI's time to first prompt.")
+    parser.add_argument("--runs", type=int, default=10, help="Launches to measure")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Fail if slower than the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.20, help="Allowed regression as a fraction")
+    args = parser.parse_args(argv)
+
+    results = run(args.runs)
+    prompt = results["first_prompt"]
+
+    print(f"time to first prompt: p50 {prompt['p50_ms']}ms  min {prompt['min_ms']}ms  max {prompt['max_ms']}ms")
+    print(f"import main: {results['import_main_ms']}ms")
+    for name, milliseconds in results["heaviest_imports_ms"].items():
+        print(f"  {name:<40}{milliseconds:>10}ms")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    failures = [f"{name} is imported before the first prompt" for name in results["deferred_imported"]]
+
+    if args.compare:
+        before = json.loads(Path(args.compare).read_text())["first_prompt"]["p50_ms"]
+        if prompt["p50_ms"] > before * (1 + args.tolerance):
+            failures.append(f"time to first prompt {before}ms -> {prompt['p50_ms']}ms")
+
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,187 @@
+"""
+Checks for the API supervisor, run against `python api.py --workers N` on a local
+SQLite database.
+
+    start       Every worker comes up and reports its load.
+    crash       A worker killed with SIGKILL is restarted in its slot and the API keeps
+                answering.
+    reload      While clients keep logging in, the .env file is changed to set
+                API_MAX_REQUESTS and the supervisor gets SIGHUP. A new generation of
+                workers takes over, and no login may go unanswered.
+    recycle     With the reloaded limit, workers are recycled while the clients keep
+                logging in, and again no login may go unanswered.
+    shutdown    SIGTERM drains the workers and the supervisor exits with code 0.
+
+Usage:
+    python benchmarks/supervisor_check.py
+    python benchmarks/supervisor_check.py --workers 4 --clients 8
+"""
+
+import argparse, http.client, json, os, re, signal, subprocess, sys, tempfile, threading, time
+from pathlib import Path
+
+APP = Path(__file__).resolve().parent.parent / "app"
+MAX_REQUESTS = 25
+
+
+def check(results, name, passed, **details) -> None:
+    results.append({"scenario": name, "passed": bool(passed), **details})
+    print(f"{'PASS' if passed else 'FAIL'} {name} {json.dumps(details)}")
+
+
+def call(port, method, path, body=None) -> tuple:
+    # One request on a new connection, as a load balancer without keep-alive would send it
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None,
+                           {"Content-Type": "application/json", "Connection": "close"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def wait_for(condition, timeout=20.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+class Clients:
+    """
+    Threads logging in over and over, counting the answers and the requests that got none.
+    """
+
+    def __init__(self, port, count) -> None:
+        self.port = port
+        self.answers = {}
+        self.dropped = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run) for _ in range(count)]
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                status, _ = call(self.port, "POST", "/login", {"email": "user@example.com", "password": "Password1!"})
+                with self._lock:
+                    self.answers[status] = self.answers.get(status, 0) + 1
+            except (OSError, http.client.HTTPException) as error:
+                self.dropped.append(repr(error))
+
+    def __enter__(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+
+def run(workers=3, clients=6) -> list:
+    """
+    Runs every scenario and returns one result per scenario.
+    """
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        env_file = os.path.join(directory, ".env")
+        stats_path = os.path.join(directory, "stats.json")
+        Path(env_file).write_text("API_MAX_REQUESTS=0\n")
+
+        environment = {**os.environ, "ENV_FILE": env_file, "DB_BACKEND": "sqlite",
+                       "DB_SQLITE_PATH": os.path.join(directory, "api.db"), "DB_SHARDS": "",
+                       "SESSION_STORE": "sqlite", "SESSION_STORE_PATH": os.path.join(directory, "sessions.db"),
+                       "CODE_STORE": "sqlite", "CODE_STORE_PATH": os.path.join(directory, "codes.db"),
+                       "AUDIT_LOG": "false", "BCRYPT_ROUNDS": "8", "METRICS_PORT": "0",
+                       "RATE_LIMIT_LOGIN_EMAIL": "1000000/60", "RATE_LIMIT_LOGIN_SOURCE": "1000000/60",
+                       "API_STATS_PATH": stats_path, "API_STATS_INTERVAL": "0.2", "API_GRACEFUL_TIMEOUT": "10"}
+        environment.pop("API_MAX_REQUESTS", None)  # The .env file sets it
+
+        supervisor = subprocess.Popen([sys.executable, str(APP / "api.py"), "--host", "127.0.0.1", "--port", "0",
+                                       "--workers", str(workers)],
+                                      cwd=directory, env=environment, stdout=subprocess.PIPE, text=True)
+        try:
+            port = int(re.search(r":(\d+) ", supervisor.stdout.readline()).group(1))
+
+            def stats() -> dict:
+                try:
+                    return json.loads(Path(stats_path).read_text())
+                except (OSError, ValueError):
+                    return {"workers": []}
+
+            def serving(generation=0) -> list:
+                return [worker for worker in stats()["workers"]
+                        if not worker["retiring"] and worker["generation"] == generation and "requests" in worker]
+
+            # start
+            started = wait_for(lambda: len(serving()) == workers)
+            status, _ = call(port, "POST", "/register", {"email": "user@example.com", "password": "Password1!"})
+            check(results, "start", started and status == 200, workers=len(serving()), register_status=status)
+
+            # crash
+            victim = serving()[0]
+            os.kill(victim["pid"], signal.SIGKILL)
+            restarted = wait_for(lambda: stats()["restarts"] >= 1 and len(serving()) == workers
+                                 and victim["pid"] not in [worker["pid"] for worker in serving()])
+            status, _ = call(port, "GET", "/health")
+            check(results, "crash", restarted and status == 200, killed_pid=victim["pid"],
+                  restarts=stats()["restarts"], health_status=status)
+
+            with Clients(port, clients) as load:
+                # reload
+                time.sleep(1)
+                Path(env_file).write_text(f"API_MAX_REQUESTS={MAX_REQUESTS}\n")
+                supervisor.send_signal(signal.SIGHUP)
+                reloaded = wait_for(lambda: stats()["reloads"] == 1 and len(serving(1)) == workers
+                                    and len(stats()["workers"]) == workers)
+                answered, dropped = sum(load.answers.values()), len(load.dropped)
+                check(results, "reload", reloaded and answered and not dropped and set(load.answers) == {200},
+                      answered=answered, dropped=dropped, answers=load.answers)
+
+                # recycle
+                recycled = wait_for(lambda: stats()["recycles"] >= 2 * workers, timeout=60)
+
+            final = stats()
+            check(results, "recycle", recycled and not load.dropped and set(load.answers) == {200},
+                  recycles=final["recycles"], answered=sum(load.answers.values()), dropped=len(load.dropped),
+                  examples=load.dropped[:3], requests=final["requests"],
+                  max_rss_mb=max((worker.get("max_rss_mb", 0) for worker in final["workers"]), default=0))
+
+            # shutdown
+            started = time.monotonic()
+            supervisor.send_signal(signal.SIGTERM)
+            try:
+                code = supervisor.wait(timeout=20)
+            except subprocess.TimeoutExpired:
+                code = None
+            check(results, "shutdown", code == 0, exit_code=code, seconds=round(time.monotonic() - started, 2))
+
+        finally:
+            if supervisor.poll() is None:
+                supervisor.kill()
+                supervisor.wait()
+
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Check worker restarts, recycling, reloads and graceful shutdown.")
+    parser.add_argument("--workers", type=int, default=3, help="API worker processes")
+    parser.add_argument("--clients", type=int, default=6, help="Client threads logging in during the reload")
+    args = parser.parse_args(argv)
+
+    results = run(args.workers, args.clients)
+
+    if not all(result["passed"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
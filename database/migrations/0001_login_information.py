@@ -0,0 +1,15 @@
+"""
+Creates the LoginInformation table as it was before migrations existed.
+"""
+
+
+def up(migration):
+    if migration.table_exists("LoginInformation"):
+        return
+
+    migration.execute(
+        'CREATE TABLE LoginInformation ('
+        'email VARCHAR(100) PRIMARY KEY, '
+        'password_hash VARCHAR(100) NOT NULL, '
+        'two_fa BIT DEFAULT 0)'
+    )
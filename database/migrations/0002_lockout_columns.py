@@ -0,0 +1,13 @@
+"""
+Adds the wrong-password counter and lock expiry used by the progressive lockout.
+
+Databases set up with an earlier LoginInformation.sql may already have these columns.
+"""
+
+
+def up(migration):
+    migration.add_column("LoginInformation", "failed_logins",
+                         sqlserver="INT NOT NULL DEFAULT 0", sqlite="INT NOT NULL DEFAULT 0")
+
+    # Unix time the account unlocks; NULL when not locked
+    migration.add_column("LoginInformation", "locked_until", sqlserver="BIGINT NULL", sqlite="BIGINT NULL")
@@ -0,0 +1,11 @@
+"""
+Adds the time of each account's last successful login.
+
+A nullable column without a default is a metadata-only change, so it does not rewrite
+or lock a large table.
+"""
+
+
+def up(migration):
+    # Unix time of the last successful login; NULL for accounts that never logged in
+    migration.add_column("LoginInformation", "last_login", sqlserver="BIGINT NULL", sqlite="BIGINT NULL")
@@ -0,0 +1,39 @@
+"""
+Creates the login_events audit table.
+
+Rows are only ever appended in time order, so on SQL Server the table is clustered on
+(occurred_at, event_id): inserts go to the end of the index instead of splitting pages,
+and time-range queries read one contiguous range. The identity column stays the primary
+key as a nonclustered index. On sqlite the rowid is already assigned in insertion
+order, so occurred_at gets a plain index. A second index on (email, occurred_at)
+serves per-account history queries.
+"""
+
+
+def up(migration):
+    if not migration.table_exists("login_events"):
+        migration.execute(
+            sqlserver='CREATE TABLE login_events ('
+                      'event_id BIGINT IDENTITY(1, 1) NOT NULL, '
+                      'occurred_at BIGINT NOT NULL, '  # Unix time in milliseconds
+                      'email VARCHAR(100) NOT NULL, '
+                      'event VARCHAR(32) NOT NULL, '
+                      'source VARCHAR(64) NULL, '
+                      'detail VARCHAR(200) NULL, '
+                      'CONSTRAINT PK_login_events PRIMARY KEY NONCLUSTERED (event_id))',
+            sqlite='CREATE TABLE login_events ('
+                   'event_id INTEGER PRIMARY KEY, '
+                   'occurred_at BIGINT NOT NULL, '
+                   'email VARCHAR(100) NOT NULL, '
+                   'event VARCHAR(32) NOT NULL, '
+                   'source VARCHAR(64) NULL, '
+                   'detail VARCHAR(200) NULL)',
+        )
+
+    migration.create_index("login_events", "IX_login_events_time",
+                           sqlserver='CREATE CLUSTERED INDEX IX_login_events_time ON login_events (occurred_at, event_id)',
+                           sqlite='CREATE INDEX IX_login_events_time ON login_events (occurred_at)')
+
+    migration.create_index("login_events", "IX_login_events_email",
+                           sqlserver='CREATE INDEX IX_login_events_email ON login_events (email, occurred_at)',
+                           sqlite='CREATE INDEX IX_login_events_email ON login_events (email, occurred_at)')
@@ -0,0 +1,30 @@
+"""
+Adds a covering index for the lookup auth.log_in performs:
+
+    SELECT email, password_hash, two_fa, failed_logins, locked_until
+    FROM LoginInformation WHERE email = ?
+
+On SQL Server the primary key is normally the clustered index. Its leaf rows already
+hold every column, so the lookup is a single seek and a second index would only
+duplicate the table. The covering index is created only when the primary key was made
+nonclustered, where it saves the key lookup into the heap on every login.
+
+sqlite always answers an equality lookup from the unique primary key index, even when
+a wider covering index exists, so nothing is created there.
+"""
+
+INDEXED_COLUMNS = "password_hash, two_fa, failed_logins, locked_until"
+
+
+def up(migration):
+    if migration.dialect != "sqlserver":
+        return
+
+    clustered = migration.execute(
+        "SELECT 1 FROM sys.indexes WHERE object_id = OBJECT_ID('LoginInformation') "
+        "AND is_primary_key = 1 AND type = 1").fetchall()
+
+    if not clustered:
+        migration.create_index(
+            "LoginInformation", "IX_LoginInformation_login",
+            sqlserver=f'CREATE NONCLUSTERED INDEX IX_LoginInformation_login ON LoginInformation (email) INCLUDE ({INDEXED_COLUMNS})')
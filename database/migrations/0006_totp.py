@@ -0,0 +1,24 @@
+"""
+Adds the authenticator-app (TOTP) second factor to LoginInformation.
+
+totp_secret holds the account's base32 TOTP secret, or NULL for accounts using emailed
+2FA codes. totp_last_step is the last TOTP time step accepted for the account, so a code
+cannot be used twice. backup_codes holds the SHA-256 hashes of the unused one-time
+backup codes, separated by commas.
+
+If 0005 created the covering login index, it is rebuilt to include the TOTP columns,
+which the login lookup now reads as well.
+"""
+
+INDEXED_COLUMNS = "password_hash, two_fa, failed_logins, locked_until, totp_secret, totp_last_step"
+
+
+def up(migration):
+    migration.add_column("LoginInformation", "totp_secret", sqlserver="VARCHAR(64) NULL", sqlite="VARCHAR(64) NULL")
+    migration.add_column("LoginInformation", "totp_last_step", sqlserver="BIGINT NULL", sqlite="BIGINT NULL")
+    migration.add_column("LoginInformation", "backup_codes", sqlserver="VARCHAR(1000) NULL", sqlite="VARCHAR(1000) NULL")
+
+    if migration.dialect == "sqlserver" and migration.index_exists("LoginInformation", "IX_LoginInformation_login"):
+        migration.execute(
+            f'CREATE NONCLUSTERED INDEX IX_LoginInformation_login ON LoginInformation (email) INCLUDE ({INDEXED_COLUMNS}) '
+            'WITH (DROP_EXISTING = ON)')
@@ -0,0 +1,55 @@
+"""
+Tracks which LoginInformation rows change, so the credential snapshot (snapshot.py) can
+be refreshed from the changed rows instead of a full read.
+
+Only changes to the columns the snapshot holds count, so the last_login and
+failed_logins writes of every login add nothing.
+
+On SQL Server this is the built-in change tracking, enabled on the table with the
+updated columns tracked. It needs change tracking enabled on the database first, which
+cannot happen inside the migration transaction:
+
+    ALTER DATABASE <database> SET CHANGE_TRACKING = ON (CHANGE_RETENTION = 7 DAYS, AUTO_CLEANUP = ON)
+
+Without it the table is left alone, and every snapshot refresh reads the whole table;
+run "ALTER TABLE LoginInformation ENABLE CHANGE_TRACKING WITH (TRACK_COLUMNS_UPDATED = ON)"
+once it is enabled.
+
+On sqlite, triggers append the email of every inserted, deleted or updated row (both
+emails for an email change) to LoginInformation_changes. Its AUTOINCREMENT key is the
+change version; the snapshot refresh deletes entries older than its retention.
+"""
+
+
+def up(migration):
+    if migration.dialect == "sqlserver":
+        database_tracked = migration.execute("SELECT 1 FROM sys.change_tracking_databases WHERE database_id = DB_ID()").fetchall()
+        table_tracked = migration.execute(
+            "SELECT 1 FROM sys.change_tracking_tables WHERE object_id = OBJECT_ID('LoginInformation')").fetchall()
+
+        if database_tracked and not table_tracked:
+            migration.execute('ALTER TABLE LoginInformation ENABLE CHANGE_TRACKING WITH (TRACK_COLUMNS_UPDATED = ON)')
+        return
+
+    if not migration.table_exists("LoginInformation_changes"):
+        migration.execute(
+            'CREATE TABLE LoginInformation_changes ('
+            'version INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'email VARCHAR(100) NOT NULL, '
+            'changed_at BIGINT NOT NULL)'  # Unix time
+        )
+
+    migration.create_index("LoginInformation_changes", "IX_LoginInformation_changes_time",
+                           sqlite='CREATE INDEX IX_LoginInformation_changes_time ON LoginInformation_changes (changed_at)')
+
+    log = "INSERT INTO LoginInformation_changes (email, changed_at) VALUES ({}, CAST(strftime('%s', 'now') AS INTEGER));"
+
+    migration.execute('CREATE TRIGGER IF NOT EXISTS TR_LoginInformation_insert AFTER INSERT ON LoginInformation '
+                      f'BEGIN {log.format("NEW.email")} END')
+    migration.execute('CREATE TRIGGER IF NOT EXISTS TR_LoginInformation_update '
+                      'AFTER UPDATE OF email, password_hash, two_fa, locked_until ON LoginInformation '
+                      f'BEGIN {log.format("OLD.email")} END')
+    migration.execute('CREATE TRIGGER IF NOT EXISTS TR_LoginInformation_rename AFTER UPDATE OF email ON LoginInformation '
+                      f'WHEN NEW.email <> OLD.email BEGIN {log.format("NEW.email")} END')
+    migration.execute('CREATE TRIGGER IF NOT EXISTS TR_LoginInformation_delete AFTER DELETE ON LoginInformation '
+                      f'BEGIN {log.format("OLD.email")} END')